@@ -3,10 +3,10 @@ Story Agent 实现
 处理 ink、记忆、LLM、判定逻辑
 """
 
-import asyncio
 from typing import Dict, Any, List
 import httpx
 import json
+from replicate_poller import prefer_wait_headers, wait_for_prediction
 
 class StoryAgent:
     """
@@ -64,7 +64,8 @@ class StoryAgent:
             "https://api.replicate.com/v1/models/openai/gpt-5-mini/predictions",
             headers={
                 "Authorization": f"Bearer {self._get_replicate_token()}",
-                "Content-Type": "application/json"
+                "Content-Type": "application/json",
+                **prefer_wait_headers(self.http_client.timeout.read)
             },
             json={
                 "input": {
@@ -79,14 +80,12 @@ class StoryAgent:
         
         prediction = response.json()
         
-        # 轮询结果
-        while prediction["status"] not in ["succeeded", "failed"]:
-            await asyncio.sleep(1)
-            response = await self.http_client.get(
-                prediction["urls"]["get"],
-                headers={"Authorization": f"Bearer {self._get_replicate_token()}"}
-            )
-            prediction = response.json()
+        # 轮询结果（指数退避，超时抛出 PredictionTimeout）
+        prediction = await wait_for_prediction(
+            self.http_client,
+            prediction,
+            headers={"Authorization": f"Bearer {self._get_replicate_token()}"}
+        )
         
         if prediction["status"] == "succeeded":
             return prediction["output"]
@@ -132,7 +131,8 @@ class StoryAgent:
             "https://api.replicate.com/v1/models/openai/gpt-5-mini/predictions",
             headers={
                 "Authorization": f"Bearer {self._get_replicate_token()}",
-                "Content-Type": "application/json"
+                "Content-Type": "application/json",
+                **prefer_wait_headers(self.http_client.timeout.read)
             },
             json={
                 "input": {
@@ -144,14 +144,12 @@ class StoryAgent:
         
         prediction = response.json()
         
-        # 轮询结果
-        while prediction["status"] not in ["succeeded", "failed"]:
-            await asyncio.sleep(1)
-            response = await self.http_client.get(
-                prediction["urls"]["get"],
-                headers={"Authorization": f"Bearer {self._get_replicate_token()}"}
-            )
-            prediction = response.json()
+        # 轮询结果（指数退避，超时抛出 PredictionTimeout）
+        prediction = await wait_for_prediction(
+            self.http_client,
+            prediction,
+            headers={"Authorization": f"Bearer {self._get_replicate_token()}"}
+        )
         
         if prediction["status"] == "succeeded":
             try:
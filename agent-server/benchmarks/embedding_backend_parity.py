@@ -0,0 +1,180 @@
+"""
+嵌入后端对比：一致性校验 + 性能基准
+对比 sentence_transformers（PyTorch）与 onnx（ONNX Runtime，默认 int8）后端：
+- 一致性：同一文本嵌入的余弦相似度；同一查询在两种后端下检索结果 top-k 的重合率
+- 性能：批量吞吐、单条延迟、进程常驻内存（每个后端在独立进程中测量）
+
+用法（在 agent-server 目录下，需先导出 ONNX 模型，见 embedding_backends.py）：
+    python benchmarks/embedding_backend_parity.py
+    python benchmarks/embedding_backend_parity.py --corpus memories.txt --min-overlap 0.9
+
+一致性低于 --min-cosine / --min-overlap 时以非零状态码退出，可用于 CI
+"""
+
+import os
+import sys
+import time
+import argparse
+import resource
+import statistics
+import itertools
+import multiprocessing
+from typing import Dict, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_executor import EMBEDDING_MODEL  # noqa: E402
+from vector_index import StoryVectorIndex  # noqa: E402
+
+
+CHARACTERS = ["崇祯皇帝", "袁崇焕", "李自成", "温体仁", "周延儒", "魏忠贤", "皇太极", "吴三桂"]
+EVENTS = [
+    "在朝堂上力陈边关军饷不足",
+    "暗中联络东林党人",
+    "率军击退后金骑兵",
+    "被弹劾贪墨库银",
+    "奏请减免陕西赋税",
+    "于宁远城下固守待援",
+    "密谋刺杀朝中重臣",
+    "献策整顿京营",
+]
+PLACES = ["紫禁城", "宁远", "陕西", "山海关", "辽东"]
+
+QUERIES = [
+    "忠诚的武将",
+    "朝廷财政困难",
+    "农民起义军的动向",
+    "宦官专权",
+    "边关战事告急",
+    "大臣之间的党争",
+]
+
+
+def default_corpus() -> List[str]:
+    return [
+        f"{character}{event}，地点在{place}"
+        for character, event, place in itertools.product(CHARACTERS, EVENTS, PLACES)
+    ]
+
+
+def _rss_mb() -> float:
+    # Linux 下 ru_maxrss 单位为 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_backend(backend: str, corpus: List[str], queries: List[str], batch_size: int, queue):
+    """在独立进程中加载后端并测量（避免两个模型的内存互相干扰）"""
+    from embedding_backends import create_embedding_backend
+
+    baseline = _rss_mb()
+    start = time.perf_counter()
+    model = create_embedding_backend(EMBEDDING_MODEL, backend, threads=1)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    model.encode(corpus[:batch_size])  # 预热
+
+    start = time.perf_counter()
+    embeddings = []
+    for offset in range(0, len(corpus), batch_size):
+        embeddings += model.encode(corpus[offset:offset + batch_size])
+    throughput = len(corpus) / (time.perf_counter() - start)
+
+    latencies = []
+    query_embeddings = []
+    for query in queries * 5:
+        start = time.perf_counter()
+        embedding = model.encode([query])[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        query_embeddings.append(embedding)
+
+    queue.put({
+        "backend": backend,
+        "load_ms": load_ms,
+        "throughput": throughput,
+        "latency_p50": statistics.median(latencies),
+        "rss_mb": _rss_mb() - baseline,
+        "embeddings": embeddings,
+        "query_embeddings": query_embeddings[:len(queries)],
+    })
+
+
+def run_backend(backend: str, corpus: List[str], queries: List[str], batch_size: int) -> Dict:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_backend, args=(backend, corpus, queries, batch_size, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def cosine_parity(a: List[List[float]], b: List[List[float]]) -> np.ndarray:
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    return (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def retrieval_overlap(reference: Dict, candidate: Dict, corpus: List[str], top_k: int) -> float:
+    """同一查询在两种后端各自索引中检索，top-k 结果的平均重合率"""
+    indexes = {}
+    for result in (reference, candidate):
+        index = StoryVectorIndex(result["backend"])
+        index.add([
+            {"id": i, "content": text, "embedding": embedding}
+            for i, (text, embedding) in enumerate(zip(corpus, result["embeddings"]))
+        ])
+        indexes[result["backend"]] = index
+
+    overlaps = []
+    for ref_query, cand_query in zip(reference["query_embeddings"], candidate["query_embeddings"]):
+        expected = {row["id"] for row in indexes[reference["backend"]].search(ref_query, top_k, threshold=-1)}
+        actual = {row["id"] for row in indexes[candidate["backend"]].search(cand_query, top_k, threshold=-1)}
+        overlaps.append(len(expected & actual) / top_k)
+    return float(np.mean(overlaps))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="嵌入后端一致性与性能对比")
+    parser.add_argument("--corpus", help="语料文件（每行一条），默认使用内置样例")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--reference", default="sentence_transformers")
+    parser.add_argument("--candidate", default="onnx")
+    parser.add_argument("--min-cosine", type=float, default=0.98, help="单条嵌入余弦相似度下限（均值）")
+    parser.add_argument("--min-overlap", type=float, default=0.8, help="检索 top-k 重合率下限")
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus, encoding="utf-8") as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    else:
+        corpus = default_corpus()
+
+    results = [
+        run_backend(backend, corpus, QUERIES, args.batch_size)
+        for backend in (args.reference, args.candidate)
+    ]
+
+    print(f"语料 {len(corpus)} 条，批大小 {args.batch_size}\n")
+    print(f"{'后端':<24} {'加载(ms)':>10} {'吞吐(条/s)':>12} {'单条p50(ms)':>12} {'内存(MB)':>10}")
+    for result in results:
+        print(
+            f"{result['backend']:<24} {result['load_ms']:>10.0f} {result['throughput']:>12.1f} "
+            f"{result['latency_p50']:>12.2f} {result['rss_mb']:>10.0f}"
+        )
+
+    reference, candidate = results
+    cosines = cosine_parity(reference["embeddings"], candidate["embeddings"])
+    overlap = retrieval_overlap(reference, candidate, corpus, args.top_k)
+    print(f"\n嵌入余弦相似度：均值 {cosines.mean():.4f}，最小 {cosines.min():.4f}")
+    print(f"检索 top-{args.top_k} 重合率：{overlap:.2%}")
+
+    if cosines.mean() < args.min_cosine or overlap < args.min_overlap:
+        print("❌ 一致性未达标")
+        sys.exit(1)
+    print("✅ 一致性达标")
+
+
+if __name__ == "__main__":
+    main()
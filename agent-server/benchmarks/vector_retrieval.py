@@ -0,0 +1,120 @@
+"""
+向量检索延迟基准测试
+测量不同语料规模下的检索延迟：
+- local：进程内索引（vector_index.StoryVectorIndex）
+- rpc：Supabase match_character_knowledge（HNSW 索引，需 --rpc 且配置 SUPABASE_URL/SUPABASE_SERVICE_ROLE_KEY）
+
+用法（在 agent-server 目录下）：
+    python benchmarks/vector_retrieval.py --sizes 1000,10000,50000
+    python benchmarks/vector_retrieval.py --sizes 1000,10000 --rpc
+
+rpc 模式会向 character_knowledge 写入 story_id 为 bench-<规模> 的随机条目，结束后删除
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+from typing import Callable, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_executor import EMBEDDING_DIM  # noqa: E402
+from vector_index import StoryVectorIndex  # noqa: E402
+
+
+def _random_rows(size: int, dim: int, rng: np.random.Generator) -> List[dict]:
+    embeddings = rng.standard_normal((size, dim), dtype=np.float32)
+    return [
+        {
+            "character_name": f"角色{i % 20}",
+            "content": f"事件 {i}",
+            "content_type": "character_memory",
+            "metadata": {"chapter": i % 10, "importance": 0.5},
+            "embedding": embedding.tolist(),
+        }
+        for i, embedding in enumerate(embeddings)
+    ]
+
+
+def _report(label: str, size: int, timings: List[float]):
+    timings = sorted(timings)
+    p50 = statistics.median(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{label:<6} {size:>8} {p50:>10.3f} {p95:>10.3f}")
+
+
+def bench_local(size: int, rows: List[dict], queries: np.ndarray, limit: int) -> List[float]:
+    index = StoryVectorIndex(f"bench-{size}")
+    index.add(rows)
+    return _time_queries(lambda q: index.search(q, limit=limit, threshold=-1), queries)
+
+
+def _time_queries(search: Callable, queries: np.ndarray) -> List[float]:
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query.tolist())
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+async def bench_rpc(size: int, rows: List[dict], queries: np.ndarray, limit: int) -> List[float]:
+    from supabase_pool import get_async_supabase_client
+
+    supabase = await get_async_supabase_client(
+        os.environ["SUPABASE_URL"],
+        os.environ["SUPABASE_SERVICE_ROLE_KEY"]
+    )
+    story_id = f"bench-{size}"
+    table = supabase.table("character_knowledge")
+    await table.delete().eq("story_id", story_id).execute()
+    try:
+        for offset in range(0, len(rows), 500):
+            await table.insert([
+                {**row, "story_id": story_id} for row in rows[offset:offset + 500]
+            ]).execute()
+
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            await supabase.rpc("match_character_knowledge", {
+                "query_embedding": query.tolist(),
+                "match_threshold": -1,
+                "match_count": limit,
+                "story_filter": story_id,
+            }).execute()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+    finally:
+        await table.delete().eq("story_id", story_id).execute()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="向量检索延迟基准测试")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="语料规模（逗号分隔）")
+    parser.add_argument("--queries", type=int, default=200, help="每个规模的查询次数")
+    parser.add_argument("--limit", type=int, default=5, help="每次返回条数")
+    parser.add_argument("--dim", type=int, default=EMBEDDING_DIM, help="嵌入维度")
+    parser.add_argument("--rpc", action="store_true", help="同时测试数据库 RPC 检索")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    print(f"{'模式':<6} {'条数':>8} {'p50(ms)':>10} {'p95(ms)':>10}")
+    for size in sizes:
+        rows = _random_rows(size, args.dim, rng)
+        queries = rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+
+        _report("local", size, bench_local(size, rows, queries, args.limit))
+        if args.rpc:
+            _report("rpc", size, await bench_rpc(size, rows, queries, args.limit))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
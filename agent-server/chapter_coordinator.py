@@ -0,0 +1,88 @@
+"""
+章节推进
+剧本配置视图与规则章节协调器（不依赖 CrewAI，可独立测试）
+"""
+
+from typing import Any, Dict, FrozenSet, Mapping, Optional
+
+from story_registry import get_story_registry
+from turn_state import FINISHED_STATUSES
+
+
+class StoryConfig:
+    """剧本配置（注册表中只读定义的视图，创建无额外开销）"""
+    def __init__(self, story_id: str):
+        self.story_id = story_id
+        self.definition = get_story_registry().get(story_id)
+        self.chapters = self.load_chapters()
+        self.characters = self.load_characters()
+    
+    def load_chapters(self) -> Mapping[int, Mapping]:
+        """加载章节配置"""
+        return self.definition.chapters if self.definition else {}
+    
+    def load_characters(self) -> Mapping[str, Mapping]:
+        """加载角色配置"""
+        return self.definition.characters if self.definition else {}
+    
+    @property
+    def last_chapter(self) -> int:
+        return self.definition.last_chapter if self.definition else 1
+    
+    def main_situations(self, chapter: int) -> FrozenSet[str]:
+        """章节的主要局势"""
+        if not self.definition:
+            return frozenset()
+        return self.definition.main_situations.get(chapter, frozenset())
+    
+    def uses_llm_transition(self, chapter: int) -> bool:
+        """章节是否声明了非确定性推进（需由 LLM 协调者判断）"""
+        return self.chapters.get(chapter, {}).get("transition") == "llm"
+
+
+class ChapterCoordinator:
+    """
+    规则章节协调器
+    
+    1. 当前章节所有主要局势都完成（成功或失败）→ 推进到下一章
+    2. 已是最后一章且主要局势完成 → 进入结局
+    3. 否则继续当前章节
+    """
+    
+    def __init__(self, config: StoryConfig):
+        self.config = config
+    
+    def decide(
+        self,
+        current_chapter: int,
+        situations: Dict[str, Dict],
+        situation_update: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        根据局势状态决定章节推进
+        
+        Args:
+            current_chapter: 当前章节
+            situations: 会话局势状态 {situation_id: state}
+            situation_update: 本回合的局势评估（覆盖对应局势的状态）
+        
+        Returns:
+            continue | next_chapter | ending
+        """
+        main_situations = self.config.main_situations(current_chapter)
+        if not main_situations:
+            return "continue"
+        
+        statuses = {
+            situation_id: state.get("status")
+            for situation_id, state in situations.items()
+        }
+        if situation_update and situation_update.get("situation_id"):
+            statuses[situation_update["situation_id"]] = situation_update.get("status")
+        
+        if any(statuses.get(situation_id) not in FINISHED_STATUSES for situation_id in main_situations):
+            return "continue"
+        
+        if current_chapter >= self.config.last_chapter:
+            return "ending"
+        return "next_chapter"
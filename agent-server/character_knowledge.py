@@ -4,10 +4,18 @@
 """
 
 from typing import List, Dict, Any, Optional
-from supabase import create_client, Client
-from sentence_transformers import SentenceTransformer
-import numpy as np
+from supabase import AsyncClient
+from supabase_pool import get_async_supabase_client
+from embedding_service import EmbeddingService
+from embedding_executor import EmbeddingExecutor, get_embedding_executor
+from vector_index import VectorIndexRegistry, INDEX_FIELDS
+from memory_ranker import MemoryRanker, PROFILE_TOKEN_BUDGET, truncate_to_tokens
 import json
+import os
+
+# 记忆检索候选数与最低相似度（候选再由 MemoryRanker 排序、按预算截取）
+MEMORY_CANDIDATE_COUNT = int(os.getenv("MEMORY_CANDIDATE_COUNT", "20"))
+MEMORY_MIN_SIMILARITY = float(os.getenv("MEMORY_MIN_SIMILARITY", "0.3"))
 
 class CharacterKnowledgeBase:
     """
@@ -15,32 +23,69 @@ class CharacterKnowledgeBase:
     支持向量检索和结构化查询
     """
     
-    def __init__(self, supabase_url: str, supabase_key: str):
-        self.supabase: Client = create_client(supabase_url, supabase_key)
+    def __init__(
+        self,
+        supabase_url: str,
+        supabase_key: str,
+        executor: Optional[EmbeddingExecutor] = None
+    ):
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
         
-        # 使用本地嵌入模型（免费）
-        self.embedding_model = SentenceTransformer(
-            'paraphrase-multilingual-MiniLM-L12-v2'
-        )
+        # 使用本地嵌入模型（免费），推理在执行器中运行，不阻塞事件循环
+        self.executor = executor or get_embedding_executor()
+        
+        # 批量嵌入服务：合并并发请求、按内容哈希缓存
+        self.embeddings = EmbeddingService(self.executor.encode_sync, self.executor.encode)
+        
+        # 进程内向量索引（按剧本懒加载），不可用时回退到数据库 RPC
+        self.vector_index = VectorIndexRegistry(self._load_story_vectors)
         
         # 或者使用 OpenAI（更好但收费）
         # import openai
         # self.openai_client = openai.OpenAI()
     
+    async def _get_client(self) -> AsyncClient:
+        """获取进程内共享的异步 Supabase 客户端"""
+        return await get_async_supabase_client(self.supabase_url, self.supabase_key)
+    
+    async def _load_story_vectors(
+        self,
+        story_id: str,
+        since: Optional[str] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """分页加载剧本的知识条目（用于构建本地索引；since 不为空时只加载该时间之后写入的条目）"""
+        supabase = await self._get_client()
+        columns = ", ".join(INDEX_FIELDS + ("embedding", "created_at"))
+        rows: List[Dict[str, Any]] = []
+        page_size = 1000
+        while True:
+            query = supabase.table("character_knowledge")\
+                .select(columns)\
+                .eq("story_id", story_id)
+            if since:
+                query = query.gte("created_at", since)
+            result = await query\
+                .order("id")\
+                .range(len(rows), len(rows) + page_size - 1)\
+                .execute()
+            rows.extend(result.data)
+            if len(result.data) < page_size:
+                return rows
+            if len(rows) > self.vector_index.max_rows:
+                return None
+    
     def generate_embedding(self, text: str) -> List[float]:
         """
-        生成文本嵌入
+        生成文本嵌入（同步，共用嵌入缓存）
         """
-        # 方式1：本地模型（免费）
-        embedding = self.embedding_model.encode(text)
-        return embedding.tolist()
-        
-        # 方式2：OpenAI（更好但收费）
-        # response = self.openai_client.embeddings.create(
-        #     model="text-embedding-3-small",
-        #     input=text
-        # )
-        # return response.data[0].embedding
+        return self.embeddings.embed_sync(text)
+    
+    async def agenerate_embedding(self, text: str) -> List[float]:
+        """
+        生成文本嵌入（并发请求合并为批量编码）
+        """
+        return await self.embeddings.embed(text)
     
     async def add_character(
         self,
@@ -82,10 +127,11 @@ class CharacterKnowledgeBase:
 """
         
         # 生成嵌入
-        embedding = self.generate_embedding(full_text)
+        embedding = await self.agenerate_embedding(full_text)
         
         # 存储到数据库
-        await self.supabase.table("character_knowledge").insert({
+        supabase = await self._get_client()
+        result = await supabase.table("character_knowledge").insert({
             "story_id": story_id,
             "character_name": character_name,
             "background": background,
@@ -96,6 +142,7 @@ class CharacterKnowledgeBase:
             "metadata": metadata or {},
             "content_type": "character_profile"
         }).execute()
+        self.vector_index.add(story_id, result.data)
     
     async def add_character_memory(
         self,
@@ -115,20 +162,49 @@ class CharacterKnowledgeBase:
             chapter: 发生的章节
             importance: 重要性（0-1）
         """
-        embedding = self.generate_embedding(event)
+        await self.add_character_memories(
+            story_id=story_id,
+            character_names=[character_name],
+            event=event,
+            chapter=chapter,
+            importance=importance
+        )
+    
+    async def add_character_memories(
+        self,
+        story_id: str,
+        character_names: List[str],
+        event: str,
+        chapter: int,
+        importance: float = 0.5
+    ):
+        """
+        为多个角色添加同一事件的记忆
         
-        await self.supabase.table("character_knowledge").insert({
-            "story_id": story_id,
-            "character_name": character_name,
-            "content": event,
-            "embedding": embedding,
-            "metadata": {
-                "chapter": chapter,
-                "importance": importance,
-                "type": "memory"
-            },
-            "content_type": "character_memory"
-        }).execute()
+        事件文本只编码一次，所有角色的记忆一次批量插入
+        """
+        if not character_names:
+            return
+        
+        embedding = await self.agenerate_embedding(event)
+        
+        supabase = await self._get_client()
+        result = await supabase.table("character_knowledge").insert([
+            {
+                "story_id": story_id,
+                "character_name": character_name,
+                "content": event,
+                "embedding": embedding,
+                "metadata": {
+                    "chapter": chapter,
+                    "importance": importance,
+                    "type": "memory"
+                },
+                "content_type": "character_memory"
+            }
+            for character_name in character_names
+        ]).execute()
+        self.vector_index.add(story_id, result.data)
     
     async def update_character_state(
         self,
@@ -145,7 +221,8 @@ class CharacterKnowledgeBase:
             state_updates: 状态更新（如 {"loyalty": 80, "power": 50}）
         """
         # 获取当前角色
-        result = await self.supabase.table("character_knowledge")\
+        supabase = await self._get_client()
+        result = await supabase.table("character_knowledge")\
             .select("*")\
             .eq("story_id", story_id)\
             .eq("character_name", character_name)\
@@ -160,7 +237,7 @@ class CharacterKnowledgeBase:
             new_state = {**current_state, **state_updates}
             
             # 更新数据库
-            await self.supabase.table("character_knowledge")\
+            await supabase.table("character_knowledge")\
                 .update({"current_state": new_state})\
                 .eq("id", character["id"])\
                 .execute()
@@ -170,7 +247,8 @@ class CharacterKnowledgeBase:
         story_id: str,
         query: str,
         limit: int = 5,
-        threshold: float = 0.7
+        threshold: float = 0.7,
+        content_type: Optional[str] = None
     ) -> List[Dict[str, Any]]:
         """
         检索相关的角色信息
@@ -180,23 +258,40 @@ class CharacterKnowledgeBase:
             query: 查询文本（如"忠诚的大臣"）
             limit: 返回数量
             threshold: 相似度阈值
+            content_type: 只检索某类条目（character_profile / character_memory）
         
         Returns:
             相关角色信息列表
         """
         # 生成查询嵌入
-        query_embedding = self.generate_embedding(query)
+        query_embedding = await self.agenerate_embedding(query)
         
-        # 调用 Supabase RPC 函数进行向量搜索
-        result = await self.supabase.rpc(
-            "match_character_knowledge",
-            {
-                "query_embedding": query_embedding,
-                "match_threshold": threshold,
-                "match_count": limit,
-                "story_filter": story_id
-            }
-        ).execute()
+        # 优先使用进程内索引
+        try:
+            index = await self.vector_index.get(story_id)
+        except Exception as e:
+            print(f"⚠️  加载向量索引失败，使用数据库检索: {e}")
+            index = None
+        if index is not None:
+            return index.search(
+                query_embedding,
+                limit=limit,
+                threshold=threshold,
+                content_type=content_type
+            )
+        
+        # 回退：调用 Supabase RPC 函数进行向量搜索
+        params = {
+            "query_embedding": query_embedding,
+            "match_threshold": threshold,
+            "match_count": limit,
+            "story_filter": story_id
+        }
+        if content_type:
+            params["content_type_filter"] = content_type
+        
+        supabase = await self._get_client()
+        result = await supabase.rpc("match_character_knowledge", params).execute()
         
         return result.data
     
@@ -208,7 +303,8 @@ class CharacterKnowledgeBase:
         """
         根据名称获取角色完整信息
         """
-        result = await self.supabase.table("character_knowledge")\
+        supabase = await self._get_client()
+        result = await supabase.table("character_knowledge")\
             .select("*")\
             .eq("story_id", story_id)\
             .eq("character_name", character_name)\
@@ -229,7 +325,8 @@ class CharacterKnowledgeBase:
         """
         获取角色的记忆（发生过的事件）
         """
-        query = self.supabase.table("character_knowledge")\
+        supabase = await self._get_client()
+        query = supabase.table("character_knowledge")\
             .select("*")\
             .eq("story_id", story_id)\
             .eq("character_name", character_name)\
@@ -250,7 +347,8 @@ class CharacterKnowledgeBase:
         """
         获取剧本的所有角色
         """
-        result = await self.supabase.table("character_knowledge")\
+        supabase = await self._get_client()
+        result = await supabase.table("character_knowledge")\
             .select("*")\
             .eq("story_id", story_id)\
             .eq("content_type", "character_profile")\
@@ -418,8 +516,13 @@ class StoryAgentWithKnowledge:
     集成角色知识库的 Agent
     """
     
-    def __init__(self, knowledge_base: CharacterKnowledgeBase):
+    def __init__(
+        self,
+        knowledge_base: CharacterKnowledgeBase,
+        ranker: Optional[MemoryRanker] = None
+    ):
         self.kb = knowledge_base
+        self.ranker = ranker or MemoryRanker()
     
     async def generate_story_with_context(
         self,
@@ -443,12 +546,15 @@ class StoryAgentWithKnowledge:
             if char_info:
                 character_contexts.append(char_info)
         
-        # 3. 检索相关的历史事件
-        relevant_memories = await self.kb.retrieve_character_info(
+        # 3. 检索相关的历史事件：多取候选，按相似度、重要性、时近性排序后装入 token 预算
+        candidates = await self.kb.retrieve_character_info(
             story_id=story_id,
             query=user_input,
-            limit=5
+            limit=MEMORY_CANDIDATE_COUNT,
+            threshold=MEMORY_MIN_SIMILARITY,
+            content_type="character_memory"
         )
+        relevant_memories = self.ranker.pack(candidates, current_state["chapter"])
         
         # 4. 构建增强的提示词
         enhanced_prompt = self.build_prompt_with_knowledge(
@@ -492,17 +598,21 @@ class StoryAgentWithKnowledge:
 相关角色信息：
 """
         
+        # 角色档案共享固定预算，提到的角色越多每人越精简
+        per_character = PROFILE_TOKEN_BUDGET // max(1, len(character_contexts))
         for char in character_contexts:
             prompt += f"""
 【{char['character_name']}】
-背景：{char['background']}
-性格：{char['personality']}
-当前状态：{json.dumps(char['current_state'], ensure_ascii=False)}
+背景：{truncate_to_tokens((char.get('background') or '').strip(), per_character // 2)}
+性格：{truncate_to_tokens((char.get('personality') or '').strip(), per_character // 4)}
+当前状态：{json.dumps(char.get('current_state') or {}, ensure_ascii=False)}
 """
         
         prompt += "\n相关历史事件：\n"
         for memory in relevant_memories:
-            prompt += f"- {memory.get('content', '')}\n"
+            chapter = (memory.get('metadata') or {}).get('chapter')
+            prefix = f"[第{chapter}章] " if chapter else ""
+            prompt += f"- {prefix}{memory.get('content', '')}\n"
         
         prompt += f"\n玩家选择：{user_input}\n"
         prompt += "\n请根据以上信息，生成生动的剧情描述。注意保持角色性格一致，考虑历史事件的影响。"
@@ -533,15 +643,14 @@ class StoryAgentWithKnowledge:
         # 提取涉及的角色
         characters = self.extract_characters(event)
         
-        # 为每个角色添加记忆
-        for char_name in characters:
-            await self.kb.add_character_memory(
-                story_id=story_id,
-                character_name=char_name,
-                event=event,
-                chapter=chapter,
-                importance=0.7
-            )
+        # 事件只编码一次，所有角色的记忆一次写入
+        await self.kb.add_character_memories(
+            story_id=story_id,
+            character_names=characters,
+            event=event,
+            chapter=chapter,
+            importance=0.7
+        )
 
 
 if __name__ == "__main__":
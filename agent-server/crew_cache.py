@@ -0,0 +1,108 @@
+"""
+Agent Crew 缓存
+按 story_id 缓存 StoryAgentCrew，LRU + 空闲超时淘汰，带命中率统计；
+异步接口在线程中创建条目（构建 Agent 与首次导入 crewai 都较慢，不能阻塞事件循环）
+"""
+
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Callable, Dict, Any, Iterable
+
+
+CREW_CACHE_MAX_SIZE = int(os.getenv("CREW_CACHE_MAX_SIZE", "8"))
+CREW_CACHE_TTL = float(os.getenv("CREW_CACHE_TTL", "1800"))  # 空闲秒数
+
+
+class CrewCache:
+    """有界 LRU 缓存，条目空闲超过 ttl 秒后淘汰"""
+
+    def __init__(
+        self,
+        factory: Callable[[str], Any],
+        max_size: int = CREW_CACHE_MAX_SIZE,
+        ttl: float = CREW_CACHE_TTL,
+    ):
+        self.factory = factory
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._building: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def aget(self, key: str) -> Any:
+        """获取缓存条目，不存在时在线程中创建（同一 key 的并发未命中只创建一次）"""
+        self._evict_idle(time.monotonic())
+
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            self.put(key, await self._build(key))
+
+        self._last_used[key] = time.monotonic()
+        return self._entries[key]
+
+    async def warm_up(self, keys: Iterable[str]):
+        """预先在线程中创建条目（不计入命中统计）"""
+        for key in keys:
+            if key not in self._entries:
+                self.put(key, await self._build(key))
+
+    async def _build(self, key: str) -> Any:
+        building = self._building.get(key)
+        if building is None:
+            building = asyncio.ensure_future(asyncio.to_thread(self.factory, key))
+            self._building[key] = building
+            building.add_done_callback(lambda _: self._building.pop(key, None))
+        # shield：单个等待方被取消时不影响其他等待方
+        return await asyncio.shield(building)
+
+    def put(self, key: str, value: Any):
+        """放入预先创建好的条目（如在线程中构建后放入，不计入命中统计）"""
+        if key not in self._entries:
+            self._entries[key] = value
+            self._last_used[key] = time.monotonic()
+            self._evict_overflow()
+
+    def _evict_idle(self, now: float):
+        # OrderedDict 按最近使用排序，最旧的在前
+        while self._entries:
+            key = next(iter(self._entries))
+            if now - self._last_used[key] < self.ttl:
+                break
+            self._remove(key)
+
+    def _evict_overflow(self):
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        del self._entries[key]
+        del self._last_used[key]
+        self.evictions += 1
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
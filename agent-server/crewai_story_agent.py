@@ -3,103 +3,139 @@ CrewAI 故事 Agent 完整实现
 支持章节/局势推进、角色管理、多结局、断点续玩
 """
 
+import os
+import asyncio
+from contextlib import asynccontextmanager
 from crewai import Agent, Task, Crew, Process
-from typing import Dict, Any, List, Optional
-from supabase import create_client, Client
+from typing import Dict, Any, List, Optional, AsyncIterator, Literal
+from pydantic import BaseModel, Field, ValidationError
 import json
-from datetime import datetime
 from replicate_llm import create_replicate_llm
+from database import DatabaseManager
+from session_cache import SessionStateCache
+from turn_state import CHARACTER_STATUSES, build_turn_delta, apply_delta_to_snapshot
+from chapter_coordinator import StoryConfig, ChapterCoordinator
 
-class StoryConfig:
-    """剧本配置"""
-    def __init__(self, story_id: str):
-        self.story_id = story_id
-        self.chapters = self.load_chapters()
-        self.characters = self.load_characters()
+CHAPTER_ACTIONS = ("continue", "next_chapter", "ending")
+
+# 回合模式：multi_agent（多 Agent 任务链）| fused（单次 LLM 调用）
+STORY_TURN_MODE = os.getenv("STORY_TURN_MODE", "multi_agent")
+
+# 融合模式下剧情与 JSON 结果之间的分隔标记
+FUSED_JSON_MARKER = "<<<TURN_JSON>>>"
+
+# 每个剧本保留的空闲 Agent 组数（并发回合更多时临时新建，用完超出部分丢弃）
+CREW_AGENT_POOL_SIZE = int(os.getenv("CREW_AGENT_POOL_SIZE", "4"))
+
+
+# ============ 融合模式输出结构 ============
+
+# 提示词中的角色状态取值，与校验、写入使用同一份列表
+CHARACTER_STATUS_CHOICES = "|".join(CHARACTER_STATUSES)
+
+class SituationJudgment(BaseModel):
+    """局势评估"""
+    score_change: int = Field(ge=-50, le=50)
+    new_score: int
+    status: Literal["in_progress", "success", "failed"]
+    rationale: str = ""
+
+
+class CharacterUpdate(BaseModel):
+    """角色状态变化"""
+    character_name: str
+    status: Optional[Literal[CHARACTER_STATUSES]] = None
+    attribute_changes: Dict[str, float] = Field(default_factory=dict)
+
+
+class FusedTurnResult(BaseModel):
+    """融合模式 JSON 块"""
+    situation_update: SituationJudgment
+    character_updates: List[CharacterUpdate] = Field(default_factory=list)
+    chapter_status: Literal["continue", "next_chapter", "ending"]
+
+
+def _task_levels(tasks: List[Task]) -> List[List[Task]]:
+    """
+    按 context 依赖对任务链分层，同层任务互不依赖
+    tasks 需已按拓扑顺序排列。
+    """
+    levels: Dict[int, int] = {}
+    groups: List[List[Task]] = []
+    for task in tasks:
+        deps = task.context if isinstance(task.context, list) else []
+        level = 1 + max(
+            (levels[id(dep)] for dep in deps if id(dep) in levels),
+            default=-1
+        )
+        levels[id(task)] = level
+        if level == len(groups):
+            groups.append([])
+        groups[level].append(task)
+    return groups
+
+
+def _task_output_text(task: Task) -> str:
+    """读取任务输出文本（兼容不同 CrewAI 版本的 TaskOutput 字段）"""
+    output = getattr(task, "output", None)
+    if output is None:
+        return ""
+    for attr in ("raw", "raw_output", "exported_output"):
+        value = getattr(output, attr, None)
+        if value:
+            return str(value)
+    return str(output)
+
+
+def _extract_json(text: str) -> Any:
+    """从 LLM 输出中提取 JSON（兼容 ```json 代码块和前后说明文字）"""
+    if not text:
+        return None
     
-    def load_chapters(self) -> Dict[int, Dict]:
-        """加载章节配置"""
-        # 示例：崇祯皇帝剧本
-        if self.story_id == "chongzhen":
-            return {
-                1: {
-                    "title": "新君即位",
-                    "situations": {
-                        "eunuch_party": {
-                            "type": "main",
-                            "name": "铲除阉党",
-                            "target_score": 100,
-                            "description": "魏忠贤把持朝政，必须铲除"
-                        },
-                        "border_defense": {
-                            "type": "optional",
-                            "name": "加强边防",
-                            "target_score": 80,
-                            "description": "后金威胁日益严重"
-                        }
-                    }
-                },
-                2: {
-                    "title": "内忧外患",
-                    "situations": {
-                        "yuan_chonghuan": {
-                            "type": "main",
-                            "name": "袁崇焕之死",
-                            "target_score": 100,
-                            "description": "如何处理袁崇焕"
-                        },
-                        "peasant_revolt": {
-                            "type": "main",
-                            "name": "农民起义",
-                            "target_score": 100,
-                            "description": "陕西农民起义愈演愈烈"
-                        }
-                    }
-                },
-                3: {
-                    "title": "大厦将倾",
-                    "situations": {
-                        "final_battle": {
-                            "type": "main",
-                            "name": "最后决战",
-                            "target_score": 100,
-                            "description": "李自成兵临城下"
-                        }
-                    }
-                }
-            }
-        return {}
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        if text.startswith("json"):
+            text = text[4:]
     
-    def load_characters(self) -> Dict[str, Dict]:
-        """加载角色配置"""
-        if self.story_id == "chongzhen":
-            return {
-                "崇祯皇帝": {
-                    "background": "明朝第十六位皇帝，勤政但多疑",
-                    "initial_state": {
-                        "status": "alive",
-                        "authority": 70,
-                        "wisdom": 60
-                    }
-                },
-                "袁崇焕": {
-                    "background": "督师蓟辽，忠诚的边关大将",
-                    "initial_state": {
-                        "status": "alive",
-                        "loyalty": 95,
-                        "military_ability": 90
-                    }
-                },
-                "李自成": {
-                    "background": "农民起义军领袖",
-                    "initial_state": {
-                        "status": "alive",
-                        "power": 30,
-                        "army_size": 10000
-                    }
-                }
-            }
-        return {}
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    
+    # 截取第一个完整的对象或数组
+    for open_char, close_char in (("{", "}"), ("[", "]")):
+        start = text.find(open_char)
+        end = text.rfind(close_char)
+        if start != -1 and end > start:
+            try:
+                return json.loads(text[start:end + 1])
+            except json.JSONDecodeError:
+                continue
+    return None
+
+
+class TurnAgents:
+    """
+    一个回合独占的一组 Agent
+
+    CrewAI 执行任务时会修改 Agent 自身（agent_executor、工具状态），
+    同一组 Agent 不能被并发回合共享
+    """
+
+    def __init__(
+        self,
+        narrator: Agent,
+        situation_judge: Agent,
+        character_manager: Agent,
+        chapter_coordinator: Agent,
+        ending_generator: Agent
+    ):
+        self.narrator = narrator
+        self.situation_judge = situation_judge
+        self.character_manager = character_manager
+        self.chapter_coordinator = chapter_coordinator
+        self.ending_generator = ending_generator
 
 
 class StoryAgentCrew:
@@ -109,11 +145,18 @@ class StoryAgentCrew:
         self,
         supabase_url: str,
         supabase_key: str,
-        story_id: str
+        story_id: str,
+        turn_mode: str = STORY_TURN_MODE,
+        state_store: Optional[SessionStateCache] = None,
+        agent_pool_size: int = CREW_AGENT_POOL_SIZE
     ):
-        self.supabase: Client = create_client(supabase_url, supabase_key)
+        self.db = DatabaseManager(supabase_url, supabase_key)
+        # 会话状态缓存（Redis 写回），为空时直接写数据库
+        self.state_store = state_store
         self.config = StoryConfig(story_id)
+        self.coordinator = ChapterCoordinator(self.config)
         self.story_id = story_id
+        self.turn_mode = turn_mode
         
         # 创建 Replicate LLM
         self.llm = create_replicate_llm(
@@ -122,12 +165,30 @@ class StoryAgentCrew:
             temperature=0.7
         )
         
-        # 创建 Agents
-        self.narrator = self._create_narrator()
-        self.situation_judge = self._create_situation_judge()
-        self.character_manager = self._create_character_manager()
-        self.chapter_coordinator = self._create_chapter_coordinator()
-        self.ending_generator = self._create_ending_generator()
+        # 创建 Agents（预建一组，回合执行时独占借出）
+        self.agent_pool_size = agent_pool_size
+        self._idle_agents: List[TurnAgents] = [self._create_agents()]
+    
+    def _create_agents(self) -> TurnAgents:
+        return TurnAgents(
+            narrator=self._create_narrator(),
+            situation_judge=self._create_situation_judge(),
+            character_manager=self._create_character_manager(),
+            chapter_coordinator=self._create_chapter_coordinator(),
+            ending_generator=self._create_ending_generator()
+        )
+    
+    @asynccontextmanager
+    async def _checkout_agents(self) -> AsyncIterator[TurnAgents]:
+        """借出一组空闲 Agent，没有空闲时在线程中新建（不阻塞事件循环）"""
+        if self._idle_agents:
+            agents = self._idle_agents.pop()
+        else:
+            agents = await asyncio.to_thread(self._create_agents)
+        yield agents
+        # 仅在回合正常结束时归还：出错或取消时线程中的任务可能仍在使用这组 Agent
+        if len(self._idle_agents) < self.agent_pool_size:
+            self._idle_agents.append(agents)
     
     def _create_narrator(self) -> Agent:
         """创建叙事者 Agent"""
@@ -187,11 +248,18 @@ class StoryAgentCrew:
     async def process_user_action(
         self,
         session_id: str,
-        user_input: str
+        user_input: str,
+        session: Optional[Dict[str, Any]] = None
     ) -> Dict[str, Any]:
         """
         处理用户行动
         
+        Args:
+            session_id: 会话 ID
+            user_input: 玩家输入
+            session: 调用方已加载的会话快照（见 DatabaseManager.get_session_snapshot），
+                     为空时自行加载
+        
         Returns:
             {
                 "story": "剧情描述",
@@ -202,7 +270,8 @@ class StoryAgentCrew:
             }
         """
         # 1. 加载会话状态
-        session = self.load_session(session_id)
+        if session is None:
+            session = await self.load_session(session_id)
         
         if session["is_completed"]:
             return {"error": "游戏已结束"}
@@ -211,56 +280,275 @@ class StoryAgentCrew:
         current_chapter = session["current_chapter"]
         current_situation = session["current_situation"]
         
-        # 3. 创建任务链
+        async with self._checkout_agents() as agents:
+            # 3. 执行回合（融合模式解析失败时回退到多 Agent 流程）
+            parsed_result = None
+            if self.turn_mode == "fused":
+                parsed_result = await self._run_fused_turn(
+                    agents=agents,
+                    session=session,
+                    user_input=user_input,
+                    current_chapter=current_chapter,
+                    current_situation=current_situation
+                )
+                if parsed_result is None:
+                    print("⚠️ 融合模式输出解析失败，回退到多 Agent 流程")
+            
+            if parsed_result is None:
+                parsed_result = await self._run_multi_agent_turn(
+                    agents=agents,
+                    session=session,
+                    user_input=user_input,
+                    current_chapter=current_chapter,
+                    current_situation=current_situation
+                )
+            
+            # 4. 更新数据库
+            return await self._finalize_turn(agents, session, parsed_result)
+    
+    async def _run_multi_agent_turn(
+        self,
+        agents: TurnAgents,
+        session: Dict,
+        user_input: str,
+        current_chapter: int,
+        current_situation: str
+    ) -> Dict[str, Any]:
+        """多 Agent 任务链：叙事 → 局势判定 / 角色更新（并发）→ 章节协调（仅非确定性章节）"""
         tasks = self._create_task_chain(
+            agents=agents,
             session=session,
             user_input=user_input,
             current_chapter=current_chapter,
             current_situation=current_situation
         )
         
-        # 4. 创建 Crew 并执行
-        crew = Crew(
-            agents=[
-                self.narrator,
-                self.situation_judge,
-                self.character_manager,
-                self.chapter_coordinator
+        await self._run_task_dag(tasks)
+        
+        return self._parse_crew_result(agents, tasks, current_situation)
+    
+    async def _run_fused_turn(
+        self,
+        agents: TurnAgents,
+        session: Dict,
+        user_input: str,
+        current_chapter: int,
+        current_situation: str
+    ) -> Optional[Dict[str, Any]]:
+        """
+        融合模式：一次 LLM 调用同时完成叙事、局势判定、角色更新和章节决策
+        
+        Returns:
+            解析后的回合结果；输出不符合结构时返回 None
+        """
+        prompt = self._build_fused_prompt(
+            agents=agents,
+            session=session,
+            user_input=user_input,
+            current_chapter=current_chapter,
+            current_situation=current_situation
+        )
+        output = await self.llm.ainvoke(prompt)
+        return self._parse_fused_output(output, current_situation)
+    
+    def _build_fused_prompt(
+        self,
+        agents: TurnAgents,
+        session: Dict,
+        user_input: str,
+        current_chapter: int,
+        current_situation: str
+    ) -> str:
+        """构建融合模式提示词（角色与局势状态只发送一次）"""
+        situations = session.get("situations", {})
+        current = situations.get(current_situation, {})
+        narrate_prompt = self._build_narrate_prompt(
+            session=session,
+            user_input=user_input,
+            current_chapter=current_chapter,
+            current_situation=current_situation
+        )
+        
+        return f"""{agents.narrator.backstory}。
+{narrate_prompt}
+当前局势分数：{current.get('score', 0)}，目标分数：{current.get('target_score', 100)}
+总章节数：{len(self.config.chapters)}
+
+输出剧情后，另起一行输出 {FUSED_JSON_MARKER}，随后只输出如下 JSON（不要代码块）：
+{{
+  "situation_update": {{
+    "score_change": 分数变化（-50 到 +50）,
+    "new_score": 新分数,
+    "status": "in_progress|success|failed",
+    "rationale": "判断理由"
+  }},
+  "character_updates": [
+    {{"character_name": "角色名", "status": "{CHARACTER_STATUS_CHOICES}", "attribute_changes": {{"loyalty": 10}}}}
+  ],
+  "chapter_status": "continue|next_chapter|ending"
+}}
+
+章节规则：当前章节所有主要局势都完成（成功或失败）时推进到下一章；
+已是最后一章且主要局势完成时进入结局；否则继续当前章节。
+角色没有变化时 character_updates 返回空数组 []。
+"""
+    
+    def _parse_fused_output(
+        self,
+        output: str,
+        current_situation: str
+    ) -> Optional[Dict[str, Any]]:
+        """拆分剧情与 JSON 块并做结构校验"""
+        if FUSED_JSON_MARKER not in output:
+            return None
+        
+        story, _, json_text = output.partition(FUSED_JSON_MARKER)
+        story = story.strip()
+        if not story:
+            return None
+        
+        try:
+            turn = FusedTurnResult.model_validate(_extract_json(json_text))
+        except ValidationError:
+            return None
+        
+        return {
+            "story": story,
+            "situation_update": {
+                "situation_id": current_situation,
+                **turn.situation_update.model_dump()
+            },
+            "character_updates": [
+                update.model_dump(exclude_none=True)
+                for update in turn.character_updates
             ],
-            tasks=tasks,
-            process=Process.sequential,  # 顺序执行
+            "chapter_status": turn.chapter_status
+        }
+    
+    async def stream_user_action(
+        self,
+        session_id: str,
+        user_input: str,
+        session: Optional[Dict[str, Any]] = None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        流式处理用户行动
+        
+        叙事者直接调用 LLM 流式输出，逐段产出剧情；
+        局势、角色、章节判定在剧情完成后执行，作为尾部事件产出。
+        
+        Yields:
+            {"event": "token", "data": {"text": "..."}}
+            {"event": "situation_update", "data": {...}}
+            {"event": "character_updates", "data": [...]}
+            {"event": "chapter_status", "data": {"chapter_status": "..."}}
+            {"event": "ending", "data": {...}} if applicable
+        """
+        if session is None:
+            session = await self.load_session(session_id)
+        
+        if session["is_completed"]:
+            yield {"event": "error", "data": {"error": "游戏已结束"}}
+            return
+        
+        current_chapter = session["current_chapter"]
+        current_situation = session["current_situation"]
+        
+        async with self._checkout_agents() as agents:
+            # 1. 流式生成剧情
+            narrator = agents.narrator
+            prompt = f"{narrator.backstory}。{narrator.goal}。\n" + self._build_narrate_prompt(
+                session=session,
+                user_input=user_input,
+                current_chapter=current_chapter,
+                current_situation=current_situation
+            )
+            chunks = []
+            async for chunk in self.llm.astream_text(prompt):
+                chunks.append(chunk)
+                yield {"event": "token", "data": {"text": chunk}}
+            story = "".join(chunks)
+            
+            # 2. 基于完整剧情执行判定任务
+            tasks = self._create_task_chain(
+                agents=agents,
+                session=session,
+                user_input=user_input,
+                current_chapter=current_chapter,
+                current_situation=current_situation,
+                narration=story
+            )
+            await self._run_task_dag(tasks)
+            
+            parsed_result = self._parse_crew_result(agents, tasks, current_situation, story=story)
+            parsed_result = await self._finalize_turn(agents, session, parsed_result)
+        
+        # 3. 尾部事件
+        yield {"event": "situation_update", "data": parsed_result["situation_update"]}
+        yield {"event": "character_updates", "data": parsed_result["character_updates"]}
+        yield {"event": "chapter_status", "data": {"chapter_status": parsed_result["chapter_status"]}}
+        if parsed_result.get("ending"):
+            yield {"event": "ending", "data": parsed_result["ending"]}
+    
+    async def _run_task_dag(self, tasks: List[Task]):
+        """
+        按依赖层级执行任务链
+        
+        同层任务（如局势判定与角色更新）各自作为单任务 Crew 在线程中并发执行，
+        下游任务通过 context 读取上游任务的输出。
+        """
+        for group in _task_levels(tasks):
+            await asyncio.gather(*(
+                asyncio.to_thread(self._kickoff_task, task)
+                for task in group
+            ))
+    
+    def _kickoff_task(self, task: Task):
+        crew = Crew(
+            agents=[task.agent],
+            tasks=[task],
+            process=Process.sequential,
             verbose=True
         )
+        crew.kickoff()
+    
+    async def _finalize_turn(
+        self,
+        agents: TurnAgents,
+        session: Dict[str, Any],
+        parsed_result: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """写入本回合结果，必要时生成结局"""
+        # 确定性章节由规则决定推进（不消耗 LLM 调用）
+        current_chapter = session["current_chapter"]
+        if not self.config.uses_llm_transition(current_chapter):
+            parsed_result["chapter_status"] = self.coordinator.decide(
+                current_chapter=current_chapter,
+                situations=session.get("situations", {}),
+                situation_update=parsed_result.get("situation_update")
+            )
         
-        result = crew.kickoff()
-        
-        # 5. 解析结果并更新数据库
-        parsed_result = self._parse_crew_result(result)
-        self._update_database(session_id, parsed_result)
+        updated_session = await self._commit_turn(session, parsed_result)
         
-        # 6. 检查是否需要生成结局
+        # 检查是否需要生成结局
         if parsed_result["chapter_status"] == "ending":
-            ending = self._generate_ending(session_id)
+            ending = await self._generate_ending(agents, updated_session)
             parsed_result["ending"] = ending
         
         return parsed_result
     
-    def _create_task_chain(
+    def _build_narrate_prompt(
         self,
         session: Dict,
         user_input: str,
         current_chapter: int,
         current_situation: str
-    ) -> List[Task]:
-        """创建任务链"""
-        
-        # 获取角色状态
+    ) -> str:
+        """构建叙事提示词"""
         characters = session.get("characters", {})
         situations = session.get("situations", {})
         
-        # 任务1：生成剧情
-        narrate_task = Task(
-            description=f"""
+        return f"""
 根据以下信息生成剧情：
 
 当前章节：第{current_chapter}章
@@ -274,16 +562,52 @@ class StoryAgentCrew:
 {json.dumps(situations, ensure_ascii=False, indent=2)}
 
 请生成生动的剧情描述（300-500字）。
-            """,
-            agent=self.narrator,
-            expected_output="剧情描述文本"
-        )
+            """
+    
+    def _create_task_chain(
+        self,
+        agents: TurnAgents,
+        session: Dict,
+        user_input: str,
+        current_chapter: int,
+        current_situation: str,
+        narration: Optional[str] = None
+    ) -> List[Task]:
+        """
+        创建任务链
+        
+        传入 narration 时剧情已生成（流式模式），不再创建叙事任务，
+        判定任务直接基于该剧情文本。
+        """
+        
+        # 获取角色状态
+        characters = session.get("characters", {})
+        situations = session.get("situations", {})
+        
+        if narration is None:
+            # 任务1：生成剧情
+            narrate_task = Task(
+                description=self._build_narrate_prompt(
+                    session=session,
+                    user_input=user_input,
+                    current_chapter=current_chapter,
+                    current_situation=current_situation
+                ),
+                agent=agents.narrator,
+                expected_output="剧情描述文本"
+            )
+            story_context = ""
+            upstream = [narrate_task]
+        else:
+            narrate_task = None
+            story_context = f"\n本回合剧情：\n{narration}\n"
+            upstream = []
         
         # 任务2：评估局势影响
         judge_task = Task(
             description=f"""
 根据剧情和玩家选择，评估对当前局势的影响：
-
+{story_context}
 当前局势：{current_situation}
 当前分数：{situations.get(current_situation, {}).get('score', 0)}
 目标分数：{situations.get(current_situation, {}).get('target_score', 100)}
@@ -296,16 +620,16 @@ class StoryAgentCrew:
   "rationale": "判断理由"
 }}
             """,
-            agent=self.situation_judge,
+            agent=agents.situation_judge,
             expected_output="JSON 格式的局势评估",
-            context=[narrate_task]
+            context=upstream
         )
         
         # 任务3：更新角色状态
         character_task = Task(
             description=f"""
 根据剧情，判断角色状态是否发生变化：
-
+{story_context}
 当前角色状态：
 {json.dumps(characters, ensure_ascii=False, indent=2)}
 
@@ -313,18 +637,26 @@ class StoryAgentCrew:
 [
   {{
     "character_name": "角色名",
-    "status": "alive|dead|missing",
+    "status": "{CHARACTER_STATUS_CHOICES}",
     "attribute_changes": {{"loyalty": +10}}
   }}
 ]
 
 如果没有变化，返回空数组 []
             """,
-            agent=self.character_manager,
+            agent=agents.character_manager,
             expected_output="JSON 格式的角色更新",
-            context=[narrate_task]
+            context=upstream
         )
         
+        tasks = [judge_task, character_task]
+        if narrate_task is not None:
+            tasks.insert(0, narrate_task)
+        
+        # 确定性章节由 ChapterCoordinator 规则判断，无需协调者任务
+        if not self.config.uses_llm_transition(current_chapter):
+            return tasks
+        
         # 任务4：决定章节推进
         coordinator_task = Task(
             description=f"""
@@ -345,112 +677,86 @@ class StoryAgentCrew:
   "rationale": "理由"
 }}
             """,
-            agent=self.chapter_coordinator,
+            agent=agents.chapter_coordinator,
             expected_output="JSON 格式的章节决策",
             context=[judge_task, character_task]
         )
         
-        return [narrate_task, judge_task, character_task, coordinator_task]
-    
-    def _parse_crew_result(self, result: str) -> Dict[str, Any]:
-        """解析 Crew 执行结果"""
-        # CrewAI 返回的是最后一个任务的输出
-        # 需要从中提取所有信息
-        try:
-            # 简化处理：假设结果包含所有任务输出
-            return {
-                "story": "剧情内容",  # 从 narrate_task 提取
-                "situation_update": {},  # 从 judge_task 提取
-                "character_updates": [],  # 从 character_task 提取
-                "chapter_status": "continue"  # 从 coordinator_task 提取
-            }
-        except Exception as e:
-            return {"error": str(e)}
+        tasks.append(coordinator_task)
+        return tasks
     
-    def load_session(self, session_id: str) -> Dict[str, Any]:
-        """加载会话状态"""
-        # 从数据库加载
-        session_result = self.supabase.table("game_sessions")\
-            .select("*")\
-            .eq("id", session_id)\
-            .single()\
-            .execute()
-        
-        session = session_result.data
+    def _parse_crew_result(
+        self,
+        agents: TurnAgents,
+        tasks: List[Task],
+        current_situation: str,
+        story: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """解析 Crew 执行结果（按任务所属 Agent 读取各任务输出）"""
+        outputs = {id(task.agent): _task_output_text(task) for task in tasks}
         
-        # 加载局势状态
-        situations_result = self.supabase.table("situation_states")\
-            .select("*")\
-            .eq("session_id", session_id)\
-            .execute()
+        if story is None:
+            story = outputs.get(id(agents.narrator), "")
         
-        situations = {s["situation_id"]: s for s in situations_result.data}
+        judgment = _extract_json(outputs.get(id(agents.situation_judge), ""))
+        situation_update = {}
+        if isinstance(judgment, dict):
+            situation_update = {"situation_id": current_situation, **judgment}
         
-        # 加载角色状态
-        characters_result = self.supabase.table("character_states")\
-            .select("*")\
-            .eq("session_id", session_id)\
-            .execute()
+        character_updates = _extract_json(outputs.get(id(agents.character_manager), ""))
+        if not isinstance(character_updates, list):
+            character_updates = []
         
-        characters = {c["character_name"]: c for c in characters_result.data}
+        decision = _extract_json(outputs.get(id(agents.chapter_coordinator), ""))
+        chapter_status = "continue"
+        if isinstance(decision, dict) and decision.get("action") in CHAPTER_ACTIONS:
+            chapter_status = decision["action"]
         
         return {
-            **session,
-            "situations": situations,
-            "characters": characters
+            "story": story,
+            "situation_update": situation_update,
+            "character_updates": character_updates,
+            "chapter_status": chapter_status
         }
     
-    def _update_database(
+    async def load_session(self, session_id: str) -> Dict[str, Any]:
+        """加载会话状态（单次请求获取会话、局势、角色）"""
+        session = await self.db.get_session_snapshot(session_id)
+        if not session:
+            raise ValueError("会话不存在")
+        return session
+    
+    async def _commit_turn(
         self,
-        session_id: str,
+        session: Dict[str, Any],
         result: Dict[str, Any]
-    ):
-        """更新数据库"""
-        # 更新局势
-        if result.get("situation_update"):
-            self.supabase.table("situation_states")\
-                .update(result["situation_update"])\
-                .eq("session_id", session_id)\
-                .execute()
-        
-        # 更新角色
-        for char_update in result.get("character_updates", []):
-            self.supabase.table("character_states")\
-                .update(char_update)\
-                .eq("session_id", session_id)\
-                .eq("character_name", char_update["character_name"])\
-                .execute()
-        
-        # 更新会话
-        if result["chapter_status"] == "next_chapter":
-            self.supabase.table("game_sessions")\
-                .update({"current_chapter": session["current_chapter"] + 1})\
-                .eq("id", session_id)\
-                .execute()
-        elif result["chapter_status"] == "ending":
-            self.supabase.table("game_sessions")\
-                .update({"is_completed": True})\
-                .eq("id", session_id)\
-                .execute()
+    ) -> Dict[str, Any]:
+        """
+        写入本回合的局势、角色、会话变化
+        
+        Returns:
+            合并本回合变化后的会话快照
+        """
+        delta = build_turn_delta(session, result)
+        
+        if self.state_store is not None:
+            return await self.state_store.apply_turn(session["id"], session, delta)
+        
+        await self.db.apply_turn_delta(session["id"], delta)
+        return apply_delta_to_snapshot(session, delta)
     
-    def _generate_ending(self, session_id: str) -> Dict[str, Any]:
+    async def _generate_ending(self, agents: TurnAgents, session: Dict[str, Any]) -> Dict[str, Any]:
         """生成结局"""
-        # 加载完成的局势
-        situations = self.supabase.table("situation_states")\
-            .select("*")\
-            .eq("session_id", session_id)\
-            .execute()
-        
-        # 统计成功/失败的局势
+        # 统计成功/失败的局势（使用本回合更新后的快照）
         completed_situations = {
             "success": [],
             "failed": []
         }
         
-        for sit in situations.data:
-            if sit["status"] == "success":
+        for sit in session.get("situations", {}).values():
+            if sit.get("status") in ("success", "completed"):
                 completed_situations["success"].append(sit["situation_id"])
-            elif sit["status"] == "failed":
+            elif sit.get("status") == "failed":
                 completed_situations["failed"].append(sit["situation_id"])
         
         # 创建结局生成任务
@@ -466,28 +772,34 @@ class StoryAgentCrew:
 2. 结局描述（500-800字）
 3. 评价总结
 
-返回 JSON 格式。
+返回 JSON 格式：
+{{
+  "ending_type": "good_ending|normal_ending|bad_ending",
+  "description": "结局描述",
+  "summary": "评价总结"
+}}
             """,
-            agent=self.ending_generator,
+            agent=agents.ending_generator,
             expected_output="JSON 格式的结局"
         )
         
-        crew = Crew(
-            agents=[self.ending_generator],
-            tasks=[ending_task],
-            verbose=True
-        )
+        await asyncio.to_thread(self._kickoff_task, ending_task)
         
-        result = crew.kickoff()
+        content = _task_output_text(ending_task)
+        ending = _extract_json(content)
+        if not isinstance(ending, dict):
+            ending = {"description": content}
+        ending.setdefault("ending_type", "normal_ending")
         
         # 保存结局
-        self.supabase.table("endings").insert({
-            "session_id": session_id,
-            "ending_content": result,
-            "situations_completed": completed_situations
-        }).execute()
+        await self.db.save_ending(
+            session_id=session["id"],
+            ending_type=ending["ending_type"],
+            ending_content=content,
+            situations_completed=completed_situations
+        )
         
-        return result
+        return ending
 
 
 # ============ 使用示例 ============
@@ -3,18 +3,52 @@
 处理所有数据库操作
 """
 
-from supabase import create_client, Client
-from typing import Dict, Any, List, Optional
+import asyncio
+import base64
+import json
+from typing import Dict, Any, List, Optional, TYPE_CHECKING
 import uuid
 from datetime import datetime
+from story_registry import get_story_registry
+from supabase_pool import get_async_supabase_client
+
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
+# 历史消息返回的列
+MESSAGE_COLUMNS = "id, chapter, role, content, created_at"
+
+
+def encode_message_cursor(message: Dict[str, Any]) -> str:
+    """消息分页游标：(created_at, id) 的 URL 安全编码"""
+    raw = json.dumps([message["created_at"], message["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_message_cursor(cursor: str) -> tuple:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        created_at, message_id = json.loads(base64.urlsafe_b64decode(padded))
+        # 校验格式，游标值会拼入查询过滤条件
+        datetime.fromisoformat(created_at.replace("Z", "+00:00"))
+        message_id = str(uuid.UUID(message_id))
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError("无效的分页游标") from e
+    return created_at, message_id
+
 
 class DatabaseManager:
-    """数据库管理器"""
+    """数据库管理器（异步，所有方法均需 await）"""
     
     def __init__(self, supabase_url: str, supabase_key: str):
-        self.client: Client = create_client(supabase_url, supabase_key)
+        self.supabase_url = supabase_url
+        self.supabase_key = supabase_key
     
-    def create_session(
+    async def _get_client(self) -> "AsyncClient":
+        """获取进程内共享的异步 Supabase 客户端"""
+        return await get_async_supabase_client(self.supabase_url, self.supabase_key)
+    
+    async def create_session(
         self,
         user_id: str,
         story_id: str
@@ -32,19 +66,21 @@ class DatabaseManager:
             "is_completed": False
         }
         
-        result = self.client.table("game_sessions").insert(session_data).execute()
-        
-        # 初始化局势状态
-        self._initialize_situations(session_id, story_id)
+        client = await self._get_client()
+        result = await client.table("game_sessions").insert(session_data).execute()
         
-        # 初始化角色状态
-        self._initialize_characters(session_id, story_id)
+        # 初始化局势状态和角色状态（互不依赖，并发写入）
+        await asyncio.gather(
+            self._initialize_situations(session_id, story_id),
+            self._initialize_characters(session_id, story_id)
+        )
         
         return result.data[0]
     
-    def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+    async def get_session(self, session_id: str) -> Optional[Dict[str, Any]]:
         """获取会话信息"""
-        result = self.client.table("game_sessions")\
+        client = await self._get_client()
+        result = await client.table("game_sessions")\
             .select("*")\
             .eq("id", session_id)\
             .single()\
@@ -52,106 +88,227 @@ class DatabaseManager:
         
         return result.data if result.data else None
     
-    def update_session(
+    async def get_session_snapshot(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        一次请求加载会话快照（会话 + 局势状态 + 角色状态）
+        
+        通过 PostgREST 嵌入资源查询，代替三次独立查询
+        
+        Returns:
+            {**session, "situations": {situation_id: state}, "characters": {character_name: state}}
+        """
+        client = await self._get_client()
+        result = await client.table("game_sessions")\
+            .select("*, situation_states(*), character_states(*)")\
+            .eq("id", session_id)\
+            .maybe_single()\
+            .execute()
+        
+        if not result or not result.data:
+            return None
+        
+        session = dict(result.data)
+        situations = session.pop("situation_states", None) or []
+        characters = session.pop("character_states", None) or []
+        
+        return {
+            **session,
+            "situations": {s["situation_id"]: s for s in situations},
+            "characters": {c["character_name"]: c for c in characters}
+        }
+    
+    async def update_session(
         self,
         session_id: str,
         updates: Dict[str, Any]
     ):
         """更新会话"""
-        self.client.table("game_sessions")\
+        client = await self._get_client()
+        await client.table("game_sessions")\
             .update(updates)\
             .eq("id", session_id)\
             .execute()
     
-    def save_message(
+    async def save_message(
         self,
         session_id: str,
         role: str,
-        content: str
+        content: str,
+        chapter: Optional[int] = None
     ):
-        """保存消息"""
-        # 获取当前章节
-        session = self.get_session(session_id)
-        chapter = session["current_chapter"] if session else 1
+        """保存消息（已知章节时无需查询会话）"""
+        if chapter is None:
+            # 获取当前章节
+            session = await self.get_session(session_id)
+            chapter = session["current_chapter"] if session else 1
         
-        self.client.table("chat_messages").insert({
+        await self.save_messages([{
             "session_id": session_id,
             "chapter": chapter,
             "role": role,
             "content": content
-        }).execute()
+        }])
     
-    def get_messages(
+    async def save_messages(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        批量保存消息（一次插入），返回插入的行
+        
+        消息自带 id 时按 id 忽略已存在的行，重试写入不会产生重复消息
+        """
+        if not messages:
+            return []
+        client = await self._get_client()
+        table = client.table("chat_messages")
+        if all("id" in message for message in messages):
+            query = table.upsert(messages, on_conflict="id", ignore_duplicates=True)
+        else:
+            query = table.insert(messages)
+        result = await query.execute()
+        return result.data
+    
+    async def get_messages(
         self,
         session_id: str,
         limit: int = 20
     ) -> List[Dict[str, Any]]:
         """获取消息历史"""
-        result = self.client.table("chat_messages")\
-            .select("*")\
-            .eq("session_id", session_id)\
+        page = await self.get_messages_page(session_id, limit)
+        return page["messages"]
+    
+    async def get_messages_page(
+        self,
+        session_id: str,
+        limit: int = 20,
+        cursor: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        按游标分页获取消息历史（keyset 分页，基于 created_at + id）
+        
+        Args:
+            session_id: 会话 ID
+            limit: 每页数量
+            cursor: 上一页返回的 next_cursor，为空时返回最新一页
+        
+        Returns:
+            {"messages": [...]（最早的在前）, "next_cursor": 更早一页的游标或 None}
+        """
+        client = await self._get_client()
+        query = client.table("chat_messages")\
+            .select(MESSAGE_COLUMNS)\
+            .eq("session_id", session_id)
+        
+        if cursor:
+            created_at, message_id = decode_message_cursor(cursor)
+            query = query.or_(
+                f'created_at.lt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.lt.{message_id})'
+            )
+        
+        result = await query\
             .order("created_at", desc=True)\
+            .order("id", desc=True)\
             .limit(limit)\
             .execute()
         
+        rows = result.data
+        next_cursor = encode_message_cursor(rows[-1]) if len(rows) == limit else None
+        
         # 反转顺序（最早的在前）
-        return list(reversed(result.data))
+        return {"messages": list(reversed(rows)), "next_cursor": next_cursor}
     
-    def update_situation(
+    async def get_last_message_id(self, session_id: str) -> Optional[str]:
+        """获取会话最新一条消息的 ID"""
+        client = await self._get_client()
+        result = await client.table("chat_messages")\
+            .select("id")\
+            .eq("session_id", session_id)\
+            .order("created_at", desc=True)\
+            .order("id", desc=True)\
+            .limit(1)\
+            .execute()
+        
+        return result.data[0]["id"] if result.data else None
+    
+    async def update_situation(
         self,
         session_id: str,
         situation_id: str,
         updates: Dict[str, Any]
     ):
         """更新局势状态"""
-        self.client.table("situation_states")\
+        client = await self._get_client()
+        await client.table("situation_states")\
             .update(updates)\
             .eq("session_id", session_id)\
             .eq("situation_id", situation_id)\
             .execute()
     
-    def get_situations(
+    async def apply_turn_delta(
+        self,
+        session_id: str,
+        delta: Dict[str, Any]
+    ):
+        """
+        写入一个回合的状态增量（单次 RPC，同一事务内完成）
+        
+        局势、角色、会话的变化由 apply_turn_delta 函数原子写入，
+        不会出现只写了一半的回合
+        
+        Args:
+            session_id: 会话 ID
+            delta: 见 turn_state.build_turn_delta
+        """
+        client = await self._get_client()
+        await client.rpc("apply_turn_delta", {
+            "p_session_id": session_id,
+            "p_delta": delta
+        }).execute()
+    
+    async def get_situations(
         self,
         session_id: str,
         chapter: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """获取局势状态"""
-        query = self.client.table("situation_states")\
+        client = await self._get_client()
+        query = client.table("situation_states")\
             .select("*")\
             .eq("session_id", session_id)
         
         if chapter is not None:
             query = query.eq("chapter", chapter)
         
-        result = query.execute()
+        result = await query.execute()
         return result.data
     
-    def update_character(
+    async def update_character(
         self,
         session_id: str,
         character_name: str,
         updates: Dict[str, Any]
     ):
         """更新角色状态"""
-        self.client.table("character_states")\
+        client = await self._get_client()
+        await client.table("character_states")\
             .update(updates)\
             .eq("session_id", session_id)\
             .eq("character_name", character_name)\
             .execute()
     
-    def get_characters(
+    async def get_characters(
         self,
         session_id: str
     ) -> List[Dict[str, Any]]:
         """获取所有角色状态"""
-        result = self.client.table("character_states")\
+        client = await self._get_client()
+        result = await client.table("character_states")\
             .select("*")\
             .eq("session_id", session_id)\
             .execute()
         
         return result.data
     
-    def save_ending(
+    async def save_ending(
         self,
         session_id: str,
         ending_type: str,
@@ -159,7 +316,8 @@ class DatabaseManager:
         situations_completed: Dict[str, List[str]]
     ):
         """保存结局"""
-        self.client.table("endings").insert({
+        client = await self._get_client()
+        await client.table("endings").insert({
             "session_id": session_id,
             "ending_type": ending_type,
             "ending_content": ending_content,
@@ -167,86 +325,45 @@ class DatabaseManager:
         }).execute()
         
         # 标记会话为已完成
-        self.update_session(session_id, {
+        await self.update_session(session_id, {
             "is_completed": True,
             "ending_type": ending_type
         })
     
-    def health_check(self):
+    async def health_check(self):
         """健康检查"""
         # 简单查询测试连接
-        self.client.table("game_sessions").select("id").limit(1).execute()
+        client = await self._get_client()
+        await client.table("game_sessions").select("id").limit(1).execute()
     
     # ============ 私有方法 ============
     
     def _get_initial_situation(self, story_id: str) -> str:
         """获取初始局势"""
         # 根据剧本返回第一个局势
-        initial_situations = {
-            "chongzhen": "eunuch_party",
-            # 其他剧本...
-        }
-        return initial_situations.get(story_id, "initial")
+        story = get_story_registry().get(story_id)
+        return story.initial_situation if story else "initial"
     
-    def _initialize_situations(self, session_id: str, story_id: str):
+    async def _initialize_situations(self, session_id: str, story_id: str):
         """初始化局势状态"""
-        # 根据剧本配置初始化局势
-        if story_id == "chongzhen":
-            situations = [
-                {
-                    "session_id": session_id,
-                    "chapter": 1,
-                    "situation_id": "eunuch_party",
-                    "situation_type": "main",
-                    "score": 0,
-                    "target_score": 100,
-                    "status": "in_progress"
-                },
-                {
-                    "session_id": session_id,
-                    "chapter": 1,
-                    "situation_id": "border_defense",
-                    "situation_type": "optional",
-                    "score": 0,
-                    "target_score": 80,
-                    "status": "in_progress"
-                }
-            ]
-            
-            self.client.table("situation_states").insert(situations).execute()
-    
-    def _initialize_characters(self, session_id: str, story_id: str):
+        # 根据剧本配置初始化第一章局势
+        story = get_story_registry().get(story_id)
+        if not story:
+            return
+        
+        situations = story.situation_rows(session_id, story.first_chapter)
+        if situations:
+            client = await self._get_client()
+            await client.table("situation_states").insert(situations).execute()
+    
+    async def _initialize_characters(self, session_id: str, story_id: str):
         """初始化角色状态"""
         # 根据剧本配置初始化角色
-        if story_id == "chongzhen":
-            characters = [
-                {
-                    "session_id": session_id,
-                    "character_name": "崇祯皇帝",
-                    "status": "alive",
-                    "attributes": {
-                        "authority": 70,
-                        "wisdom": 60
-                    }
-                },
-                {
-                    "session_id": session_id,
-                    "character_name": "袁崇焕",
-                    "status": "alive",
-                    "attributes": {
-                        "loyalty": 95,
-                        "military_ability": 90
-                    }
-                },
-                {
-                    "session_id": session_id,
-                    "character_name": "李自成",
-                    "status": "alive",
-                    "attributes": {
-                        "power": 30,
-                        "army_size": 10000
-                    }
-                }
-            ]
-            
-            self.client.table("character_states").insert(characters).execute()
+        story = get_story_registry().get(story_id)
+        if not story:
+            return
+        
+        characters = story.character_rows(session_id)
+        if characters:
+            client = await self._get_client()
+            await client.table("character_states").insert(characters).execute()
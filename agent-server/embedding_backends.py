@@ -0,0 +1,212 @@
+"""
+嵌入模型后端
+- sentence_transformers：PyTorch 全精度模型（默认）
+- onnx：ONNX Runtime 推理，可选 int8 动态量化，内存占用和 CPU 延迟更低
+
+ONNX 模型需先导出（需要 torch、transformers、onnxruntime）：
+    python embedding_backends.py export --output ./models/minilm-onnx
+"""
+
+import os
+import json
+import argparse
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "sentence_transformers")  # sentence_transformers | onnx
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "./models/minilm-onnx")
+EMBEDDING_ONNX_QUANTIZED = os.getenv("EMBEDDING_ONNX_QUANTIZED", "true").lower() == "true"
+EMBEDDING_MAX_SEQ_LENGTH = int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", "128"))
+
+ONNX_MODEL_FILE = "model.onnx"
+ONNX_QUANTIZED_FILE = "model.int8.onnx"
+ONNX_METADATA_FILE = "embedding_export.json"  # 导出时记录的模型名与维度，加载时校验
+
+
+def _hub_name(model_name: str) -> str:
+    # sentence-transformers 允许省略组织名
+    return model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+
+
+class EmbeddingBackend(ABC):
+    """嵌入后端接口"""
+
+    name = "base"
+
+    @abstractmethod
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """批量编码"""
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """PyTorch 后端（sentence-transformers）"""
+
+    name = "sentence_transformers"
+
+    def __init__(self, model_name: str, torch_threads: int = 1):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(torch_threads)
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        return self.model.encode(texts, batch_size=len(texts)).tolist()
+
+
+class OnnxEmbeddingBackend(EmbeddingBackend):
+    """
+    ONNX Runtime 后端
+
+    与 sentence-transformers 的 MiniLM 保持一致：
+    transformer 输出按 attention mask 做均值池化；
+    加载时校验导出目录记录的模型名与维度，避免用错模型写入不兼容的向量
+    """
+
+    name = "onnx"
+
+    def __init__(
+        self,
+        model_name: str,
+        dim: Optional[int] = None,
+        model_dir: str = EMBEDDING_ONNX_DIR,
+        quantized: bool = EMBEDDING_ONNX_QUANTIZED,
+        threads: int = 1,
+        max_seq_length: int = EMBEDDING_MAX_SEQ_LENGTH,
+    ):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("ONNX 嵌入后端需要安装 onnxruntime 和 transformers") from e
+
+        model_path = os.path.join(model_dir, ONNX_QUANTIZED_FILE if quantized else ONNX_MODEL_FILE)
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"未找到 ONNX 模型 {model_path}，请先运行 python embedding_backends.py export"
+            )
+        self.dim = _check_export_metadata(model_dir, model_name, dim)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            model_path,
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = max_seq_length
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        tokens = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np",
+        )
+        inputs = {name: tokens[name].astype(np.int64) for name in self.input_names if name in tokens}
+        hidden = self.session.run(None, inputs)[0]
+
+        mask = tokens["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled.tolist()
+
+
+def create_embedding_backend(
+    model_name: str,
+    backend: str = EMBEDDING_BACKEND,
+    threads: int = 1,
+    dim: Optional[int] = None,
+) -> EmbeddingBackend:
+    """按名称创建嵌入后端（dim 不为空时 ONNX 后端加载时校验维度）"""
+    if backend == "sentence_transformers":
+        return SentenceTransformerBackend(model_name, torch_threads=threads)
+    if backend == "onnx":
+        return OnnxEmbeddingBackend(model_name, dim=dim, threads=threads)
+    raise ValueError(f"未知的嵌入后端: {backend}")
+
+
+def _check_export_metadata(model_dir: str, model_name: str, dim: Optional[int]) -> int:
+    """校验导出目录的模型名与维度，返回模型输出维度"""
+    metadata_path = os.path.join(model_dir, ONNX_METADATA_FILE)
+    if not os.path.exists(metadata_path):
+        raise FileNotFoundError(
+            f"未找到 {metadata_path}，无法确认 ONNX 模型与 EMBEDDING_MODEL 一致，"
+            f"请重新运行 python embedding_backends.py export"
+        )
+    with open(metadata_path, encoding="utf-8") as f:
+        metadata = json.load(f)
+
+    if metadata.get("model_name") != _hub_name(model_name):
+        raise ValueError(
+            f"ONNX 模型导出自 {metadata.get('model_name')}，与 EMBEDDING_MODEL={model_name} 不一致，"
+            f"请重新导出"
+        )
+    if dim is not None and metadata.get("dim") != dim:
+        raise ValueError(
+            f"ONNX 模型维度 {metadata.get('dim')} 与 EMBEDDING_DIM={dim} 不一致，请同步修改数据库向量列维度"
+        )
+    return metadata.get("dim")
+
+
+# ============ 模型导出 ============
+
+def export_onnx_model(model_name: str, output_dir: str, quantize: bool = True):
+    """
+    导出 transformer 为 ONNX（可选 int8 动态量化），并保存分词器与模型名、维度
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(output_dir, exist_ok=True)
+    hub_name = _hub_name(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(hub_name)
+    model = AutoModel.from_pretrained(hub_name).eval()
+
+    sample = tokenizer(["导出样例", "export sample"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    model_path = os.path.join(output_dir, ONNX_MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in input_names),
+            model_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, ONNX_METADATA_FILE), "w", encoding="utf-8") as f:
+        json.dump({"model_name": hub_name, "dim": model.config.hidden_size}, f, ensure_ascii=False, indent=2)
+    print(f"✅ 已导出 {model_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = os.path.join(output_dir, ONNX_QUANTIZED_FILE)
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+        print(f"✅ 已量化 {quantized_path}")
+
+
+if __name__ == "__main__":
+    from embedding_executor import EMBEDDING_MODEL
+
+    parser = argparse.ArgumentParser(description="嵌入模型工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="导出 ONNX 模型")
+    export.add_argument("--model", default=EMBEDDING_MODEL)
+    export.add_argument("--output", default=EMBEDDING_ONNX_DIR)
+    export.add_argument("--no-quantize", action="store_true", help="只导出全精度模型")
+    args = parser.parse_args()
+
+    export_onnx_model(args.model, args.output, quantize=not args.no_quantize)
@@ -0,0 +1,152 @@
+"""
+嵌入推理执行器
+将嵌入模型推理移出事件循环（模型后端见 embedding_backends）：
+- process：进程池，每个工作进程启动时预加载模型，推理可利用多核
+- thread：线程池，限制 torch 线程数，避免与请求处理争抢 CPU
+"""
+
+import os
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+
+from embedding_backends import EMBEDDING_BACKEND, EmbeddingBackend, create_embedding_backend
+
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "paraphrase-multilingual-MiniLM-L12-v2")
+# 必须与数据库向量列维度一致（见 supabase/migrations/*_embedding_dim_and_vector_indexes.sql）
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "384"))
+EMBEDDING_EXECUTOR = os.getenv("EMBEDDING_EXECUTOR", "thread")  # thread | process
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "2"))
+EMBEDDING_TORCH_THREADS = int(os.getenv("EMBEDDING_TORCH_THREADS", "1"))
+
+
+# ============ 工作进程 ============
+
+_worker_backend: Optional[EmbeddingBackend] = None
+
+
+def _init_worker(model_name: str, backend: str, threads: int, dim: int):
+    """工作进程初始化：预加载模型（限制推理线程数）"""
+    global _worker_backend
+    _worker_backend = create_embedding_backend(model_name, backend, threads, dim=dim)
+
+
+def _encode_in_worker(texts: List[str]) -> List[List[float]]:
+    return _worker_backend.encode(texts)
+
+
+# ============ 执行器 ============
+
+class EmbeddingExecutor:
+    """嵌入推理执行器（异步接口）"""
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL,
+        dim: int = EMBEDDING_DIM,
+        backend: str = EMBEDDING_BACKEND,
+        mode: str = EMBEDDING_EXECUTOR,
+        workers: int = EMBEDDING_WORKERS,
+        torch_threads: int = EMBEDDING_TORCH_THREADS,
+    ):
+        if mode not in ("thread", "process"):
+            raise ValueError(f"未知的嵌入执行器类型: {mode}")
+
+        self.model_name = model_name
+        self.dim = dim
+        self.backend_name = backend
+        self.mode = mode
+        self.workers = workers
+        self.torch_threads = torch_threads
+        self._executor: Optional[Executor] = None
+        self._backend: Optional[EmbeddingBackend] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.mode == "process":
+                    # spawn：避免 fork 继承 torch 线程池导致死锁
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=_init_worker,
+                        initargs=(self.model_name, self.backend_name, self.torch_threads, self.dim),
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers,
+                        thread_name_prefix="embedding",
+                    )
+            return self._executor
+
+    def _get_backend(self) -> EmbeddingBackend:
+        """线程模式下进程内共享的模型"""
+        with self._lock:
+            if self._backend is None:
+                self._backend = create_embedding_backend(
+                    self.model_name,
+                    self.backend_name,
+                    self.torch_threads,
+                    dim=self.dim
+                )
+            return self._backend
+
+    def _encode_local(self, texts: List[str]) -> List[List[float]]:
+        return self._get_backend().encode(texts)
+
+    def _submit(self, texts: List[str]):
+        if self.mode == "process":
+            return self._get_executor().submit(_encode_in_worker, texts)
+        return self._get_executor().submit(self._encode_local, texts)
+
+    def _check_dim(self, embeddings: List[List[float]]) -> List[List[float]]:
+        if embeddings and len(embeddings[0]) != self.dim:
+            raise ValueError(
+                f"嵌入维度 {len(embeddings[0])} 与 EMBEDDING_DIM={self.dim} 不一致"
+                f"（模型 {self.model_name}，后端 {self.backend_name}），请同步修改数据库向量列维度"
+            )
+        return embeddings
+
+    async def encode(self, texts: List[str]) -> List[List[float]]:
+        """批量编码（在执行器中运行，不阻塞事件循环）"""
+        return self._check_dim(await asyncio.wrap_future(self._submit(texts)))
+
+    def encode_sync(self, texts: List[str]) -> List[List[float]]:
+        """批量编码（同步等待结果）"""
+        return self._check_dim(self._submit(texts).result())
+
+    def warm_up(self):
+        """预加载模型（进程模式下每个工作进程各执行一次初始化）"""
+        for future in [self._submit(["warm up"]) for _ in range(max(1, self.workers))]:
+            self._check_dim(future.result())
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+
+_executor: Optional[EmbeddingExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_embedding_executor() -> EmbeddingExecutor:
+    """进程内共享的嵌入执行器"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = EmbeddingExecutor()
+        return _executor
+
+
+def shutdown_embedding_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
@@ -0,0 +1,199 @@
+"""
+批量嵌入服务
+并发请求的文本排队合并为一批向量化编码，相同内容通过哈希缓存去重
+"""
+
+import os
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+
+EMBEDDING_BATCH_MAX = int(os.getenv("EMBEDDING_BATCH_MAX", "32"))
+EMBEDDING_BATCH_WAIT_MS = int(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """内容哈希 → 嵌入向量的 LRU 缓存（线程安全）"""
+
+    def __init__(self, max_size: int = EMBEDDING_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return embedding
+
+    def put(self, key: str, embedding: List[float]):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class EmbeddingService:
+    """
+    批量嵌入服务
+
+    embed() 将文本放入队列，等待 max_wait_ms 收集同一时间段内的其他请求，
+    再以一次 encode_batch 调用完成编码；缓存命中或同一内容正在编码时不重复计算
+    """
+
+    def __init__(
+        self,
+        encode_batch: Callable[[List[str]], List[List[float]]],
+        aencode_batch: Optional[Callable[[List[str]], Awaitable[List[List[float]]]]] = None,
+        max_batch: int = EMBEDDING_BATCH_MAX,
+        max_wait_ms: int = EMBEDDING_BATCH_WAIT_MS,
+        cache_size: int = EMBEDDING_CACHE_SIZE,
+    ):
+        self.encode_batch = encode_batch
+        # 异步编码（如执行器），未提供时在事件循环中直接调用 encode_batch
+        self.aencode_batch = aencode_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.cache = EmbeddingCache(cache_size)
+
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._queue: List[str] = []
+        self._texts: Dict[str, str] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: Set[asyncio.Task] = set()
+
+        self.batches = 0
+        self.encoded = 0
+
+    # ============ 异步接口 ============
+
+    async def embed(self, text: str) -> List[float]:
+        """生成单条文本嵌入"""
+        return (await self.embed_many([text]))[0]
+
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """生成多条文本嵌入（重复文本只编码一次）"""
+        keys = [content_hash(text) for text in texts]
+        futures = {}
+        for key, text in zip(keys, texts):
+            if key not in futures:
+                futures[key] = self._submit(key, text)
+        # 同一内容的调用方共享 future：shield 避免某个调用方被取消时连带取消其他调用方
+        results = {key: await asyncio.shield(future) for key, future in futures.items()}
+        return [results[key] for key in keys]
+
+    def _submit(self, key: str, text: str) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            future = loop.create_future()
+            future.set_result(cached)
+            return future
+
+        # 同一内容已在队列或编码中（已取消的 future 换成新的，仍由同一批次完成）
+        pending = self._pending.get(key)
+        if pending is not None:
+            if not pending.cancelled():
+                return pending
+            future = loop.create_future()
+            self._pending[key] = future
+            return future
+
+        future = loop.create_future()
+        self._pending[key] = future
+        self._queue.append(key)
+        self._texts[key] = text
+
+        if len(self._queue) >= self.max_batch:
+            self._schedule_flush(loop, 0)
+        elif self._flush_handle is None:
+            self._schedule_flush(loop, self.max_wait)
+        return future
+
+    def _schedule_flush(self, loop: asyncio.AbstractEventLoop, delay: float):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        # 持有任务引用，避免执行中被回收
+        task = asyncio.ensure_future(self._flush())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self):
+        self._flush_handle = None
+        keys, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+        if self._queue:
+            self._schedule_flush(asyncio.get_running_loop(), 0)
+        # 已取消（无人等待）的内容不再编码
+        for key in [key for key in keys if self._pending[key].cancelled()]:
+            self._pending.pop(key)
+            self._texts.pop(key)
+        keys = [key for key in keys if key in self._pending]
+        if not keys:
+            return
+
+        texts = [self._texts.pop(key) for key in keys]
+        try:
+            embeddings = await self._encode(texts)
+        except Exception as e:
+            for key in keys:
+                future = self._pending.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for key, embedding in zip(keys, embeddings):
+            self.cache.put(key, embedding)
+            future = self._pending.pop(key)
+            if not future.done():
+                future.set_result(embedding)
+
+    async def _encode(self, texts: List[str]) -> List[List[float]]:
+        self.batches += 1
+        self.encoded += len(texts)
+        if self.aencode_batch is not None:
+            return await self.aencode_batch(texts)
+        return self.encode_batch(texts)
+
+    # ============ 同步接口 ============
+
+    def embed_sync(self, text: str) -> List[float]:
+        """同步生成嵌入（共用缓存，不参与批处理）"""
+        key = content_hash(text)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        embedding = self.encode_batch([text])[0]
+        self.encoded += 1
+        self.cache.put(key, embedding)
+        return embedding
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "batches": self.batches,
+            "encoded": self.encoded,
+            "cache_size": len(self.cache),
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+        }
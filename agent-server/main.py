@@ -3,17 +3,37 @@ CrewAI Agent 服务器 - FastAPI 实现
 支持章节/局势推进、角色管理、多结局、断点续玩
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict, Any, List
+# 启动计时最先导入，后续导入均计入报告
+from startup_profile import startup_profile
+
 import os
-from dotenv import load_dotenv
-import redis.asyncio as redis
+import re
+import sys
+import json
+import asyncio
+import traceback
+from typing import Optional, Dict, Any, List, TYPE_CHECKING
+
+with startup_profile.phase("import:fastapi"):
+    from fastapi import FastAPI, HTTPException, Request, Response
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
+    from pydantic import BaseModel
+    from dotenv import load_dotenv
 
-# 导入 CrewAI Agent
-from crewai_story_agent import StoryAgentCrew
-from database import DatabaseManager
+# crewai / langchain / supabase / redis 在首次使用时导入（见 startup 与 _create_agent_crew）
+with startup_profile.phase("import:app_modules"):
+    from database import DatabaseManager
+    from story_registry import get_story_registry
+    from crew_cache import CrewCache
+    from supabase_pool import close_supabase_clients
+    from session_cache import SessionStateCache
+    from message_writer import MessageWriter
+    from turn_guard import TurnGuard, TurnBusyError
+    from turn_queue import TurnQueue, TurnQueueFull, TurnWorkerPool, TURN_WORKERS, format_prometheus
+
+if TYPE_CHECKING:
+    from crewai_story_agent import StoryAgentCrew
 
 # 加载环境变量
 load_dotenv()
@@ -36,18 +56,65 @@ app.add_middleware(
 # Redis 配置
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 
+# 历史消息每页上限
+HISTORY_MAX_LIMIT = 100
+
+# 启动时预热的剧本（逗号分隔）
+CREW_WARMUP_STORIES = [s.strip() for s in os.getenv("CREW_WARMUP_STORIES", "").split(",") if s.strip()]
+# 预热方式：background（启动后后台预热，完成前 /ready 返回 503）| blocking（启动时同步预热）| off
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "background")
+# 预热时是否加载角色知识库的嵌入模型
+WARMUP_EMBEDDING_MODEL = os.getenv("WARMUP_EMBEDDING_MODEL", "false").lower() == "true"
+
+# 同步回合的执行位置：local（本进程执行）| queue（提交到回合队列，由 worker 层执行并等待结果）
+TURN_EXECUTION = os.getenv("TURN_EXECUTION", "local")
+# queue 模式下等待 worker 返回结果的最长秒数
+TURN_EXECUTION_TIMEOUT = float(os.getenv("TURN_EXECUTION_TIMEOUT", "300"))
+
 # 全局变量
 redis_client = None
 db_manager = None
-agent_crews = {}  # 缓存不同剧本的 Agent Crew
+session_cache = None
+message_writer = None
+turn_guard = None
+turn_queue = None
+turn_workers = None
+turn_worker_concurrency = TURN_WORKERS  # 独立 worker 进程（worker.py）启动前覆盖
+warmup_task = None
+ready = False
+
+
+def _create_agent_crew(story_id: str) -> "StoryAgentCrew":
+    # crewai 仅在首次创建 Agent Crew 时导入
+    with startup_profile.phase("import:crewai_story_agent"):
+        from crewai_story_agent import StoryAgentCrew
+    
+    with startup_profile.phase(f"init:agent_crew:{story_id}"):
+        return StoryAgentCrew(
+            supabase_url=os.getenv("SUPABASE_URL"),
+            supabase_key=os.getenv("SUPABASE_SERVICE_ROLE_KEY"),
+            story_id=story_id,
+            state_store=session_cache
+        )
+
+agent_crews = CrewCache(_create_agent_crew)  # 缓存不同剧本的 Agent Crew（LRU + 空闲淘汰）
 
 @app.on_event("startup")
 async def startup():
     """启动时初始化"""
-    global redis_client, db_manager
+    global redis_client, db_manager, session_cache, message_writer, turn_guard, turn_queue, turn_workers
+    global warmup_task, ready
+    
+    # 加载剧本注册表
+    with startup_profile.phase("init:story_registry"):
+        registry = get_story_registry()
+    print(f"📚 已加载剧本: {', '.join(registry.story_ids) or '无'}")
     
     # 初始化 Redis
-    redis_client = await redis.from_url(REDIS_URL)
+    with startup_profile.phase("import:redis"):
+        import redis.asyncio as redis
+    with startup_profile.phase("init:redis"):
+        redis_client = await redis.from_url(REDIS_URL)
     
     # 初始化数据库管理器
     db_manager = DatabaseManager(
@@ -55,13 +122,81 @@ async def startup():
         supabase_key=os.getenv("SUPABASE_SERVICE_ROLE_KEY")
     )
     
+    # 初始化会话状态缓存（重放未写完的增量并启动写回任务）
+    with startup_profile.phase("init:session_cache"):
+        session_cache = SessionStateCache(redis_client, db_manager)
+        await session_cache.start()
+    
+    # 初始化消息写入管道
+    with startup_profile.phase("init:message_writer"):
+        message_writer = MessageWriter(db_manager, redis_client)
+        await message_writer.start()
+    
+    # 同一会话的回合串行执行、重复提交去重
+    turn_guard = TurnGuard(redis_client)
+    
+    # 异步回合队列与工作协程（TURN_WORKERS=0 时本进程只提交，由独立 worker 执行）
+    turn_queue = TurnQueue(redis_client)
+    turn_workers = TurnWorkerPool(turn_queue, run_turn_job, concurrency=turn_worker_concurrency)
+    await turn_workers.start()
+    
+    startup_profile.mark("startup_complete")
     print("✅ 服务器启动成功")
+    
+    # 预热（完成后才报告就绪）
+    if STARTUP_WARMUP == "blocking":
+        await warm_up(registry)
+    elif STARTUP_WARMUP == "background":
+        warmup_task = asyncio.create_task(warm_up(registry))
+    else:
+        ready = True
+    
+    startup_profile.print_report()
+
+async def warm_up(registry):
+    """预热 Agent Crew 与嵌入模型（在线程中构建，不阻塞事件循环）"""
+    global ready
+    try:
+        for story_id in CREW_WARMUP_STORIES:
+            if story_id not in registry:
+                continue
+            with startup_profile.phase(f"warmup:agent_crew:{story_id}"):
+                await agent_crews.warm_up([story_id])
+            print(f"🔥 已预热 Agent Crew: {story_id}")
+        
+        if WARMUP_EMBEDDING_MODEL:
+            from embedding_executor import get_embedding_executor
+            
+            with startup_profile.phase("warmup:embedding_model"):
+                await asyncio.to_thread(get_embedding_executor().warm_up)
+            print("🔥 已预热嵌入模型")
+    except Exception:
+        # 预热失败不影响服务，首次请求时再创建
+        traceback.print_exc()
+    finally:
+        ready = True
+        startup_profile.mark("ready")
+        startup_profile.print_report("预热完成")
 
 @app.on_event("shutdown")
 async def shutdown():
     """关闭时清理"""
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    if turn_workers:
+        await turn_workers.stop()
+    if message_writer:
+        await message_writer.stop()
+    if session_cache:
+        await session_cache.stop()
     if redis_client:
         await redis_client.close()
+    # 仅关闭已加载模块的连接池
+    if "replicate_llm" in sys.modules:
+        await sys.modules["replicate_llm"].close_http_clients()
+    if "embedding_executor" in sys.modules:
+        sys.modules["embedding_executor"].shutdown_embedding_executor()
+    await close_supabase_clients()
     print("👋 服务器已关闭")
 
 # ============ 数据模型 ============
@@ -80,6 +215,7 @@ class SessionResponse(BaseModel):
 class ActionRequest(BaseModel):
     session_id: str
     user_input: str
+    request_id: Optional[str] = None  # 幂等键（也可通过 Idempotency-Key 请求头传递）
 
 class ActionResponse(BaseModel):
     story: str
@@ -90,15 +226,25 @@ class ActionResponse(BaseModel):
 
 # ============ 辅助函数 ============
 
-def get_agent_crew(story_id: str) -> StoryAgentCrew:
-    """获取或创建 Agent Crew"""
-    if story_id not in agent_crews:
-        agent_crews[story_id] = StoryAgentCrew(
-            supabase_url=os.getenv("SUPABASE_URL"),
-            supabase_key=os.getenv("SUPABASE_SERVICE_ROLE_KEY"),
-            story_id=story_id
-        )
-    return agent_crews[story_id]
+async def get_agent_crew(story_id: str) -> "StoryAgentCrew":
+    """获取或创建 Agent Crew（未命中时在线程中创建）"""
+    return await agent_crews.aget(story_id)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 弱比较：支持逗号分隔的多个 ETag、W/ 弱验证器和 *"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any(
+        (candidate[2:] if candidate.startswith("W/") else candidate) == opaque
+        for candidate in re.findall(r'(?:W/)?"[^"]*"', if_none_match)
+    )
+
+def format_sse(event: str, data: Any) -> str:
+    """格式化 Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 # ============ API 端点 ============
 
@@ -114,8 +260,11 @@ async def root():
 @app.post("/api/session/create", response_model=SessionResponse)
 async def create_session(request: CreateSessionRequest):
     """创建新游戏会话"""
+    if request.story_id not in get_story_registry():
+        raise HTTPException(status_code=400, detail="剧本不存在")
+    
     try:
-        session = db_manager.create_session(
+        session = await db_manager.create_session(
             user_id=request.user_id,
             story_id=request.story_id
         )
@@ -131,69 +280,293 @@ async def create_session(request: CreateSessionRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/story/action", response_model=ActionResponse)
-async def process_action(request: ActionRequest, background_tasks: BackgroundTasks):
+async def process_action(request: ActionRequest, http_request: Request):
     """
     处理用户行动（同步返回）
+    
+    同一会话的回合依次执行；携带相同幂等键（request_id 或 Idempotency-Key 请求头）
+    的重复提交共享同一结果，不会重复调用 LLM
     """
+    idempotency_key = request.request_id or http_request.headers.get("idempotency-key")
+    if TURN_EXECUTION == "queue":
+        return ActionResponse(**await run_turn_via_queue(request, idempotency_key))
     try:
-        # 获取会话信息
-        session = db_manager.get_session(request.session_id)
-        if not session:
-            raise HTTPException(status_code=404, detail="会话不存在")
-        
-        if session["is_completed"]:
-            raise HTTPException(status_code=400, detail="游戏已结束")
-        
-        # 获取 Agent Crew
-        agent = get_agent_crew(session["story_id"])
-        
-        # 处理用户行动
-        result = await agent.process_user_action(
+        result = await turn_guard.run(
             session_id=request.session_id,
-            user_input=request.user_input
+            idempotency_key=idempotency_key,
+            user_input=request.user_input,
+            turn=lambda: run_turn(request)
         )
-        
-        # 后台保存消息
-        background_tasks.add_task(
-            db_manager.save_message,
+        return ActionResponse(**result)
+    except HTTPException:
+        raise
+    except TurnBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def run_turn(request: ActionRequest) -> Dict[str, Any]:
+    """执行一个回合（在会话锁内调用，快照反映前一回合的结果）"""
+    # 获取会话快照（会话 + 局势 + 角色，Redis 优先，与 Agent 共用）
+    session = await session_cache.get_snapshot(request.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    
+    if session["is_completed"]:
+        raise HTTPException(status_code=400, detail="游戏已结束")
+    
+    # 获取 Agent Crew
+    agent = await get_agent_crew(session["story_id"])
+    
+    # 处理用户行动
+    result = await agent.process_user_action(
+        session_id=request.session_id,
+        user_input=request.user_input,
+        session=session
+    )
+    
+    # 保存消息（锁内提交，保证历史顺序与回合顺序一致；后台写入，失败不影响已提交的回合）
+    await message_writer.write_turn(
+        session_id=request.session_id,
+        chapter=session["current_chapter"],
+        user_input=request.user_input,
+        story=result["story"]
+    )
+    
+    return result
+
+async def run_turn_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """工作协程执行队列中的回合（以 turn_id 作为幂等键，恢复重跑时不会重复执行）"""
+    request = ActionRequest(
+        session_id=job["session_id"],
+        user_input=job["user_input"],
+        request_id=job.get("idempotency_key") or None
+    )
+    try:
+        return await turn_guard.run(
             session_id=request.session_id,
-            role="user",
-            content=request.user_input
+            idempotency_key=request.request_id or job["turn_id"],
+            user_input=request.user_input,
+            turn=lambda: run_turn(request)
         )
-        background_tasks.add_task(
-            db_manager.save_message,
+    except TurnBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+async def enqueue_turn(request: ActionRequest, idempotency_key: Optional[str]) -> Dict[str, Any]:
+    """提交回合到队列（分片模式下按剧本进入对应分片，同一剧本由同一 worker 执行）"""
+    story_id = None
+    if turn_queue.shards > 1:
+        session = await session_cache.get_snapshot(request.session_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="会话不存在")
+        story_id = session["story_id"]
+    
+    try:
+        return await turn_queue.enqueue(
             session_id=request.session_id,
-            role="assistant",
-            content=result["story"]
+            user_input=request.user_input,
+            idempotency_key=idempotency_key,
+            story_id=story_id
         )
-        
-        return ActionResponse(**result)
-        
+    except TurnQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "5"})
+
+async def run_turn_via_queue(request: ActionRequest, idempotency_key: Optional[str]) -> Dict[str, Any]:
+    """提交回合并等待 worker 执行结果（TURN_EXECUTION=queue，HTTP 层不运行 LLM 编排）"""
+    job = await enqueue_turn(request, idempotency_key)
+    
+    async def wait_for_result() -> Dict[str, Any]:
+        final = job
+        async for final in turn_queue.subscribe(job["turn_id"], max_wait=TURN_EXECUTION_TIMEOUT):
+            pass
+        return final
+    
+    try:
+        final = await asyncio.wait_for(wait_for_result(), timeout=TURN_EXECUTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="回合执行超时，可通过 /api/story/turns/{turn_id} 查询结果")
+    
+    if final["status"] == "completed":
+        return final["result"]
+    if final["status"] == "failed":
+        raise HTTPException(status_code=final.get("error_status", 500), detail=final.get("error"))
+    raise HTTPException(status_code=500, detail="回合不存在或已过期")
+
+# ============ 异步回合 ============
+
+@app.post("/api/story/turns", status_code=202)
+async def submit_turn(request: ActionRequest, http_request: Request):
+    """
+    提交回合（立即返回 turn_id）
+    
+    通过 GET /api/story/turns/{turn_id} 轮询，或订阅 /api/story/turns/{turn_id}/events 获取结果；
+    排队回合过多时返回 429
+    """
+    try:
+        job = await enqueue_turn(request, request.request_id or http_request.headers.get("idempotency-key"))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    return {
+        **job,
+        "status_url": f"/api/story/turns/{job['turn_id']}",
+        "events_url": f"/api/story/turns/{job['turn_id']}/events",
+    }
+
+@app.get("/api/story/turns/{turn_id}")
+async def get_turn(turn_id: str):
+    """查询回合状态：queued → running → completed（含 result）| failed（含 error）"""
+    job = await turn_queue.get(turn_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="回合不存在或已过期")
+    return job
+
+@app.get("/api/story/turns/{turn_id}/events")
+async def turn_events(turn_id: str):
+    """
+    订阅回合状态（SSE）：status 事件（可多次）→ result 或 error → done
+    
+    无事件时定期发送 `: keepalive` 注释；回合过期或等待超过 TURN_EVENTS_MAX_WAIT 时发送 error 结束
+    """
+    if not await turn_queue.get(turn_id):
+        raise HTTPException(status_code=404, detail="回合不存在或已过期")
+    
+    async def event_stream():
+        async for job in turn_queue.subscribe(turn_id):
+            if job.get("keepalive"):
+                yield ": keepalive\n\n"  # SSE 注释行，保持连接不被代理断开
+            elif job["status"] == "completed":
+                yield format_sse("result", job.get("result"))
+            elif job["status"] == "failed":
+                yield format_sse("error", {"error": job.get("error")})
+            else:
+                yield format_sse("status", {"status": job["status"]})
+        yield format_sse("done", {})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+@app.post("/api/story/action/stream")
+async def process_action_stream(request: ActionRequest):
+    """
+    处理用户行动（SSE 流式返回）
+    
+    事件顺序：token（剧情片段，可多次）→ situation_update → character_updates
+    → chapter_status → ending（可选）→ done；出错时发送 error
+    """
+    try:
+        session = await session_cache.get_snapshot(request.session_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if not session:
+        raise HTTPException(status_code=404, detail="会话不存在")
+    
+    if session["is_completed"]:
+        raise HTTPException(status_code=400, detail="游戏已结束")
+    
+    async def event_stream():
+        story_chunks = []
+        try:
+            # 与同步接口共用会话锁；持锁后重新读取快照（可能刚被前一回合更新）
+            async with turn_guard.session_lock(request.session_id):
+                current = await session_cache.get_snapshot(request.session_id)
+                if current["is_completed"]:
+                    yield format_sse("error", {"error": "游戏已结束"})
+                    return
+                
+                agent = await get_agent_crew(current["story_id"])
+                async for item in agent.stream_user_action(
+                    session_id=request.session_id,
+                    user_input=request.user_input,
+                    session=current
+                ):
+                    if item["event"] == "token":
+                        story_chunks.append(item["data"]["text"])
+                    yield format_sse(item["event"], item["data"])
+                
+                # 保存消息（锁内提交、后台写入）
+                await message_writer.write_turn(
+                    session_id=request.session_id,
+                    chapter=current["current_chapter"],
+                    user_input=request.user_input,
+                    story="".join(story_chunks)
+                )
+        except Exception as e:
+            yield format_sse("error", {"error": str(e)})
+            return
+        
+        yield format_sse("done", {})
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # 关闭 Nginx 缓冲
+        }
+    )
 
 @app.get("/api/session/{session_id}")
 async def get_session(session_id: str):
     """获取会话信息"""
     try:
-        session = db_manager.get_session(session_id)
-        if not session:
+        snapshot = await session_cache.get_snapshot(session_id)
+        if not snapshot:
             raise HTTPException(status_code=404, detail="会话不存在")
-        return session
+        return {
+            key: value for key, value in snapshot.items()
+            if key not in ("situations", "characters")
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/session/{session_id}/history")
-async def get_history(session_id: str, limit: int = 20):
-    """获取对话历史"""
+async def get_history(
+    session_id: str,
+    request: Request,
+    response: Response,
+    limit: int = 20,
+    cursor: Optional[str] = None
+):
+    """
+    获取对话历史（游标分页）
+    
+    - 不带 cursor 返回最新一页，next_cursor 用于获取更早的一页
+    - 响应带 ETag，客户端通过 If-None-Match 重新请求时，无新消息返回 304
+    """
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
     try:
-        messages = db_manager.get_messages(session_id, limit)
-        return {"messages": messages}
+        marker = await message_writer.last_message_marker(session_id)
+        etag = f'W/"{marker}:{cursor or ""}:{limit}"'
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        page = await db_manager.get_messages_page(session_id, limit, cursor)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
+        return page
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # ============ 健康检查 ============
 
+@app.get("/ready")
+async def readiness_check():
+    """就绪检查：启动和预热完成前返回 503（供负载均衡 / 自动扩缩容探测）"""
+    body = {"ready": ready, "startup": startup_profile.report()}
+    return JSONResponse(body, status_code=200 if ready else 503)
+
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
@@ -210,7 +583,7 @@ async def health_check():
     # 检查数据库连接
     try:
         if db_manager:
-            db_manager.health_check()
+            await db_manager.health_check()
             db_status = "healthy"
         else:
             db_status = "not_initialized"
@@ -223,10 +596,25 @@ async def health_check():
         "status": overall_status,
         "redis": redis_status,
         "database": db_status,
+        "crew_cache": agent_crews.stats(),
+        "message_writer": message_writer.stats() if message_writer else None,
+        "turn_guard": turn_guard.stats() if turn_guard else None,
+        "turn_queue": {
+            **await turn_queue.metrics(),
+            "local_workers": turn_workers.stats(),
+        } if turn_queue and redis_status == "healthy" else None,
+        "session_cache": await session_cache.stats() if session_cache and redis_status == "healthy" else None,
         "version": "2.0.0",
         "framework": "CrewAI"
     }
 
+@app.get("/metrics")
+async def metrics():
+    """扩缩容指标（Prometheus 文本格式）：排队深度、执行中回合数、worker 数与饱和度"""
+    if not turn_queue:
+        raise HTTPException(status_code=503, detail="服务未就绪")
+    return PlainTextResponse(format_prometheus(await turn_queue.metrics()))
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
@@ -0,0 +1,124 @@
+"""
+记忆排序与上下文预算
+综合向量相似度、记忆重要性（metadata.importance）和章节远近为检索结果打分，
+按分数贪心装入固定的 token 预算，长篇剧情下提示词长度保持恒定
+"""
+
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "600"))
+PROFILE_TOKEN_BUDGET = int(os.getenv("PROFILE_TOKEN_BUDGET", "400"))
+MEMORY_WEIGHT_SIMILARITY = float(os.getenv("MEMORY_WEIGHT_SIMILARITY", "0.6"))
+MEMORY_WEIGHT_IMPORTANCE = float(os.getenv("MEMORY_WEIGHT_IMPORTANCE", "0.25"))
+MEMORY_WEIGHT_RECENCY = float(os.getenv("MEMORY_WEIGHT_RECENCY", "0.15"))
+# 每相隔一章，时近性分数乘以该系数
+MEMORY_RECENCY_DECAY = float(os.getenv("MEMORY_RECENCY_DECAY", "0.7"))
+
+DEFAULT_IMPORTANCE = 0.5
+
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token/字，其余约 4 字符/token"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """截断文本使其不超过 max_tokens"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) + 1 <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…"
+
+
+class MemoryRanker:
+    """记忆排序器"""
+
+    def __init__(
+        self,
+        budget: int = MEMORY_TOKEN_BUDGET,
+        w_similarity: float = MEMORY_WEIGHT_SIMILARITY,
+        w_importance: float = MEMORY_WEIGHT_IMPORTANCE,
+        w_recency: float = MEMORY_WEIGHT_RECENCY,
+        recency_decay: float = MEMORY_RECENCY_DECAY,
+    ):
+        self.budget = budget
+        self.w_similarity = w_similarity
+        self.w_importance = w_importance
+        self.w_recency = w_recency
+        self.recency_decay = recency_decay
+
+    def score(self, memory: Dict[str, Any], current_chapter: Optional[int]) -> float:
+        metadata = memory.get("metadata") or {}
+
+        similarity = memory.get("similarity")
+        similarity = float(similarity) if isinstance(similarity, (int, float)) else 0.0
+
+        importance = metadata.get("importance")
+        importance = float(importance) if isinstance(importance, (int, float)) else DEFAULT_IMPORTANCE
+
+        chapter = metadata.get("chapter")
+        if isinstance(chapter, int) and isinstance(current_chapter, int):
+            recency = self.recency_decay ** max(0, current_chapter - chapter)
+        else:
+            recency = 1.0
+
+        return (
+            self.w_similarity * similarity
+            + self.w_importance * min(max(importance, 0.0), 1.0)
+            + self.w_recency * recency
+        )
+
+    def rank(
+        self,
+        memories: List[Dict[str, Any]],
+        current_chapter: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """按综合分数降序排列（附加 score 字段）"""
+        scored = [
+            {**memory, "score": self.score(memory, current_chapter)}
+            for memory in memories
+            if memory.get("content")
+        ]
+        return sorted(scored, key=lambda memory: memory["score"], reverse=True)
+
+    def pack(
+        self,
+        memories: List[Dict[str, Any]],
+        current_chapter: Optional[int] = None,
+        budget: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        按分数贪心装入 token 预算
+
+        放不下的记忆跳过，继续尝试分数更低但更短的记忆；
+        返回结果按章节先后排列，便于叙事者理解时间线
+        """
+        remaining = self.budget if budget is None else budget
+        selected = []
+        seen = set()
+        for memory in self.rank(memories, current_chapter):
+            # 同一事件可能写入多个角色的记忆
+            if memory["content"] in seen:
+                continue
+            tokens = estimate_tokens(memory["content"]) + 2
+            if tokens > remaining:
+                continue
+            selected.append(memory)
+            seen.add(memory["content"])
+            remaining -= tokens
+
+        return sorted(selected, key=lambda memory: (memory.get("metadata") or {}).get("chapter") or 0)
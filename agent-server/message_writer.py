@@ -0,0 +1,211 @@
+"""
+消息写入管道
+每回合的玩家输入与剧情一次批量写入，写入在后台进行（同一会话按提交顺序依次写入），
+失败不影响已提交的回合；
+可选微批：在短暂的刷新间隔内合并多个会话的消息为一次插入；
+批量插入失败时退避重试，仍失败则逐回合写入，避免整批消息丢失
+（消息 ID 由客户端生成，重试不会产生重复消息）
+"""
+
+import os
+import uuid
+import asyncio
+import traceback
+from typing import Dict, Any, List, Optional
+
+from database import DatabaseManager
+
+
+# 微批刷新间隔（毫秒），0 表示每回合立即写入
+MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "0"))
+MESSAGE_BATCH_MAX = int(os.getenv("MESSAGE_BATCH_MAX", "200"))
+MESSAGE_WRITE_RETRIES = int(os.getenv("MESSAGE_WRITE_RETRIES", "3"))
+MESSAGE_RETRY_DELAY = 0.5  # 首次重试间隔（秒），之后翻倍
+
+# 每个会话最新消息的标记（用于历史接口 ETag）
+LAST_MESSAGE_KEY = "session_messages:last:{session_id}"
+LAST_MESSAGE_TTL = int(os.getenv("SESSION_CACHE_TTL", "3600"))
+EMPTY_MARKER = "empty"
+
+
+class MessageWriter:
+    """消息写入管道"""
+
+    def __init__(
+        self,
+        db: DatabaseManager,
+        redis_client=None,
+        flush_interval_ms: int = MESSAGE_FLUSH_INTERVAL_MS,
+        max_batch: int = MESSAGE_BATCH_MAX,
+    ):
+        self.db = db
+        self.redis = redis_client
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._flusher: Optional[asyncio.Task] = None
+        # 各会话最后一个后台写入任务（新写入排在其后，保持回合顺序）
+        self._tails: Dict[str, asyncio.Task] = {}
+
+        self.rows_written = 0
+        self.inserts = 0
+        self.retries = 0
+        self.failed_rows = 0
+
+    @property
+    def batching(self) -> bool:
+        return self.flush_interval > 0
+
+    async def write_turn(
+        self,
+        session_id: str,
+        chapter: int,
+        user_input: str,
+        story: str
+    ):
+        """
+        提交一个回合的对话（按调用顺序写入，不等待数据库，不抛出写入错误）
+
+        Args:
+            session_id: 会话 ID
+            chapter: 回合发生时的章节（取自内存中的会话快照，无需再查询会话）
+            user_input: 玩家输入
+            story: 剧情
+        """
+        rows = [
+            {"id": str(uuid.uuid4()), "session_id": session_id, "chapter": chapter, "role": "user", "content": user_input},
+            {"id": str(uuid.uuid4()), "session_id": session_id, "chapter": chapter, "role": "assistant", "content": story},
+        ]
+
+        if self.batching and self._queue is not None:
+            await self._queue.put(rows)
+        else:
+            previous = self._tails.get(session_id)
+            task = asyncio.create_task(self._write_after(previous, rows))
+            self._tails[session_id] = task
+            task.add_done_callback(lambda done: self._forget_tail(session_id, done))
+
+    async def _write_after(self, previous: Optional[asyncio.Task], rows: List[Dict[str, Any]]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        await self._write_batch([rows])
+
+    def _forget_tail(self, session_id: str, task: asyncio.Task):
+        if self._tails.get(session_id) is task:
+            del self._tails[session_id]
+
+    async def start(self):
+        """启动微批刷新任务"""
+        if self.batching and self._flusher is None:
+            self._queue = asyncio.Queue()
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """停止刷新任务并写入剩余消息"""
+        if self._tails:
+            await asyncio.gather(*self._tails.values(), return_exceptions=True)
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+
+        turns = self._drain(self._queue.qsize() if self._queue else 0)
+        if turns:
+            await self._write_batch(turns)
+        self._queue = None
+
+    async def _flush_loop(self):
+        while True:
+            # 等待第一个回合，再收集刷新间隔内到达的回合
+            turns = [await self._queue.get()]
+            try:
+                await asyncio.sleep(self.flush_interval)
+            except asyncio.CancelledError:
+                # 关闭时写入已取出的消息
+                await self._write_batch(turns)
+                raise
+            turns += self._drain(self.max_batch - len(turns[0]))
+            await self._write_batch(turns)
+
+    def _drain(self, max_rows: int) -> List[List[Dict[str, Any]]]:
+        """取出队列中的回合（每回合的消息保持在同一批次）"""
+        turns = []
+        rows = 0
+        while rows < max_rows and self._queue is not None and not self._queue.empty():
+            turn = self._queue.get_nowait()
+            turns.append(turn)
+            rows += len(turn)
+        return turns
+
+    async def _write_batch(self, turns: List[List[Dict[str, Any]]]):
+        """批量写入多个回合：失败时退避重试，仍失败则逐回合写入"""
+        rows = [row for turn in turns for row in turn]
+        for attempt in range(MESSAGE_WRITE_RETRIES):
+            try:
+                await self._insert(rows)
+                return
+            except Exception:
+                traceback.print_exc()
+                if attempt + 1 < MESSAGE_WRITE_RETRIES:
+                    self.retries += 1
+                    await asyncio.sleep(MESSAGE_RETRY_DELAY * 2 ** attempt)
+
+        # 单个回合的问题数据不连累同批其他回合
+        for turn in turns:
+            try:
+                await self._insert(turn)
+            except Exception:
+                self.failed_rows += len(turn)
+                traceback.print_exc()
+                print(f"❌ 消息写入失败，已丢弃会话 {turn[0]['session_id']} 的 {len(turn)} 条消息")
+
+    async def _insert(self, rows: List[Dict[str, Any]]):
+        inserted = await self.db.save_messages(rows)
+        self.inserts += 1
+        self.rows_written += len(rows)
+        await self._update_markers(inserted)
+
+    # ============ 最新消息标记 ============
+
+    async def _update_markers(self, inserted: List[Dict[str, Any]]):
+        if self.redis is None or not inserted:
+            return
+        # 同一批次中每个会话最后插入的消息
+        last_ids = {row["session_id"]: row["id"] for row in inserted}
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for session_id, message_id in last_ids.items():
+                pipe.set(LAST_MESSAGE_KEY.format(session_id=session_id), message_id, ex=LAST_MESSAGE_TTL)
+            await pipe.execute()
+
+    async def last_message_marker(self, session_id: str) -> str:
+        """
+        会话最新消息标记
+
+        优先读取 Redis，未命中时查询最新消息 ID 并回填
+        """
+        key = LAST_MESSAGE_KEY.format(session_id=session_id)
+        if self.redis is not None:
+            marker = await self.redis.get(key)
+            if marker:
+                return marker.decode() if isinstance(marker, bytes) else marker
+
+        marker = await self.db.get_last_message_id(session_id) or EMPTY_MARKER
+        if self.redis is not None:
+            # NX：避免覆盖刚写入的更新标记
+            await self.redis.set(key, marker, ex=LAST_MESSAGE_TTL, nx=True)
+        return marker
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "batching": self.batching,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "writing_sessions": len(self._tails),
+            "inserts": self.inserts,
+            "rows_written": self.rows_written,
+            "retries": self.retries,
+            "failed_rows": self.failed_rows,
+        }
@@ -4,51 +4,142 @@ Replicate API LLM 包装器
 """
 
 import os
-import requests
-import time
-from typing import List, Dict, Any, Optional
+import asyncio
+import threading
+import httpx
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
 from langchain_core.language_models.llms import LLM
-from langchain_core.callbacks.manager import CallbackManagerForLLMRun
+from langchain_core.callbacks.manager import (
+    CallbackManagerForLLMRun,
+    AsyncCallbackManagerForLLMRun,
+)
+from replicate_poller import (
+    prefer_wait_headers,
+    wait_for_prediction,
+    wait_for_prediction_sync,
+)
+
+
+REPLICATE_API_BASE = "https://api.replicate.com/v1"
+
+# 连接池配置（进程内所有 ReplicateLLM 实例共享）
+REPLICATE_MAX_CONNECTIONS = int(os.getenv("REPLICATE_MAX_CONNECTIONS", "64"))
+REPLICATE_MAX_KEEPALIVE = int(os.getenv("REPLICATE_MAX_KEEPALIVE", "32"))
+REPLICATE_KEEPALIVE_EXPIRY = float(os.getenv("REPLICATE_KEEPALIVE_EXPIRY", "30"))
+REPLICATE_HTTP_TIMEOUT = float(os.getenv("REPLICATE_HTTP_TIMEOUT", "30"))
+
+# 同时进行中的预测数量上限
+REPLICATE_MAX_CONCURRENCY = int(os.getenv("REPLICATE_MAX_CONCURRENCY", "32"))
+
+
+# ============ 共享 HTTP 连接池 ============
+
+_async_client: Optional[httpx.AsyncClient] = None
+_sync_client: Optional[httpx.Client] = None
+_async_semaphore: Optional[asyncio.Semaphore] = None
+_sync_semaphore = threading.BoundedSemaphore(REPLICATE_MAX_CONCURRENCY)
+_client_lock = threading.Lock()
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=REPLICATE_MAX_CONNECTIONS,
+        max_keepalive_connections=REPLICATE_MAX_KEEPALIVE,
+        keepalive_expiry=REPLICATE_KEEPALIVE_EXPIRY,
+    )
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """获取共享的异步 HTTP 客户端（keep-alive 连接复用）"""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            base_url=REPLICATE_API_BASE,
+            limits=_http_limits(),
+            timeout=REPLICATE_HTTP_TIMEOUT,
+        )
+    return _async_client
+
+
+def get_sync_http_client() -> httpx.Client:
+    """获取共享的同步 HTTP 客户端（供 CrewAI 线程内调用）"""
+    global _sync_client
+    with _client_lock:
+        if _sync_client is None or _sync_client.is_closed:
+            _sync_client = httpx.Client(
+                base_url=REPLICATE_API_BASE,
+                limits=_http_limits(),
+                timeout=REPLICATE_HTTP_TIMEOUT,
+            )
+    return _sync_client
+
+
+def _get_async_semaphore() -> asyncio.Semaphore:
+    global _async_semaphore
+    if _async_semaphore is None:
+        _async_semaphore = asyncio.Semaphore(REPLICATE_MAX_CONCURRENCY)
+    return _async_semaphore
+
+
+async def close_http_clients():
+    """关闭共享连接池（服务关闭时调用）"""
+    global _async_client, _sync_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    with _client_lock:
+        if _sync_client is not None:
+            _sync_client.close()
+            _sync_client = None
+
+
+async def _iter_sse_events(response: httpx.Response) -> AsyncIterator[Tuple[str, str]]:
+    """解析 Server-Sent Events 流，产出 (event, data)"""
+    event, data = "message", []
+    async for line in response.aiter_lines():
+        if line == "":
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith(":"):
+            continue
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            value = line[len("data:"):]
+            data.append(value[1:] if value.startswith(" ") else value)
+    if data:
+        yield event, "\n".join(data)
 
 
 class ReplicateLLM(LLM):
     """Replicate API LLM 包装器"""
-    
+
     model: str = "openai/gpt-5-mini"
     replicate_api_token: str = ""
     max_tokens: int = 1024
     temperature: float = 0.7
-    
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         if not self.replicate_api_token:
             self.replicate_api_token = os.getenv("REPLICATE_API_TOKEN", "")
-    
+
     @property
     def _llm_type(self) -> str:
         return "replicate"
-    
-    def _call(
-        self,
-        prompt: str,
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[CallbackManagerForLLMRun] = None,
-        **kwargs: Any,
-    ) -> str:
-        """调用 Replicate API"""
-        
+
+    def _headers(self) -> Dict[str, str]:
         if not self.replicate_api_token:
             raise ValueError("REPLICATE_API_TOKEN 未设置")
-        
-        # 创建预测
-        prediction_url = f"https://api.replicate.com/v1/models/{self.model}/predictions"
-        
-        headers = {
+
+        return {
             "Authorization": f"Bearer {self.replicate_api_token}",
             "Content-Type": "application/json",
         }
-        
-        payload = {
+
+    def _build_payload(self, prompt: str) -> Dict[str, Any]:
+        return {
             "input": {
                 "messages": [
                     {"role": "user", "content": prompt}
@@ -57,45 +148,123 @@ class ReplicateLLM(LLM):
                 "temperature": self.temperature,
             }
         }
-        
-        # 创建预测
-        response = requests.post(prediction_url, json=payload, headers=headers)
-        
+
+    @property
+    def _prediction_path(self) -> str:
+        return f"/models/{self.model}/predictions"
+
+    @staticmethod
+    def _check_created(response: httpx.Response) -> Dict[str, Any]:
         if response.status_code != 201:
             error_detail = response.text
             raise Exception(f"Replicate API 错误: {response.status_code} - {error_detail}")
-        
-        prediction = response.json()
-        prediction_id = prediction["id"]
-        get_url = prediction["urls"]["get"]
-        
-        # 轮询结果
-        max_attempts = 60  # 最多等待 60 秒
-        for _ in range(max_attempts):
-            time.sleep(1)
-            
-            result_response = requests.get(get_url, headers=headers)
-            if result_response.status_code != 200:
-                continue
-            
-            result = result_response.json()
-            status = result.get("status")
-            
-            if status == "succeeded":
-                output = result.get("output", "")
-                if isinstance(output, list):
-                    return "".join(output)
-                return str(output)
-            
-            elif status == "failed":
-                error = result.get("error", "未知错误")
-                raise Exception(f"Replicate 预测失败: {error}")
-            
-            elif status == "canceled":
-                raise Exception("Replicate 预测被取消")
-        
-        raise Exception("Replicate 预测超时")
-    
+        return response.json()
+
+    @staticmethod
+    def _parse_result(result: Dict[str, Any]) -> str:
+        """解析终态预测的输出"""
+        status = result.get("status")
+
+        if status == "succeeded":
+            output = result.get("output", "")
+            if isinstance(output, list):
+                return "".join(output)
+            return str(output)
+
+        elif status == "failed":
+            error = result.get("error", "未知错误")
+            raise Exception(f"Replicate 预测失败: {error}")
+
+        elif status == "canceled":
+            raise Exception("Replicate 预测被取消")
+
+        raise Exception(f"Replicate 预测状态异常: {status}")
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        """调用 Replicate API（同步，复用共享连接池）"""
+        headers = self._headers()
+        client = get_sync_http_client()
+
+        with _sync_semaphore:
+            # 创建预测（Prefer: wait 下短预测可直接返回结果）
+            response = client.post(
+                self._prediction_path,
+                json=self._build_payload(prompt),
+                headers={**headers, **prefer_wait_headers(REPLICATE_HTTP_TIMEOUT)},
+            )
+            prediction = self._check_created(response)
+            prediction = wait_for_prediction_sync(client, prediction, headers)
+            return self._parse_result(prediction)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        """调用 Replicate API（异步，不阻塞事件循环）"""
+        headers = self._headers()
+        client = get_async_http_client()
+
+        async with _get_async_semaphore():
+            # 创建预测（Prefer: wait 下短预测可直接返回结果）
+            response = await client.post(
+                self._prediction_path,
+                json=self._build_payload(prompt),
+                headers={**headers, **prefer_wait_headers(REPLICATE_HTTP_TIMEOUT)},
+            )
+            prediction = self._check_created(response)
+            prediction = await wait_for_prediction(client, prediction, headers)
+            return self._parse_result(prediction)
+
+    async def astream_text(self, prompt: str) -> AsyncIterator[str]:
+        """
+        流式调用 Replicate API，逐段产出模型输出
+
+        使用预测返回的 urls.stream（SSE），模型不支持流式时退化为一次性输出
+        """
+        headers = self._headers()
+        client = get_async_http_client()
+        payload = {**self._build_payload(prompt), "stream": True}
+
+        async with _get_async_semaphore():
+            response = await client.post(
+                self._prediction_path,
+                json=payload,
+                headers=headers,
+            )
+            prediction = self._check_created(response)
+            stream_url = prediction.get("urls", {}).get("stream")
+
+            if not stream_url:
+                prediction = await wait_for_prediction(client, prediction, headers)
+                yield self._parse_result(prediction)
+                return
+
+            stream_headers = {
+                **headers,
+                "Accept": "text/event-stream",
+                "Cache-Control": "no-store",
+            }
+            # 流式读取不设读超时，由模型生成速度决定
+            timeout = httpx.Timeout(REPLICATE_HTTP_TIMEOUT, read=None)
+
+            async with client.stream("GET", stream_url, headers=stream_headers, timeout=timeout) as stream:
+                async for event, data in _iter_sse_events(stream):
+                    if event == "output":
+                        yield data
+                    elif event == "error":
+                        raise Exception(f"Replicate 预测失败: {data}")
+                    elif event == "done":
+                        break
+
     @property
     def _identifying_params(self) -> Dict[str, Any]:
         """返回标识参数"""
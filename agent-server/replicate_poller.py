@@ -0,0 +1,163 @@
+"""
+Replicate 预测轮询器
+指数退避 + 抖动 + 硬性截止时间，支持 Prefer: wait 同步模式
+ReplicateLLM 与 StoryAgent 共用
+"""
+
+import os
+import time
+import random
+import asyncio
+import httpx
+from typing import Dict, Any, Iterator, Optional
+
+
+# 首次轮询间隔（秒），之后按倍数递增直至上限
+POLL_INITIAL_DELAY = float(os.getenv("REPLICATE_POLL_INITIAL_DELAY", "0.25"))
+POLL_MAX_DELAY = float(os.getenv("REPLICATE_POLL_MAX_DELAY", "2.0"))
+POLL_BACKOFF_FACTOR = float(os.getenv("REPLICATE_POLL_BACKOFF_FACTOR", "1.5"))
+POLL_JITTER = float(os.getenv("REPLICATE_POLL_JITTER", "0.2"))  # 抖动比例
+
+# 单个预测的最长等待时间（秒）
+PREDICTION_DEADLINE = float(os.getenv("REPLICATE_PREDICTION_DEADLINE", "60"))
+
+# Prefer: wait 同步等待秒数（Replicate 上限 60），0 表示关闭
+PREFER_WAIT_SECONDS = int(os.getenv("REPLICATE_PREFER_WAIT", "10"))
+# 同步等待需比 HTTP 超时至少短这么多秒，否则创建请求会先触发客户端超时而不是回退到轮询
+PREFER_WAIT_MARGIN = 5
+
+TERMINAL_STATUSES = ("succeeded", "failed", "canceled")
+
+
+class PredictionTimeout(Exception):
+    """预测在截止时间内未完成"""
+
+
+def prefer_wait_headers(http_timeout: Optional[float] = None) -> Dict[str, str]:
+    """
+    创建预测时附加的同步等待请求头
+
+    Args:
+        http_timeout: 创建请求所用客户端的读超时（秒），同步等待会被压到其之下
+    """
+    wait = min(PREFER_WAIT_SECONDS, 60)
+    if http_timeout is not None:
+        wait = min(wait, int(http_timeout - PREFER_WAIT_MARGIN))
+    if wait <= 0:
+        return {}
+    return {"Prefer": f"wait={wait}"}
+
+
+def is_terminal(prediction: Dict[str, Any]) -> bool:
+    return prediction.get("status") in TERMINAL_STATUSES
+
+
+def backoff_delays(
+    initial: float = POLL_INITIAL_DELAY,
+    maximum: float = POLL_MAX_DELAY,
+    factor: float = POLL_BACKOFF_FACTOR,
+    jitter: float = POLL_JITTER,
+) -> Iterator[float]:
+    """生成轮询间隔序列（指数退避，带随机抖动）"""
+    delay = initial
+    while True:
+        spread = delay * jitter
+        yield max(0.0, delay + random.uniform(-spread, spread))
+        delay = min(delay * factor, maximum)
+
+
+def _remaining(deadline_at: float) -> float:
+    return deadline_at - time.monotonic()
+
+
+async def wait_for_prediction(
+    client: httpx.AsyncClient,
+    prediction: Dict[str, Any],
+    headers: Dict[str, str],
+    deadline: float = PREDICTION_DEADLINE,
+) -> Dict[str, Any]:
+    """
+    异步等待预测进入终态
+
+    Args:
+        client: HTTP 客户端
+        prediction: 创建预测时返回的对象（Prefer: wait 下可能已是终态）
+        headers: 鉴权请求头
+        deadline: 最长等待秒数
+
+    Returns:
+        终态的预测对象
+
+    Raises:
+        PredictionTimeout: 超过截止时间（会尝试取消预测）
+    """
+    deadline_at = time.monotonic() + deadline
+    get_url = prediction["urls"]["get"]
+
+    for delay in backoff_delays():
+        if is_terminal(prediction):
+            return prediction
+
+        remaining = _remaining(deadline_at)
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(delay, remaining))
+
+        response = await client.get(get_url, headers=headers)
+        if response.status_code == 200:
+            prediction = response.json()
+
+    await _cancel(client, prediction, headers)
+    raise PredictionTimeout("Replicate 预测超时")
+
+
+def wait_for_prediction_sync(
+    client: httpx.Client,
+    prediction: Dict[str, Any],
+    headers: Dict[str, str],
+    deadline: float = PREDICTION_DEADLINE,
+) -> Dict[str, Any]:
+    """同步等待预测进入终态（参数同 wait_for_prediction）"""
+    deadline_at = time.monotonic() + deadline
+    get_url = prediction["urls"]["get"]
+
+    for delay in backoff_delays():
+        if is_terminal(prediction):
+            return prediction
+
+        remaining = _remaining(deadline_at)
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+
+        response = client.get(get_url, headers=headers)
+        if response.status_code == 200:
+            prediction = response.json()
+
+    _cancel_sync(client, prediction, headers)
+    raise PredictionTimeout("Replicate 预测超时")
+
+
+def _cancel_url(prediction: Dict[str, Any]) -> Optional[str]:
+    return prediction.get("urls", {}).get("cancel")
+
+
+async def _cancel(client: httpx.AsyncClient, prediction: Dict[str, Any], headers: Dict[str, str]):
+    """尽力取消超时的预测，避免继续计费"""
+    cancel_url = _cancel_url(prediction)
+    if not cancel_url:
+        return
+    try:
+        await client.post(cancel_url, headers=headers)
+    except httpx.HTTPError:
+        pass
+
+
+def _cancel_sync(client: httpx.Client, prediction: Dict[str, Any], headers: Dict[str, str]):
+    cancel_url = _cancel_url(prediction)
+    if not cancel_url:
+        return
+    try:
+        client.post(cancel_url, headers=headers)
+    except httpx.HTTPError:
+        pass
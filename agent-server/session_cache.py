@@ -0,0 +1,294 @@
+"""
+会话状态缓存（Redis 热数据层 + 写回持久化）
+
+读：优先从 Redis 读取会话快照，未命中时从 Supabase 加载并回填
+    （叠加该会话尚未落库的增量，快照过期早于写回时也不会读到旧状态）
+写：回合增量先合并进 Redis 快照并追加到该会话的写回队列，后台任务异步写入 Supabase
+顺序：每个会话的增量按回合顺序排在各自的队列中；待写回的会话在 dirty 列表中只出现一次，
+     同一时间只由一个 flusher 认领并按序写入，多进程写回也不会乱序覆盖
+崩溃恢复：增量写入成功后才出队（增量为绝对值，重复写入安全）；flusher 定期心跳，
+         心跳过期的 flusher 认领的会话由其他进程放回 dirty 列表
+队列有界：待写回的会话数达到上限时，没有排队增量的会话改为同步写入（背压）
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import traceback
+from typing import Dict, Any, List, Optional
+
+from database import DatabaseManager
+from turn_state import apply_delta_to_snapshot, is_empty_delta
+
+
+SESSION_CACHE_ENABLED = os.getenv("SESSION_CACHE_ENABLED", "true").lower() == "true"
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "3600"))
+SESSION_WRITE_QUEUE_MAX = int(os.getenv("SESSION_WRITE_QUEUE_MAX", "10000"))  # 待写回的会话数上限
+SESSION_FLUSH_MAX_ATTEMPTS = int(os.getenv("SESSION_FLUSH_MAX_ATTEMPTS", "5"))
+SESSION_FLUSH_HEARTBEAT = int(os.getenv("SESSION_FLUSH_HEARTBEAT", "10"))
+
+SNAPSHOT_KEY = "session_state:{session_id}"
+QUEUE_KEY = "session_state:write_behind:session:{session_id}"
+DIRTY_KEY = "session_state:write_behind:dirty"
+DIRTY_SET_KEY = "session_state:write_behind:dirty_set"
+CLAIMED_KEY = "session_state:write_behind:claimed:{consumer}"
+CONSUMER_KEY = "session_state:write_behind:consumer:{consumer}"
+ATTEMPTS_KEY = "session_state:write_behind:attempts"
+FAILED_KEY = "session_state:write_behind:failed"
+
+# 追加增量；会话不在 dirty 列表中时加入
+_ENQUEUE_SCRIPT = """
+redis.call('rpush', KEYS[1], ARGV[1])
+if redis.call('sadd', KEYS[2], ARGV[2]) == 1 then
+    redis.call('rpush', KEYS[3], ARGV[2])
+end
+return 1
+"""
+# 释放认领；期间又有新增量时重新放回 dirty 列表
+_RELEASE_SCRIPT = """
+redis.call('lrem', KEYS[3], 1, ARGV[1])
+if redis.call('llen', KEYS[1]) == 0 then
+    redis.call('srem', KEYS[2], ARGV[1])
+else
+    redis.call('rpush', KEYS[4], ARGV[1])
+end
+return 1
+"""
+
+
+class SessionStateCache:
+    """会话状态缓存"""
+
+    def __init__(
+        self,
+        redis_client,
+        db: DatabaseManager,
+        enabled: bool = SESSION_CACHE_ENABLED,
+        ttl: int = SESSION_CACHE_TTL,
+        max_queue: int = SESSION_WRITE_QUEUE_MAX,
+    ):
+        self.redis = redis_client
+        self.db = db
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_queue = max_queue
+        self.consumer = uuid.uuid4().hex[:12]
+        self.claimed_key = CLAIMED_KEY.format(consumer=self.consumer)
+        self._tasks: List[asyncio.Task] = []
+
+        self._enqueue = redis_client.register_script(_ENQUEUE_SCRIPT)
+        self._release = redis_client.register_script(_RELEASE_SCRIPT)
+
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+        self.write_through = 0
+        self.flush_errors = 0
+        self.reclaimed = 0
+
+    # ============ 读 ============
+
+    async def get_snapshot(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """获取会话快照（Redis 优先）"""
+        if not self.enabled:
+            return await self.db.get_session_snapshot(session_id)
+
+        key = SNAPSHOT_KEY.format(session_id=session_id)
+        cached = await self.redis.get(key)
+        if cached:
+            self.hits += 1
+            await self.redis.expire(key, self.ttl)
+            return json.loads(cached)
+
+        self.misses += 1
+        # 先读排队增量再读数据库：期间写回的增量要么已在数据库中，要么仍在列表里（重复叠加安全）
+        queued = await self.redis.lrange(QUEUE_KEY.format(session_id=session_id), 0, -1)
+        snapshot = await self.db.get_session_snapshot(session_id)
+        if snapshot:
+            for item in queued:
+                snapshot = apply_delta_to_snapshot(snapshot, json.loads(item)["delta"])
+            # NX：避免覆盖并发回合刚写入的新快照
+            await self.redis.set(key, self._dumps(snapshot), ex=self.ttl, nx=True)
+        return snapshot
+
+    async def invalidate(self, session_id: str):
+        if self.enabled:
+            await self.redis.delete(SNAPSHOT_KEY.format(session_id=session_id))
+
+    # ============ 写 ============
+
+    async def apply_turn(
+        self,
+        session_id: str,
+        snapshot: Dict[str, Any],
+        delta: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        应用回合增量
+
+        Args:
+            session_id: 会话 ID
+            snapshot: 本回合开始时的会话快照
+            delta: 回合增量（见 turn_state.build_turn_delta）
+
+        Returns:
+            合并增量后的新快照
+        """
+        updated = apply_delta_to_snapshot(snapshot, delta)
+        if is_empty_delta(delta):
+            return updated
+
+        if not self.enabled:
+            await self.db.apply_turn_delta(session_id, delta)
+            return updated
+
+        await self.redis.set(
+            SNAPSHOT_KEY.format(session_id=session_id),
+            self._dumps(updated),
+            ex=self.ttl
+        )
+
+        queue_key = QUEUE_KEY.format(session_id=session_id)
+        if (
+            await self.redis.llen(DIRTY_KEY) >= self.max_queue
+            and not await self.redis.exists(queue_key)
+        ):
+            # 写回队列已满且本会话没有排队增量：同步写入不会与排队增量乱序
+            self.write_through += 1
+            await self.db.apply_turn_delta(session_id, delta)
+        else:
+            await self._enqueue(
+                keys=[queue_key, DIRTY_SET_KEY, DIRTY_KEY],
+                args=[self._dumps({"session_id": session_id, "delta": delta}), session_id]
+            )
+
+        return updated
+
+    # ============ 写回任务 ============
+
+    async def start(self):
+        """回收失联 flusher 认领的会话并启动后台写回任务"""
+        if not self.enabled or self._tasks:
+            return
+        await self._heartbeat()
+        await self.reclaim_stale()
+        self._tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._heartbeat_loop()),
+        ]
+
+    async def stop(self):
+        """停止写回任务（当前会话的认领释放回 dirty 列表，剩余增量留在队列中）"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._tasks:
+            await self.redis.delete(CONSUMER_KEY.format(consumer=self.consumer))
+        self._tasks = []
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                session_id = await self.redis.blmove(DIRTY_KEY, self.claimed_key, 1, "LEFT", "RIGHT")
+                if session_id is None:
+                    continue
+                if not await self._drain(_decode(session_id)):
+                    await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.flush_errors += 1
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+    async def _drain(self, session_id: str) -> bool:
+        """
+        按顺序写入一个会话的排队增量
+
+        Returns:
+            是否全部写入成功（失败时会话放回 dirty 列表稍后重试）
+        """
+        queue_key = QUEUE_KEY.format(session_id=session_id)
+        try:
+            while True:
+                item = await self.redis.lindex(queue_key, 0)
+                if item is None:
+                    return True
+                try:
+                    await self._write(item)
+                    self.flushed += 1
+                except Exception:
+                    self.flush_errors += 1
+                    traceback.print_exc()
+                    attempts = await self.redis.hincrby(ATTEMPTS_KEY, session_id, 1)
+                    if attempts < SESSION_FLUSH_MAX_ATTEMPTS:
+                        return False
+                    # 多次失败的增量转入 failed 列表，避免阻塞该会话的后续增量
+                    await self.redis.rpush(FAILED_KEY, item)
+                await self.redis.lpop(queue_key)
+                await self.redis.hdel(ATTEMPTS_KEY, session_id)
+        finally:
+            await self._release(
+                keys=[queue_key, DIRTY_SET_KEY, self.claimed_key, DIRTY_KEY],
+                args=[session_id]
+            )
+
+    async def _write(self, item):
+        entry = json.loads(item)
+        await self.db.apply_turn_delta(entry["session_id"], entry["delta"])
+
+    # ============ 心跳与回收 ============
+
+    async def _heartbeat(self):
+        await self.redis.set(
+            CONSUMER_KEY.format(consumer=self.consumer),
+            str(time.time()),
+            ex=SESSION_FLUSH_HEARTBEAT * 3
+        )
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(SESSION_FLUSH_HEARTBEAT)
+            try:
+                await self._heartbeat()
+                await self.reclaim_stale()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+
+    async def reclaim_stale(self):
+        """将心跳已过期的 flusher 认领的会话放回 dirty 列表（其增量仍在会话队列中）"""
+        async for key in self.redis.scan_iter(match=CLAIMED_KEY.format(consumer="*")):
+            key = _decode(key)
+            consumer = key.rsplit(":", 1)[-1]
+            if consumer == self.consumer or await self.redis.exists(CONSUMER_KEY.format(consumer=consumer)):
+                continue
+            while await self.redis.lmove(key, DIRTY_KEY, "LEFT", "RIGHT") is not None:
+                self.reclaimed += 1
+
+    @staticmethod
+    def _dumps(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False, default=str)
+
+    async def stats(self) -> Dict[str, Any]:
+        """缓存与写回队列统计"""
+        if not self.enabled:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "hits": self.hits,
+            "misses": self.misses,
+            "pending_sessions": await self.redis.llen(DIRTY_KEY),
+            "failed": await self.redis.llen(FAILED_KEY),
+            "flushed": self.flushed,
+            "write_through": self.write_through,
+            "flush_errors": self.flush_errors,
+            "reclaimed": self.reclaimed,
+        }
+
+
+def _decode(value: Any) -> Any:
+    return value.decode() if isinstance(value, bytes) else value
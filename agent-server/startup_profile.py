@@ -0,0 +1,59 @@
+"""
+启动耗时分析
+记录各阶段（模块导入、组件初始化、预热）的耗时，用于控制冷启动预算；
+STARTUP_PROFILE=true 时在启动和预热完成后打印报告
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "false").lower() == "true"
+
+
+class StartupProfiler:
+    """启动阶段计时器"""
+
+    def __init__(self, enabled: bool = STARTUP_PROFILE):
+        self.enabled = enabled
+        self.started_at = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.milestones: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        计时一个阶段（毫秒）
+
+        同名阶段只记录第一次（懒加载的导入和初始化只在首次使用时有开销）
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if name not in self.phases:
+                self.phases[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    def mark(self, name: str):
+        """记录里程碑（距进程导入本模块的毫秒数）"""
+        self.milestones[name] = round((time.perf_counter() - self.started_at) * 1000, 1)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "phases_ms": dict(self.phases),
+            "milestones_ms": dict(self.milestones),
+        }
+
+    def print_report(self, title: Optional[str] = None):
+        if not self.enabled:
+            return
+        print(f"⏱️  {title or '启动耗时'}")
+        for name, elapsed in self.phases.items():
+            print(f"   {name:<40} {elapsed:>10.1f} ms")
+        for name, elapsed in self.milestones.items():
+            print(f"   @{name:<39} {elapsed:>10.1f} ms")
+
+
+startup_profile = StartupProfiler()
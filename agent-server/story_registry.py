@@ -0,0 +1,165 @@
+"""
+剧本注册表
+启动时从声明式剧本文件（stories/*.json|yaml）加载章节、局势、角色定义，
+预编译查询索引，之后以只读方式在进程内共享
+"""
+
+import os
+import json
+import threading
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, Any, Iterable, List, Mapping, FrozenSet, Optional
+
+try:
+    import yaml
+except ImportError:  # YAML 剧本文件为可选格式
+    yaml = None
+
+
+STORIES_DIR = os.getenv("STORIES_DIR", str(Path(__file__).parent / "stories"))
+
+
+def _freeze(value: Any) -> Any:
+    """递归转换为只读结构"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class StoryDefinition:
+    """单个剧本的只读定义及预编译索引"""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.story_id: str = data["story_id"]
+        self.version: int = int(data.get("version", 1))
+        self.title: str = data.get("title", self.story_id)
+
+        chapters = {int(number): chapter for number, chapter in data.get("chapters", {}).items()}
+        self.chapters: Mapping[int, Mapping[str, Any]] = _freeze(dict(sorted(chapters.items())))
+        self.characters: Mapping[str, Mapping[str, Any]] = _freeze(data.get("characters", {}))
+
+        # 索引：局势 → 章节、章节 → 主要局势
+        situation_chapter = {}
+        main_situations = {}
+        for number, chapter in chapters.items():
+            mains = set()
+            for situation_id, situation in chapter.get("situations", {}).items():
+                if situation_id in situation_chapter:
+                    raise ValueError(f"剧本 {self.story_id} 中局势 {situation_id} 重复定义")
+                situation_chapter[situation_id] = number
+                if situation.get("type") == "main":
+                    mains.add(situation_id)
+            main_situations[number] = frozenset(mains)
+
+        self.situation_chapter: Mapping[str, int] = MappingProxyType(situation_chapter)
+        self.main_situations: Mapping[int, FrozenSet[str]] = MappingProxyType(main_situations)
+        self.first_chapter: int = min(chapters) if chapters else 1
+        self.last_chapter: int = max(chapters) if chapters else 1
+
+        initial_situation = data.get("initial_situation")
+        if initial_situation is None:
+            first = chapters.get(self.first_chapter, {}).get("situations", {})
+            initial_situation = next(iter(first), "initial")
+        self.initial_situation: str = initial_situation
+
+    def next_chapter(self, chapter: int) -> Optional[int]:
+        """下一章节号，已是最后一章时返回 None"""
+        return next((number for number in self.chapters if number > chapter), None)
+
+    def focus_situation(self, chapter: int, finished: Iterable[str] = ()) -> Optional[str]:
+        """章节中按声明顺序第一个未结束的主要局势（均已结束时返回 None）"""
+        finished = set(finished)
+        for situation_id, situation in self.chapters.get(chapter, {}).get("situations", {}).items():
+            if situation.get("type") == "main" and situation_id not in finished:
+                return situation_id
+        return None
+
+    def situation_rows(self, session_id: str, chapter: int) -> List[Dict[str, Any]]:
+        """生成某章节局势的初始状态行（situation_states）"""
+        situations = self.chapters.get(chapter, {}).get("situations", {})
+        return [
+            {
+                "session_id": session_id,
+                "chapter": chapter,
+                "situation_id": situation_id,
+                "situation_type": situation.get("type", "optional"),
+                "score": 0,
+                "target_score": situation.get("target_score", 100),
+                "status": "in_progress"
+            }
+            for situation_id, situation in situations.items()
+        ]
+
+    def character_rows(self, session_id: str) -> List[Dict[str, Any]]:
+        """生成角色的初始状态行（character_states）"""
+        rows = []
+        for name, character in self.characters.items():
+            initial_state = dict(character.get("initial_state", {}))
+            status = initial_state.pop("status", "alive")
+            rows.append({
+                "session_id": session_id,
+                "character_name": name,
+                "status": status,
+                "attributes": initial_state
+            })
+        return rows
+
+
+class StoryRegistry:
+    """剧本注册表（进程内单例，加载后只读）"""
+
+    def __init__(self, stories_dir: str = STORIES_DIR):
+        self.stories_dir = Path(stories_dir)
+        self._stories: Mapping[str, StoryDefinition] = MappingProxyType({})
+
+    def load(self) -> "StoryRegistry":
+        """加载目录下所有剧本文件"""
+        stories = {}
+        if self.stories_dir.is_dir():
+            for path in sorted(self.stories_dir.iterdir()):
+                data = self._read(path)
+                if data is None:
+                    continue
+                story = StoryDefinition(data)
+                if story.story_id in stories:
+                    raise ValueError(f"剧本 {story.story_id} 重复定义：{path.name}")
+                stories[story.story_id] = story
+        self._stories = MappingProxyType(stories)
+        return self
+
+    @staticmethod
+    def _read(path: Path) -> Optional[Dict[str, Any]]:
+        if path.suffix == ".json":
+            return json.loads(path.read_text(encoding="utf-8"))
+        if path.suffix in (".yaml", ".yml"):
+            if yaml is None:
+                raise RuntimeError(f"加载 {path.name} 需要安装 PyYAML")
+            return yaml.safe_load(path.read_text(encoding="utf-8"))
+        return None
+
+    def get(self, story_id: str) -> Optional[StoryDefinition]:
+        return self._stories.get(story_id)
+
+    def __contains__(self, story_id: str) -> bool:
+        return story_id in self._stories
+
+    @property
+    def story_ids(self) -> List[str]:
+        return list(self._stories)
+
+
+_registry: Optional[StoryRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_story_registry() -> StoryRegistry:
+    """获取全局剧本注册表（首次调用时加载）"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = StoryRegistry().load()
+    return _registry
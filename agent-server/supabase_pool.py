@@ -0,0 +1,61 @@
+"""
+Supabase 客户端池
+进程内共享同一组 PostgREST 连接（keep-alive、可选 HTTP/2），
+DatabaseManager、StoryAgentCrew、CharacterKnowledgeBase 共用
+"""
+
+import os
+import asyncio
+import httpx
+from typing import Dict, Tuple, TYPE_CHECKING
+
+# supabase 在首次创建客户端时才导入，缩短服务冷启动
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+
+
+SUPABASE_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "20"))
+SUPABASE_KEEPALIVE = int(os.getenv("SUPABASE_KEEPALIVE", "10"))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY", "60"))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "true").lower() == "true"
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+
+
+_async_clients: Dict[Tuple[str, str], "AsyncClient"] = {}
+_async_lock = asyncio.Lock()
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=SUPABASE_POOL_SIZE,
+        max_keepalive_connections=SUPABASE_KEEPALIVE,
+        keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+    )
+
+
+async def get_async_supabase_client(supabase_url: str, supabase_key: str) -> "AsyncClient":
+    """获取共享的异步 Supabase 客户端"""
+    key = (supabase_url, supabase_key)
+    async with _async_lock:
+        if key not in _async_clients:
+            from supabase import acreate_client, AsyncClientOptions
+
+            http_client = httpx.AsyncClient(
+                limits=_limits(),
+                http2=SUPABASE_HTTP2,
+                timeout=SUPABASE_TIMEOUT,
+            )
+            _async_clients[key] = await acreate_client(
+                supabase_url,
+                supabase_key,
+                options=AsyncClientOptions(httpx_client=http_client),
+            )
+        return _async_clients[key]
+
+
+async def close_supabase_clients():
+    """关闭共享连接池（服务关闭时调用）"""
+    async with _async_lock:
+        for client in _async_clients.values():
+            await client.options.httpx_client.aclose()
+        _async_clients.clear()
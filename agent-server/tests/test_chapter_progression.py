@@ -0,0 +1,121 @@
+"""
+章节推进：按规则协调器与回合增量从第一章玩到结局
+"""
+
+from chapter_coordinator import ChapterCoordinator, StoryConfig
+from story_registry import get_story_registry
+from turn_state import apply_delta_to_snapshot, build_turn_delta
+
+
+STORY_ID = "chongzhen"
+
+
+def new_session(session_id: str = "session-1") -> dict:
+    """与 DatabaseManager.create_session 创建的初始状态一致"""
+    story = get_story_registry().get(STORY_ID)
+    return {
+        "id": session_id,
+        "story_id": STORY_ID,
+        "current_chapter": 1,
+        "current_situation": story.initial_situation,
+        "is_completed": False,
+        "situations": {
+            row["situation_id"]: row
+            for row in story.situation_rows(session_id, story.first_chapter)
+        },
+        "characters": {
+            row["character_name"]: row
+            for row in story.character_rows(session_id)
+        },
+    }
+
+
+def play_turn(coordinator: ChapterCoordinator, session: dict, status: str = "success") -> tuple:
+    """judge 将当前局势判定为 status，返回（章节决策，增量，新快照）"""
+    situation_update = {
+        "situation_id": session["current_situation"],
+        "new_score": 100,
+        "status": status,
+    }
+    chapter_status = coordinator.decide(
+        current_chapter=session["current_chapter"],
+        situations=session["situations"],
+        situation_update=situation_update,
+    )
+    delta = build_turn_delta(session, {
+        "situation_update": situation_update,
+        "character_updates": [],
+        "chapter_status": chapter_status,
+    })
+    return chapter_status, delta, apply_delta_to_snapshot(session, delta)
+
+
+def test_plays_from_chapter_one_to_ending():
+    coordinator = ChapterCoordinator(StoryConfig(STORY_ID))
+    session = new_session()
+    history = []
+
+    while not session["is_completed"]:
+        assert len(history) < 10, f"剧情未能推进：{history}"
+        situation = session["current_situation"]
+        chapter_status, delta, session = play_turn(coordinator, session)
+        history.append((situation, chapter_status))
+
+    assert history == [
+        ("eunuch_party", "next_chapter"),
+        ("yuan_chonghuan", "continue"),
+        ("peasant_revolt", "next_chapter"),
+        ("final_battle", "ending"),
+    ]
+    assert session["current_chapter"] == 3
+    assert {
+        situation_id: state["status"]
+        for situation_id, state in session["situations"].items()
+        if state["situation_type"] == "main"
+    } == {
+        "eunuch_party": "completed",
+        "yuan_chonghuan": "completed",
+        "peasant_revolt": "completed",
+        "final_battle": "completed",
+    }
+
+
+def test_next_chapter_delta_seeds_situations_and_focus():
+    coordinator = ChapterCoordinator(StoryConfig(STORY_ID))
+    chapter_status, delta, session = play_turn(coordinator, new_session())
+
+    assert chapter_status == "next_chapter"
+    assert delta["session"] == {"current_chapter": 2, "current_situation": "yuan_chonghuan"}
+    assert [row["situation_id"] for row in delta["new_situations"]] == ["yuan_chonghuan", "peasant_revolt"]
+    assert all(row["chapter"] == 2 and row["status"] == "in_progress" for row in delta["new_situations"])
+    assert session["situations"]["peasant_revolt"]["score"] == 0
+
+    # 重放同一章的增量不会重复创建局势行
+    replay = build_turn_delta(session, {"chapter_status": "continue"})
+    assert replay["new_situations"] == []
+
+
+def test_failed_main_situation_still_advances():
+    coordinator = ChapterCoordinator(StoryConfig(STORY_ID))
+    chapter_status, _, session = play_turn(coordinator, new_session(), status="failed")
+
+    assert chapter_status == "next_chapter"
+    assert session["situations"]["eunuch_party"]["status"] == "failed"
+    assert session["current_situation"] == "yuan_chonghuan"
+
+
+def test_repairs_session_advanced_without_situation_rows():
+    """旧版本推进章节时只修改了 current_chapter"""
+    coordinator = ChapterCoordinator(StoryConfig(STORY_ID))
+    session = new_session()
+    session["situations"]["eunuch_party"]["status"] = "completed"
+    session["current_chapter"] = 2
+
+    _, delta, session = play_turn(coordinator, session)
+
+    assert [row["situation_id"] for row in delta["new_situations"]] == ["yuan_chonghuan", "peasant_revolt"]
+    assert session["current_situation"] == "yuan_chonghuan"
+
+    while not session["is_completed"]:
+        _, _, session = play_turn(coordinator, session)
+    assert session["current_chapter"] == 3
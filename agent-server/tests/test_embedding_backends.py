@@ -0,0 +1,41 @@
+"""
+ONNX 导出目录的模型名与维度校验
+"""
+
+import json
+
+import pytest
+
+from embedding_backends import EmbeddingBackend, ONNX_METADATA_FILE, _check_export_metadata
+
+
+MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+
+
+def write_metadata(directory, **metadata):
+    (directory / ONNX_METADATA_FILE).write_text(json.dumps(metadata), encoding="utf-8")
+
+
+def test_embedding_backend_is_abstract():
+    with pytest.raises(TypeError):
+        EmbeddingBackend()
+
+
+def test_matching_export_returns_dim(tmp_path):
+    write_metadata(tmp_path, model_name=f"sentence-transformers/{MODEL}", dim=384)
+    assert _check_export_metadata(str(tmp_path), MODEL, 384) == 384
+
+
+def test_mismatched_model_or_dim_is_rejected(tmp_path):
+    write_metadata(tmp_path, model_name="sentence-transformers/all-mpnet-base-v2", dim=768)
+    with pytest.raises(ValueError):
+        _check_export_metadata(str(tmp_path), MODEL, None)
+
+    write_metadata(tmp_path, model_name=f"sentence-transformers/{MODEL}", dim=768)
+    with pytest.raises(ValueError):
+        _check_export_metadata(str(tmp_path), MODEL, 384)
+
+
+def test_export_without_metadata_is_rejected(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        _check_export_metadata(str(tmp_path), MODEL, 384)
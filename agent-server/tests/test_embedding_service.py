@@ -0,0 +1,74 @@
+"""
+批量嵌入服务：合并、去重与取消
+"""
+
+import asyncio
+
+from embedding_service import EmbeddingService
+
+
+def fake_encoder(batches):
+    def encode_batch(texts):
+        batches.append(list(texts))
+        return [[float(len(text))] for text in texts]
+    return encode_batch
+
+
+def test_concurrent_requests_share_one_batch():
+    async def scenario():
+        batches = []
+        service = EmbeddingService(fake_encoder(batches))
+        results = await asyncio.gather(service.embed("ab"), service.embed("ab"), service.embed("abc"))
+        assert results == [[2.0], [2.0], [3.0]]
+        assert batches == [["ab", "abc"]]
+        # 再次请求命中缓存
+        assert await service.embed("ab") == [2.0]
+        assert len(batches) == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelling_one_caller_does_not_cancel_others():
+    async def scenario():
+        service = EmbeddingService(fake_encoder([]))
+        first = asyncio.create_task(service.embed("x"))
+        second = asyncio.create_task(service.embed("x"))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        # 取消后到达的调用方仍能拿到结果
+        third = asyncio.create_task(service.embed("x"))
+        assert await second == [1.0]
+        assert await third == [1.0]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_pending_entry_is_replaced():
+    async def scenario():
+        batches = []
+        service = EmbeddingService(fake_encoder(batches))
+        task = asyncio.create_task(service.embed("x"))
+        await asyncio.sleep(0)
+        # 直接取消共享 future（模拟旧版本的连带取消）
+        service._pending[next(iter(service._pending))].cancel()
+        task.cancel()
+        assert await service.embed("x") == [1.0]
+        assert batches == [["x"]]
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_entries_are_not_encoded():
+    async def scenario():
+        batches = []
+        service = EmbeddingService(fake_encoder(batches))
+        task = asyncio.create_task(service.embed("x"))
+        await asyncio.sleep(0)
+        service._pending[next(iter(service._pending))].cancel()
+        task.cancel()
+        await asyncio.sleep(0.05)
+        assert batches == []
+        assert service._pending == {}
+
+    asyncio.run(scenario())
@@ -0,0 +1,110 @@
+"""
+回合去重：未带幂等键时的输入指纹
+"""
+
+import asyncio
+import time
+
+from turn_guard import TurnGuard
+
+
+class FakeRedis:
+    """TurnGuard 用到的 Redis 命令的内存实现（两个 TurnGuard 共用即模拟两个进程）"""
+
+    def __init__(self):
+        self.data = {}
+
+    def _alive(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    async def set(self, key, value, px=None, ex=None, nx=False):
+        if nx and self._alive(key) is not None:
+            return None
+        ttl = px / 1000 if px else ex
+        self.data[key] = (str(value).encode(), time.monotonic() + ttl if ttl else None)
+        return True
+
+    async def get(self, key):
+        return self._alive(key)
+
+    async def delete(self, key):
+        return 1 if self.data.pop(key, None) else 0
+
+    def register_script(self, source):
+        async def script(keys, args):
+            if self._alive(keys[0]) != str(args[0]).encode():
+                return 0
+            if "pexpire" in source:
+                self.data[keys[0]] = (self.data[keys[0]][0], time.monotonic() + int(args[1]) / 1000)
+            else:
+                del self.data[keys[0]]
+            return 1
+        return script
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def counting_turn(calls, name, gate=None):
+    async def turn():
+        calls.append(name)
+        if gate is not None:
+            await gate.wait()
+        return {"story": f"{name}-{len(calls)}"}
+    return turn
+
+
+async def _retry_of_queued_turn_after_previous_completes(second_guard: bool):
+    redis = FakeRedis()
+    guard = TurnGuard(redis)
+    retry_guard = TurnGuard(redis) if second_guard else guard
+    calls = []
+    gate_a, gate_b = asyncio.Event(), asyncio.Event()
+
+    # A 持锁执行；B 提交后排队等锁
+    task_a = asyncio.create_task(guard.run("s", None, "a", counting_turn(calls, "a", gate_a)))
+    await asyncio.sleep(0.01)
+    task_b = asyncio.create_task(guard.run("s", None, "b", counting_turn(calls, "b", gate_b)))
+    await asyncio.sleep(0.01)
+
+    # A 完成，B 开始执行；此时客户端重试 B
+    gate_a.set()
+    await task_a
+    await asyncio.sleep(0.01)
+    assert calls == ["a", "b"]
+    task_retry = asyncio.create_task(retry_guard.run("s", None, "b", counting_turn(calls, "b")))
+    await asyncio.sleep(0.01)
+
+    gate_b.set()
+    result_b, result_retry = await asyncio.gather(task_b, task_retry)
+    assert calls == ["a", "b"]
+    assert result_retry == result_b
+
+    # B 完成后再次提交相同输入是新的回合
+    await retry_guard.run("s", None, "b", counting_turn(calls, "b"))
+    assert calls == ["a", "b", "b"]
+
+
+def test_retry_shares_queued_turn_in_process():
+    run(_retry_of_queued_turn_after_previous_completes(second_guard=False))
+
+
+def test_retry_shares_queued_turn_across_processes():
+    run(_retry_of_queued_turn_after_previous_completes(second_guard=True))
+
+
+def test_explicit_key_returns_cached_result():
+    async def scenario():
+        guard = TurnGuard(FakeRedis())
+        calls = []
+        first = await guard.run("s", "req-1", "a", counting_turn(calls, "a"))
+        again = await guard.run("s", "req-1", "a", counting_turn(calls, "a"))
+        assert calls == ["a"]
+        assert again == first
+
+    run(scenario())
@@ -0,0 +1,177 @@
+"""
+回合队列：扩缩容指标格式与回合出错后的结算
+"""
+
+import asyncio
+
+from turn_queue import JOB_KEY, TURN_JOB_MAX_ATTEMPTS, TurnQueue, TurnWorkerPool, format_prometheus
+
+
+def test_prometheus_reports_owner_saturation():
+    text = format_prometheus({
+        "pending": 12,
+        "in_flight": 4,
+        "workers": 2,
+        "capacity": 16,
+        "saturation": 1.0,
+        "shards": 2,
+        "pending_by_shard": {0: 12, 1: 0},
+        "owner_by_shard": {0: "a", 1: "b"},
+        "saturation_by_owner": {"a": 2.0, "b": 0.0},
+        "max_owner_saturation": 2.0,
+    })
+    assert "turn_queue_saturation 1.0" in text
+    assert "turn_queue_max_owner_saturation 2.0" in text
+    assert 'turn_queue_owner_saturation{consumer="a"} 2.0' in text
+    assert 'turn_queue_shard_pending{shard="0"} 12' in text
+
+
+def test_prometheus_without_shards_omits_owner_metrics():
+    text = format_prometheus({"pending": 0, "in_flight": 0, "workers": 1, "capacity": 8, "saturation": 0.0, "shards": 1})
+    assert "owner_saturation" not in text
+
+
+class FakeRedis:
+    """TurnWorkerPool 结算回合时用到的 Redis 命令（hash / list / pipeline）"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.lists = {}
+
+    async def exists(self, key):
+        return int(key in self.hashes or key in self.lists)
+
+    async def hincrby(self, key, field, amount):
+        value = int(self.hashes.setdefault(key, {}).get(field, 0)) + amount
+        self.hashes[key][field] = str(value)
+        return value
+
+    async def hget(self, key, field):
+        value = self.hashes.get(key, {}).get(field)
+        return value.encode() if value is not None else None
+
+    async def hset(self, key, field=None, value=None, mapping=None):
+        self.hashes.setdefault(key, {}).update(mapping or {field: value})
+
+    async def expire(self, key, seconds):
+        return 1
+
+    async def publish(self, channel, message):
+        return 0
+
+    async def lrem(self, key, count, value):
+        items = self.lists.get(key, [])
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    async def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value)
+
+    async def hgetall(self, key):
+        return {k.encode(): v.encode() for k, v in self.hashes.get(key, {}).items()}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self):
+        return FakePubSub()
+
+
+class FakePubSub:
+    """没有任何消息的订阅（模拟终态事件丢失或回合卡住）"""
+
+    async def subscribe(self, channel):
+        pass
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        await asyncio.sleep(timeout)
+        return None
+
+    async def unsubscribe(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    async def execute(self):
+        return [await getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+def test_turn_that_fails_outside_handler_is_requeued_then_failed():
+    async def scenario():
+        redis = FakeRedis()
+        queue = TurnQueue(redis, shards=1)
+        pool = TurnWorkerPool(queue, handler=None, concurrency=1)
+        pool._slots = asyncio.Semaphore(0)
+
+        async def broken_execute(turn_id):
+            raise ConnectionError("redis blip")
+        pool._execute = broken_execute
+
+        job_key = JOB_KEY.format(turn_id="t1")
+        redis.hashes[job_key] = {"status": "running", "queue": "turn_queue:pending"}
+        for attempt in range(1, TURN_JOB_MAX_ATTEMPTS + 1):
+            redis.lists[pool.processing_key] = [b"t1"]
+            redis.lists["turn_queue:pending"] = []
+            await pool._run(b"t1")
+            assert redis.lists[pool.processing_key] == []
+            if attempt < TURN_JOB_MAX_ATTEMPTS:
+                assert redis.lists["turn_queue:pending"] == [b"t1"]
+                assert redis.hashes[job_key]["status"] == "queued"
+
+        assert redis.lists["turn_queue:pending"] == []
+        assert redis.hashes[job_key]["status"] == "failed"
+        assert pool.requeued == TURN_JOB_MAX_ATTEMPTS - 1
+
+    asyncio.run(scenario())
+
+
+def test_subscribe_sends_keepalive_and_ends_when_job_expires():
+    async def scenario():
+        redis = FakeRedis()
+        queue = TurnQueue(redis, shards=1)
+        job_key = JOB_KEY.format(turn_id="t1")
+        redis.hashes[job_key] = {"turn_id": "t1", "session_id": "s", "status": "running"}
+
+        events = []
+        async for event in queue.subscribe("t1", keepalive=0.01, max_wait=5):
+            events.append(event)
+            if event.get("keepalive"):
+                redis.hashes.pop(job_key)  # 任务详情过期
+
+        assert [event["status"] for event in events] == ["running", "running", "failed"]
+        assert events[1]["keepalive"]
+        assert events[-1]["error_status"] == 404
+
+    asyncio.run(scenario())
+
+
+def test_subscribe_gives_up_after_max_wait():
+    async def scenario():
+        redis = FakeRedis()
+        queue = TurnQueue(redis, shards=1)
+        redis.hashes[JOB_KEY.format(turn_id="t1")] = {"turn_id": "t1", "session_id": "s", "status": "running"}
+
+        events = [event async for event in queue.subscribe("t1", keepalive=0.01, max_wait=0.05)]
+        assert events[-1]["status"] == "failed"
+        assert events[-1]["error_status"] == 504
+        assert all(event.get("keepalive") for event in events[1:-1])
+
+    asyncio.run(scenario())
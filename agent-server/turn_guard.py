@@ -0,0 +1,286 @@
+"""
+回合串行化与请求去重
+- 同一会话的回合串行执行：进程内 asyncio.Lock（先到先得）+ Redis 分布式锁（跨进程互斥，持有期间自动续期）
+- 幂等键：相同键的重复提交共享同一次执行结果；结果缓存在 Redis 中，重试请求不再调用 LLM
+- 未提供幂等键时按玩家输入生成指纹：只合并相同输入仍在排队或执行时的重复提交（防止连点、超时重试），
+  该回合完成后再次提交相同输入视为新的回合；每次执行的结果按执行令牌单独保存，等待方不会读到更早回合的结果
+"""
+
+import os
+import json
+import uuid
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+TURN_LOCK_TTL_MS = int(os.getenv("TURN_LOCK_TTL_MS", "180000"))
+TURN_LOCK_WAIT = float(os.getenv("TURN_LOCK_WAIT", "300"))  # 等待前一回合的最长秒数
+TURN_RESULT_TTL = int(os.getenv("TURN_RESULT_TTL", "600"))  # 显式幂等键的结果保留秒数
+TURN_AUTO_DEDUP_TTL = int(os.getenv("TURN_AUTO_DEDUP_TTL", "5"))  # 输入指纹的结果保留秒数（供等待方读取）
+
+LOCK_KEY = "turn:lock:{session_id}"
+INFLIGHT_KEY = "turn:inflight:{session_id}:{key}"
+RESULT_KEY = "turn:result:{session_id}:{key}"
+
+# 仅当锁仍由自己持有时才释放 / 续期
+_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+_RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class TurnBusyError(Exception):
+    """等待同一会话的其他回合超时"""
+
+
+def input_fingerprint(user_input: str) -> str:
+    return "auto:" + hashlib.sha1(user_input.strip().encode("utf-8")).hexdigest()
+
+
+class TurnGuard:
+    """每会话单飞（single-flight）执行器"""
+
+    def __init__(
+        self,
+        redis_client,
+        lock_ttl_ms: int = TURN_LOCK_TTL_MS,
+        lock_wait: float = TURN_LOCK_WAIT,
+        result_ttl: int = TURN_RESULT_TTL,
+        auto_dedup_ttl: int = TURN_AUTO_DEDUP_TTL,
+    ):
+        self.redis = redis_client
+        self.lock_ttl_ms = lock_ttl_ms
+        self.lock_wait = lock_wait
+        self.result_ttl = result_ttl
+        self.auto_dedup_ttl = auto_dedup_ttl
+
+        self._release = redis_client.register_script(_RELEASE_SCRIPT)
+        self._renew = redis_client.register_script(_RENEW_SCRIPT)
+        self._local_locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+
+        self.executed = 0
+        self.shared = 0
+        self.cached = 0
+        self.lock_waits = 0
+
+    # ============ 去重 ============
+
+    async def run(
+        self,
+        session_id: str,
+        idempotency_key: Optional[str],
+        user_input: str,
+        turn: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Dict[str, Any]:
+        """
+        执行一个回合（去重 + 串行化）
+
+        Args:
+            session_id: 会话 ID
+            idempotency_key: 客户端提供的幂等键（可选）
+            user_input: 玩家输入（无幂等键时用于生成指纹）
+            turn: 实际执行回合的协程函数，返回可 JSON 序列化的结果
+        """
+        explicit = bool(idempotency_key)
+        key = idempotency_key or input_fingerprint(user_input)
+        ttl = self.result_ttl if explicit else self.auto_dedup_ttl
+
+        # 1. 已完成的重复请求：直接返回缓存结果（仅显式幂等键；指纹只合并未完成的回合）
+        if explicit:
+            cached = await self._cached_result(session_id, key)
+            if cached is not None:
+                self.cached += 1
+                return cached
+
+        # 2. 本进程内正在执行的重复请求：共享同一结果
+        flight = (session_id, key)
+        if flight in self._inflight:
+            self.shared += 1
+            # 与跨进程等待一致：最多等待排队等锁 + 一次锁持有的时间
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(self._inflight[flight]),
+                    timeout=self.lock_wait + self.lock_ttl_ms / 1000
+                )
+            except asyncio.TimeoutError:
+                raise TurnBusyError("相同请求仍在处理中，请稍后重试")
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[flight] = future
+        try:
+            result = await self._run_once(session_id, key, ttl, explicit, turn)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            del self._inflight[flight]
+
+    async def _run_once(
+        self,
+        session_id: str,
+        key: str,
+        ttl: int,
+        explicit: bool,
+        turn
+    ) -> Dict[str, Any]:
+        """
+        跨进程单飞执行
+
+        inflight 标记的值为执行令牌，从提交（排队等锁）起一直保留到结果写入；
+        指纹的结果按令牌保存，显式幂等键的结果按键保存（重试时可直接命中）
+        """
+        inflight_key = INFLIGHT_KEY.format(session_id=session_id, key=key)
+        # 标记覆盖排队等锁 + 执行的最长时间
+        inflight_ttl_ms = int(self.lock_wait * 1000) + self.lock_ttl_ms
+        token = uuid.uuid4().hex
+
+        # 3. 其他进程正在排队或执行同一请求：等待其结果
+        while not await self.redis.set(inflight_key, token, px=inflight_ttl_ms, nx=True):
+            owner = await self.redis.get(inflight_key)
+            if owner is None:
+                continue
+            self.shared += 1
+            result_key = key if explicit else f"{key}:{_decode(owner)}"
+            result = await self._wait_for_result(session_id, result_key, inflight_key, owner)
+            if result is not None:
+                return result
+
+        try:
+            async with self.session_lock(session_id):
+                # 持锁后再检查一次：等待期间可能已由其他进程完成
+                if explicit:
+                    cached = await self._cached_result(session_id, key)
+                    if cached is not None:
+                        self.cached += 1
+                        return cached
+
+                result = await turn()
+                self.executed += 1
+                await self.redis.set(
+                    RESULT_KEY.format(session_id=session_id, key=key if explicit else f"{key}:{token}"),
+                    json.dumps(result, ensure_ascii=False, default=str),
+                    ex=ttl
+                )
+                return result
+        finally:
+            await self._release(keys=[inflight_key], args=[token])
+
+    async def _cached_result(self, session_id: str, key: str) -> Optional[Dict[str, Any]]:
+        cached = await self.redis.get(RESULT_KEY.format(session_id=session_id, key=key))
+        return json.loads(cached) if cached else None
+
+    async def _wait_for_result(
+        self,
+        session_id: str,
+        key: str,
+        inflight_key: str,
+        owner: bytes
+    ) -> Optional[Dict[str, Any]]:
+        """
+        等待其他进程的执行结果
+
+        执行方失败（inflight 标记消失或换了令牌但无结果）时返回 None，由调用方重新认领执行
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_wait
+        delay = 0.1
+        while loop.time() < deadline:
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 1.0)
+            cached = await self._cached_result(session_id, key)
+            if cached is not None:
+                return cached
+            if await self.redis.get(inflight_key) != owner:
+                # 结果先于标记释放写入：标记消失后再读一次，避免错过刚写入的结果
+                return await self._cached_result(session_id, key)
+        raise TurnBusyError("相同请求仍在处理中，请稍后重试")
+
+    # ============ 串行化 ============
+
+    @asynccontextmanager
+    async def session_lock(self, session_id: str):
+        """会话锁：同一会话的回合按到达顺序依次执行"""
+        local = self._acquire_local(session_id)
+        try:
+            if local.locked():
+                self.lock_waits += 1
+            try:
+                await asyncio.wait_for(local.acquire(), timeout=self.lock_wait)
+            except asyncio.TimeoutError:
+                raise TurnBusyError("上一回合仍在处理中，请稍后重试")
+            try:
+                token = await self._acquire_redis(session_id)
+                renewer = asyncio.create_task(self._keep_alive(session_id, token))
+                try:
+                    yield
+                finally:
+                    renewer.cancel()
+                    await self._release(keys=[LOCK_KEY.format(session_id=session_id)], args=[token])
+            finally:
+                local.release()
+        finally:
+            self._release_local(session_id)
+
+    def _acquire_local(self, session_id: str) -> asyncio.Lock:
+        lock, users = self._local_locks.get(session_id, (None, 0))
+        lock = lock or asyncio.Lock()
+        self._local_locks[session_id] = (lock, users + 1)
+        return lock
+
+    def _release_local(self, session_id: str):
+        lock, users = self._local_locks[session_id]
+        if users <= 1:
+            del self._local_locks[session_id]
+        else:
+            self._local_locks[session_id] = (lock, users - 1)
+
+    async def _acquire_redis(self, session_id: str) -> str:
+        key = LOCK_KEY.format(session_id=session_id)
+        token = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.lock_wait
+        delay = 0.05
+        while not await self.redis.set(key, token, px=self.lock_ttl_ms, nx=True):
+            if loop.time() >= deadline:
+                raise TurnBusyError("上一回合仍在处理中，请稍后重试")
+            self.lock_waits += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 0.5)
+        return token
+
+    async def _keep_alive(self, session_id: str, token: str):
+        key = LOCK_KEY.format(session_id=session_id)
+        while True:
+            await asyncio.sleep(self.lock_ttl_ms / 3000)
+            await self._renew(keys=[key], args=[token, self.lock_ttl_ms])
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "executed": self.executed,
+            "shared": self.shared,
+            "cached": self.cached,
+            "lock_waits": self.lock_waits,
+            "active_sessions": len(self._local_locks),
+        }
+
+
+def _decode(value: Any) -> Any:
+    return value.decode() if isinstance(value, bytes) else value
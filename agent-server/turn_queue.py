@@ -0,0 +1,628 @@
+"""
+异步回合队列
+提交回合后立即返回 turn_id，由工作协程从 Redis 队列中取出执行；
+客户端通过轮询或订阅（Redis pub/sub → SSE）获取状态与结果
+
+队列结构：
+- pending[:{shard}]：待执行的 turn_id 列表（有上限，超出时拒绝提交，形成背压）；
+  TURN_SHARDS > 1 时按剧本分片，每个 worker 优先消费一致性哈希环分配给它的分片，
+  自己的分片为空时从积压达到 TURN_STEAL_THRESHOLD 的其他分片窃取（热门剧本不受单个 worker 并发限制）
+- processing:{consumer}：各消费者正在执行的 turn_id，消费者心跳过期后由其他进程重新入队
+- members / workers：存活的消费者（心跳时间）及其并发与执行中回合数，用于分片分配和扩缩容指标
+- turn_job:{turn_id}：任务详情（hash），完成后保留 TURN_JOB_TTL 秒
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+import traceback
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from turn_sharding import TURN_SHARDS, ConsistentHashRing, shard_for
+
+
+TURN_QUEUE_MAX = int(os.getenv("TURN_QUEUE_MAX", "1000"))
+TURN_JOB_TTL = int(os.getenv("TURN_JOB_TTL", "3600"))
+TURN_WORKERS = int(os.getenv("TURN_WORKERS", "4"))  # 本进程的工作协程数，0 表示只提交不执行
+TURN_CONSUMER_HEARTBEAT = int(os.getenv("TURN_CONSUMER_HEARTBEAT", "10"))
+# 非本 worker 的分片积压达到该数量时，空闲 worker 从中窃取回合，0 表示不窃取
+TURN_STEAL_THRESHOLD = int(os.getenv("TURN_STEAL_THRESHOLD", "2"))
+TURN_EVENTS_KEEPALIVE = float(os.getenv("TURN_EVENTS_KEEPALIVE", "15"))  # 订阅无事件时的保活间隔（秒）
+TURN_EVENTS_MAX_WAIT = float(os.getenv("TURN_EVENTS_MAX_WAIT", "600"))  # 订阅的最长等待秒数
+# 回合在处理器之外出错（如 Redis 暂时不可用）时重新入队的次数上限，超出后标记为失败
+TURN_JOB_MAX_ATTEMPTS = int(os.getenv("TURN_JOB_MAX_ATTEMPTS", "3"))
+
+PENDING_KEY = "turn_queue:pending"
+SHARD_PENDING_KEY = "turn_queue:pending:{shard}"
+MEMBERS_KEY = "turn_queue:members"
+WORKERS_KEY = "turn_queue:workers"
+PROCESSING_KEY = "turn_queue:processing:{consumer}"
+CONSUMER_KEY = "turn_queue:consumer:{consumer}"
+JOB_KEY = "turn_job:{turn_id}"
+IDEMPOTENCY_KEY = "turn_job:idem:{session_id}:{key}"
+EVENTS_CHANNEL = "turn_job:{turn_id}:events"
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class TurnQueueFull(Exception):
+    """待执行回合过多"""
+
+
+class TurnQueue:
+    """回合任务队列（提交、查询、订阅）"""
+
+    def __init__(
+        self,
+        redis_client,
+        max_pending: int = TURN_QUEUE_MAX,
+        job_ttl: int = TURN_JOB_TTL,
+        shards: int = TURN_SHARDS,
+    ):
+        self.redis = redis_client
+        self.max_pending = max_pending
+        self.job_ttl = job_ttl
+        self.shards = max(1, shards)
+
+    # ============ 分片 ============
+
+    def pending_key(self, shard: int = 0) -> str:
+        return SHARD_PENDING_KEY.format(shard=shard) if self.shards > 1 else PENDING_KEY
+
+    def pending_keys(self) -> List[str]:
+        return [self.pending_key(shard) for shard in range(self.shards)]
+
+    def pending_key_for(self, story_id: Optional[str]) -> str:
+        """剧本所属分片的待执行队列"""
+        return self.pending_key(shard_for(story_id, self.shards) if story_id else 0)
+
+    # ============ 提交 ============
+
+    async def enqueue(
+        self,
+        session_id: str,
+        user_input: str,
+        idempotency_key: Optional[str] = None,
+        story_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """
+        提交回合
+
+        携带幂等键的重复提交返回同一个任务；分片模式下按 story_id 进入对应分片队列
+
+        Raises:
+            TurnQueueFull: 待执行回合已达上限
+        """
+        turn_id = uuid.uuid4().hex
+        if idempotency_key:
+            idem_key = IDEMPOTENCY_KEY.format(session_id=session_id, key=idempotency_key)
+            if not await self.redis.set(idem_key, turn_id, ex=self.job_ttl, nx=True):
+                existing = await self.get(_decode(await self.redis.get(idem_key)))
+                if existing:
+                    return existing
+                # 原任务已过期：改为指向新任务
+                await self.redis.set(idem_key, turn_id, ex=self.job_ttl)
+
+        pending_key = self.pending_key_for(story_id)
+        if await self.depth() >= self.max_pending:
+            if idempotency_key:
+                await self.redis.delete(idem_key)
+            raise TurnQueueFull("当前排队回合过多，请稍后重试")
+
+        job = {
+            "turn_id": turn_id,
+            "session_id": session_id,
+            "user_input": user_input,
+            "idempotency_key": idempotency_key or "",
+            "status": "queued",
+            "queue": pending_key,
+            "created_at": time.time(),
+        }
+        key = JOB_KEY.format(turn_id=turn_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={k: str(v) for k, v in job.items()})
+            pipe.expire(key, self.job_ttl)
+            pipe.rpush(pending_key, turn_id)
+            await pipe.execute()
+        await self._publish(turn_id, {"status": "queued"})
+        return self._public(job)
+
+    # ============ 查询 ============
+
+    async def get(self, turn_id: str) -> Optional[Dict[str, Any]]:
+        """获取任务状态（完成后包含 result，失败时包含 error）"""
+        raw = await self.redis.hgetall(JOB_KEY.format(turn_id=turn_id))
+        if not raw:
+            return None
+        return self._public({_decode(k): _decode(v) for k, v in raw.items()})
+
+    async def subscribe(
+        self,
+        turn_id: str,
+        keepalive: float = TURN_EVENTS_KEEPALIVE,
+        max_wait: float = TURN_EVENTS_MAX_WAIT,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        订阅任务状态变化，直到完成或失败
+
+        先订阅再读取当前状态，避免错过订阅前发生的变化；
+        keepalive 秒内没有事件时重新读取任务详情（错过终态事件时据此结束），并产出 keepalive 事件；
+        任务已过期或超过 max_wait 时以 failed 结束，不会无限占用连接
+        """
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(EVENTS_CHANNEL.format(turn_id=turn_id))
+        try:
+            job = await self.get(turn_id)
+            if job is None:
+                return
+            yield job
+            if job["status"] in TERMINAL_STATUSES:
+                return
+
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + max_wait
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    yield _failed_event(turn_id, "等待回合结果超时，可稍后查询回合状态", 504)
+                    return
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=min(keepalive, remaining)
+                )
+                if message is None:
+                    job = await self.get(turn_id)
+                    if job is None:
+                        yield _failed_event(turn_id, "回合不存在或已过期", 404)
+                        return
+                    if job["status"] in TERMINAL_STATUSES:
+                        yield job
+                        return
+                    yield {"turn_id": turn_id, "status": job["status"], "keepalive": True}
+                    continue
+                if message.get("type") != "message":
+                    continue
+                event = json.loads(message["data"])
+                if event["status"] in TERMINAL_STATUSES:
+                    # 终态从任务详情读取完整结果
+                    yield await self.get(turn_id) or event
+                    return
+                yield event
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+    async def depth(self) -> int:
+        """所有分片的待执行回合总数"""
+        return sum(await self._shard_depths())
+
+    async def _shard_depths(self) -> List[int]:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in self.pending_keys():
+                pipe.llen(key)
+            return await pipe.execute()
+
+    async def metrics(self) -> Dict[str, Any]:
+        """
+        扩缩容指标
+
+        saturation =（排队 + 执行中）/ 总并发，持续大于 1 说明 worker 不足；
+        分片模式下另按 worker 统计（所属分片的排队 + 其执行中）/ 其并发，
+        max_owner_saturation 持续大于 1 说明热门分片的积压超出了窃取能消化的量
+        """
+        depths = await self._shard_depths()
+        workers = await live_workers(self.redis)
+        pending = sum(depths)
+        in_flight = sum(worker["in_flight"] for worker in workers.values())
+        capacity = sum(worker["concurrency"] for worker in workers.values())
+        result = {
+            "pending": pending,
+            "in_flight": in_flight,
+            "workers": len(workers),
+            "capacity": capacity,
+            "saturation": _saturation(pending + in_flight, capacity),
+            "shards": self.shards,
+        }
+        if self.shards > 1:
+            result["pending_by_shard"] = dict(enumerate(depths))
+            owners = ConsistentHashRing(workers).assignments(self.shards)
+            result["owner_by_shard"] = owners
+            result["saturation_by_owner"] = {
+                consumer: _saturation(
+                    sum(depths[shard] for shard, owner in owners.items() if owner == consumer) + worker["in_flight"],
+                    worker["concurrency"]
+                )
+                for consumer, worker in workers.items()
+            }
+            values = [value for value in result["saturation_by_owner"].values() if value is not None]
+            result["max_owner_saturation"] = max(values) if values else None
+        return result
+
+    # ============ 状态更新（工作协程调用） ============
+
+    async def mark(self, turn_id: str, status: str, **fields: Any):
+        key = JOB_KEY.format(turn_id=turn_id)
+        values = {"status": status, f"{status}_at": str(time.time())}
+        for name, value in fields.items():
+            values[name] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+        await self.redis.hset(key, mapping=values)
+        await self.redis.expire(key, self.job_ttl)
+        await self._publish(turn_id, {"turn_id": turn_id, "status": status})
+
+    async def _publish(self, turn_id: str, event: Dict[str, Any]):
+        await self.redis.publish(
+            EVENTS_CHANNEL.format(turn_id=turn_id),
+            json.dumps({"turn_id": turn_id, **event}, ensure_ascii=False)
+        )
+
+    @staticmethod
+    def _public(job: Dict[str, Any]) -> Dict[str, Any]:
+        result = {
+            "turn_id": job["turn_id"],
+            "session_id": job.get("session_id"),
+            "status": job["status"],
+        }
+        if job.get("result"):
+            result["result"] = json.loads(job["result"]) if isinstance(job["result"], str) else job["result"]
+        if job.get("error"):
+            result["error"] = job["error"]
+            result["error_status"] = int(job.get("error_status") or 500)
+        return result
+
+
+class TurnWorkerPool:
+    """
+    回合工作协程池
+
+    handler(job) 执行回合并返回结果；分发协程在有空闲并发槽时用 (B)LMOVE 将任务移入本消费者的
+    processing 列表，执行结束后移除，进程崩溃时由其他进程在心跳过期后重新入队。
+    分片模式下每次心跳按一致性哈希环重新计算本消费者负责的分片；负责的分片为空时
+    从积压的其他分片队首窃取回合（同一会话的回合仍由会话锁串行执行）
+    """
+
+    def __init__(
+        self,
+        queue: TurnQueue,
+        handler: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+        concurrency: int = TURN_WORKERS,
+        steal_threshold: int = TURN_STEAL_THRESHOLD,
+    ):
+        self.queue = queue
+        self.steal_threshold = steal_threshold
+        self.redis = queue.redis
+        self.handler = handler
+        self.concurrency = concurrency
+        self.consumer = uuid.uuid4().hex[:12]
+        self.processing_key = PROCESSING_KEY.format(consumer=self.consumer)
+        self.owned_keys: List[str] = [] if queue.shards > 1 else [PENDING_KEY]
+        self._tasks: List[asyncio.Task] = []
+        self._running: set = set()
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._cursor = 0
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.stolen = 0
+        self.requeued = 0
+
+    async def start(self):
+        if self.concurrency <= 0 or self._tasks:
+            return
+        self._slots = asyncio.Semaphore(self.concurrency)
+        await self._heartbeat_once()
+        await self.recover_orphans()
+        self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
+        self._tasks.append(asyncio.create_task(self._dispatch_loop()))
+
+    async def stop(self):
+        """停止工作协程（执行中的回合被取消，留在 processing 中由其他进程恢复）"""
+        tasks = self._tasks + list(self._running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        if self.concurrency <= 0:
+            return
+        # 删除心跳并退出哈希环，让其他进程尽快接管分片、恢复被中断的回合
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(CONSUMER_KEY.format(consumer=self.consumer))
+            pipe.zrem(MEMBERS_KEY, self.consumer)
+            pipe.hdel(WORKERS_KEY, self.consumer)
+            await pipe.execute()
+
+    # ============ 分发与执行 ============
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._slots.acquire()
+            try:
+                turn_id = await self._next_turn()
+            except asyncio.CancelledError:
+                self._slots.release()
+                raise
+            except Exception:
+                self._slots.release()
+                traceback.print_exc()
+                await asyncio.sleep(1)
+                continue
+            if turn_id is None:
+                self._slots.release()
+                continue
+            task = asyncio.create_task(self._run(turn_id))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _next_turn(self) -> Optional[bytes]:
+        """
+        从负责的队列取出一个回合
+
+        只有一个队列时阻塞等待；多个分片时轮询（空闲时逐步退避），避免为每个分片各开一组协程；
+        负责的分片都为空时尝试窃取
+        """
+        keys = self.owned_keys
+        if not keys:
+            # 暂未分到分片（等待下一次心跳重新分配），期间仍可窃取
+            turn_id = await self._steal()
+            if turn_id is None:
+                await asyncio.sleep(1)
+            return turn_id
+        if len(keys) == 1 and self.queue.shards <= 1:
+            return await self.redis.blmove(keys[0], self.processing_key, 1, "LEFT", "RIGHT")
+
+        delay = 0.05
+        for _ in range(20):
+            for offset in range(len(keys)):
+                key = keys[(self._cursor + offset) % len(keys)]
+                turn_id = await self.redis.lmove(key, self.processing_key, "LEFT", "RIGHT")
+                if turn_id is not None:
+                    # 下次从下一个分片开始，避免某个分片饿死其他分片
+                    self._cursor = (self._cursor + offset + 1) % len(keys)
+                    return turn_id
+            turn_id = await self._steal()
+            if turn_id is not None:
+                return turn_id
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.5, 0.5)
+            if keys is not self.owned_keys:
+                break  # 分片已重新分配
+        return None
+
+    async def _steal(self) -> Optional[bytes]:
+        """从积压最多的非本消费者分片队首取出一个回合"""
+        if self.queue.shards <= 1 or self.steal_threshold <= 0:
+            return None
+        owned = set(self.owned_keys)
+        depths = await self.queue._shard_depths()
+        candidates = sorted(
+            (
+                (depth, key)
+                for key, depth in zip(self.queue.pending_keys(), depths)
+                if key not in owned and depth >= self.steal_threshold
+            ),
+            reverse=True
+        )
+        for _, key in candidates:
+            turn_id = await self.redis.lmove(key, self.processing_key, "LEFT", "RIGHT")
+            if turn_id is not None:
+                self.stolen += 1
+                return turn_id
+        return None
+
+    async def _run(self, turn_id: bytes):
+        try:
+            try:
+                await self._execute(_decode(turn_id))
+                requeue = False
+            except asyncio.CancelledError:
+                raise  # 留在 processing 中，由其他进程在心跳过期后恢复
+            except Exception:
+                traceback.print_exc()
+                requeue = True
+            await self._settle(turn_id, requeue)
+        finally:
+            self._slots.release()
+
+    async def _settle(self, turn_id: bytes, requeue: bool):
+        """
+        将回合移出 processing
+
+        处理器之外出错时放回原队列队首（超过 TURN_JOB_MAX_ATTEMPTS 次则标记为失败）；
+        Redis 暂时不可用时退避重试，直到回合重新入队或进入终态后移出
+        """
+        delay = 0.5
+        while True:
+            try:
+                if requeue:
+                    await self._requeue(_decode(turn_id), turn_id)
+                else:
+                    await self.redis.lrem(self.processing_key, 1, turn_id)
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    async def _requeue(self, turn_id: str, raw_id: bytes):
+        key = JOB_KEY.format(turn_id=turn_id)
+        if not await self.redis.exists(key):
+            await self.redis.lrem(self.processing_key, 1, raw_id)  # 任务已过期
+            return
+        attempts = await self.redis.hincrby(key, "attempts", 1)
+        if attempts >= TURN_JOB_MAX_ATTEMPTS:
+            await self.queue.mark(turn_id, "failed", error="回合执行失败次数过多", error_status="500")
+            await self.redis.lrem(self.processing_key, 1, raw_id)
+            self.failed += 1
+            return
+
+        target = _decode(await self.redis.hget(key, "queue")) or PENDING_KEY
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, "status", "queued")
+            pipe.lrem(self.processing_key, 1, raw_id)
+            pipe.lpush(target, raw_id)
+            await pipe.execute()
+        self.requeued += 1
+        print(f"♻️  重新入队回合 {turn_id}（第 {attempts} 次执行出错）")
+
+    async def _execute(self, turn_id: str):
+        raw = await self.redis.hgetall(JOB_KEY.format(turn_id=turn_id))
+        if not raw:
+            return  # 任务已过期
+        job = {_decode(k): _decode(v) for k, v in raw.items()}
+        if job["status"] in TERMINAL_STATUSES:
+            return  # 恢复时重复入队的已完成任务
+
+        self.in_flight += 1
+        await self.queue.mark(turn_id, "running", consumer=self.consumer)
+        try:
+            result = await self.handler(job)
+            await self.queue.mark(turn_id, "completed", result=result)
+            self.completed += 1
+        except Exception as e:
+            await self.queue.mark(
+                turn_id,
+                "failed",
+                error=getattr(e, "detail", None) or str(e),
+                error_status=str(getattr(e, "status_code", 500))
+            )
+            self.failed += 1
+        finally:
+            self.in_flight -= 1
+
+    # ============ 心跳、分片分配与恢复 ============
+
+    async def _heartbeat_once(self):
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(CONSUMER_KEY.format(consumer=self.consumer), "1", ex=TURN_CONSUMER_HEARTBEAT * 3)
+            pipe.zadd(MEMBERS_KEY, {self.consumer: now})
+            pipe.hset(WORKERS_KEY, self.consumer, json.dumps({
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "owned_keys": self.owned_keys,
+            }))
+            await pipe.execute()
+        await self._rebalance()
+
+    async def _rebalance(self):
+        """按存活成员重建哈希环，更新本消费者负责的分片"""
+        if self.queue.shards <= 1:
+            return
+        members = list(await live_workers(self.redis))
+        ring = ConsistentHashRing(members)
+        owned = [self.queue.pending_key(shard) for shard in ring.owned_shards(self.consumer, self.queue.shards)]
+        if owned != self.owned_keys:
+            print(f"🔀 消费者 {self.consumer} 负责分片: {len(owned)}/{self.queue.shards}（存活 worker {len(members)}）")
+            self.owned_keys = owned
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(TURN_CONSUMER_HEARTBEAT)
+            try:
+                await self._heartbeat_once()
+                await self.recover_orphans()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+
+    async def recover_orphans(self):
+        """将心跳已过期的消费者 processing 列表中的任务放回其原队列的队首"""
+        async for key in self.redis.scan_iter(match=PROCESSING_KEY.format(consumer="*")):
+            key = _decode(key)
+            consumer = key.rsplit(":", 1)[-1]
+            if consumer == self.consumer or await self.redis.exists(CONSUMER_KEY.format(consumer=consumer)):
+                continue
+            while True:
+                turn_id = await self.redis.lindex(key, -1)
+                if turn_id is None:
+                    break
+                target = _decode(await self.redis.hget(JOB_KEY.format(turn_id=_decode(turn_id)), "queue"))
+                await self.redis.lmove(key, target or PENDING_KEY, "RIGHT", "LEFT")
+                print(f"♻️  重新入队回合 {_decode(turn_id)}（消费者 {consumer} 已失联）")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "consumer": self.consumer,
+            "concurrency": self.concurrency,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "stolen": self.stolen,
+            "requeued": self.requeued,
+            "owned_shards": len(self.owned_keys) if self.queue.shards > 1 else None,
+        }
+
+
+async def live_workers(redis_client) -> Dict[str, Dict[str, Any]]:
+    """
+    存活的消费者及其并发 / 执行中回合数
+
+    顺带清理心跳超时的成员（崩溃的进程来不及自行退出哈希环）
+    """
+    expired_before = time.time() - TURN_CONSUMER_HEARTBEAT * 3
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.zremrangebyscore(MEMBERS_KEY, "-inf", expired_before)
+        pipe.zrange(MEMBERS_KEY, 0, -1)
+        pipe.hgetall(WORKERS_KEY)
+        _, members, info = await pipe.execute()
+
+    members = {_decode(member) for member in members}
+    info = {_decode(k): json.loads(v) for k, v in info.items()}
+    stale = [consumer for consumer in info if consumer not in members]
+    if stale:
+        await redis_client.hdel(WORKERS_KEY, *stale)
+    return {
+        consumer: info.get(consumer, {"concurrency": 0, "in_flight": 0})
+        for consumer in sorted(members)
+    }
+
+
+def _failed_event(turn_id: str, error: str, status_code: int) -> Dict[str, Any]:
+    return {"turn_id": turn_id, "status": "failed", "error": error, "error_status": status_code}
+
+
+def _saturation(load: int, capacity: int) -> Optional[float]:
+    return round(load / capacity, 3) if capacity else None
+
+
+def format_prometheus(metrics: Dict[str, Any]) -> str:
+    """将扩缩容指标格式化为 Prometheus 文本格式"""
+    gauges = [
+        ("turn_queue_pending", "排队中的回合数", "pending"),
+        ("turn_queue_in_flight", "执行中的回合数", "in_flight"),
+        ("turn_queue_workers", "存活的回合 worker 数", "workers"),
+        ("turn_queue_capacity", "所有 worker 的并发总数", "capacity"),
+        ("turn_queue_saturation", "（排队 + 执行中）/ 并发总数", "saturation"),
+        ("turn_queue_max_owner_saturation", "各 worker（所属分片排队 + 执行中）/ 并发的最大值", "max_owner_saturation"),
+    ]
+    lines = []
+    for name, help_text, field in gauges:
+        if metrics.get(field) is None:
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {metrics[field]}"]
+    if metrics.get("pending_by_shard"):
+        lines += ["# HELP turn_queue_shard_pending 各分片排队中的回合数", "# TYPE turn_queue_shard_pending gauge"]
+        lines += [
+            f'turn_queue_shard_pending{{shard="{shard}"}} {depth}'
+            for shard, depth in metrics["pending_by_shard"].items()
+        ]
+    if metrics.get("saturation_by_owner"):
+        lines += [
+            "# HELP turn_queue_owner_saturation 各 worker（所属分片排队 + 执行中）/ 并发",
+            "# TYPE turn_queue_owner_saturation gauge",
+        ]
+        lines += [
+            f'turn_queue_owner_saturation{{consumer="{consumer}"}} {value}'
+            for consumer, value in metrics["saturation_by_owner"].items()
+            if value is not None
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def _decode(value: Any) -> Any:
+    return value.decode() if isinstance(value, bytes) else value
@@ -0,0 +1,55 @@
+"""
+回合分片
+- 剧本按稳定哈希映射到固定数量的分片（TURN_SHARDS），每个分片对应一个待执行队列
+- 分片通过一致性哈希环分配给存活的 worker：同一剧本的回合总由同一 worker 执行，
+  复用其 Agent Crew 与剧本配置缓存；worker 增减时只有约 1/n 的分片迁移
+"""
+
+import os
+import bisect
+import hashlib
+from typing import Dict, Iterable, List, Optional
+
+
+TURN_SHARDS = int(os.getenv("TURN_SHARDS", "1"))  # 1 表示不分片，所有 worker 共用一个队列
+TURN_RING_REPLICAS = int(os.getenv("TURN_RING_REPLICAS", "100"))  # 每个 worker 的虚拟节点数
+
+
+def stable_hash(value: str) -> int:
+    # 不使用内置 hash()：其结果随进程随机化，无法跨进程一致
+    return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+
+def shard_for(story_id: str, shards: int = TURN_SHARDS) -> int:
+    """剧本所属分片"""
+    return stable_hash(story_id) % shards if shards > 1 else 0
+
+
+class ConsistentHashRing:
+    """一致性哈希环（带虚拟节点）"""
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = TURN_RING_REPLICAS):
+        self.replicas = replicas
+        self.nodes = sorted(set(nodes))
+
+        points = sorted(
+            (stable_hash(f"{node}#{i}"), node)
+            for node in self.nodes
+            for i in range(replicas)
+        )
+        self._points: List[int] = [point for point, _ in points]
+        self._owners: List[str] = [node for _, node in points]
+
+    def node_for(self, key: str) -> Optional[str]:
+        """key 顺时针方向的第一个节点"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, stable_hash(key)) % len(self._points)
+        return self._owners[index]
+
+    def assignments(self, shards: int) -> Dict[int, Optional[str]]:
+        """各分片的所属节点"""
+        return {shard: self.node_for(f"shard:{shard}") for shard in range(shards)}
+
+    def owned_shards(self, node: str, shards: int) -> List[int]:
+        return [shard for shard, owner in self.assignments(shards).items() if owner == node]
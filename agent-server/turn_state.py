@@ -0,0 +1,197 @@
+"""
+回合状态增量
+将 Agent 解析出的回合结果转换为数据库可直接写入的增量，
+增量中均为写入后的绝对值，重复应用结果一致（可安全重放）
+"""
+
+import copy
+from typing import Dict, Any, List, Optional, Tuple
+
+from story_registry import StoryDefinition, get_story_registry
+
+
+# judge 输出状态 → situation_states.status
+SITUATION_STATUS_MAP = {
+    "in_progress": "in_progress",
+    "success": "completed",
+    "completed": "completed",
+    "failed": "failed",
+}
+
+CHARACTER_STATUSES = ("alive", "dead", "missing", "imprisoned")
+
+# 局势已结束的状态（judge 使用 success/failed，数据库使用 completed/failed）
+FINISHED_STATUSES = ("success", "completed", "failed")
+
+
+def build_turn_delta(
+    session: Dict[str, Any],
+    result: Dict[str, Any],
+    story: Optional[StoryDefinition] = None
+) -> Dict[str, Any]:
+    """
+    根据会话快照和回合结果生成状态增量
+
+    Args:
+        session: 会话快照（见 DatabaseManager.get_session_snapshot）
+        result: 回合结果（situation_update / character_updates / chapter_status）
+        story: 剧本定义，为空时按 session["story_id"] 从注册表获取
+
+    Returns:
+        {
+            "situation": {"situation_id": ..., "score": ..., "status": ...} | None,
+            "characters": [{"character_name": ..., "status": ..., "attributes": {...}}],
+            "session": {"current_chapter": ..., "current_situation": ...} | {"is_completed": True} | {},
+            "new_situations": [situation_states 初始行]  # 进入新章节时创建
+        }
+    """
+    if story is None and session.get("story_id"):
+        story = get_story_registry().get(session["story_id"])
+
+    situation = _situation_delta(session, result.get("situation_update"))
+    session_delta, new_situations = _progress_delta(session, situation, result.get("chapter_status"), story)
+    return {
+        "situation": situation,
+        "characters": [
+            delta
+            for delta in (
+                _character_delta(session, update)
+                for update in result.get("character_updates") or []
+            )
+            if delta
+        ],
+        "session": session_delta,
+        "new_situations": new_situations
+    }
+
+
+def _situation_delta(
+    session: Dict[str, Any],
+    update: Optional[Dict[str, Any]]
+) -> Optional[Dict[str, Any]]:
+    if not update:
+        return None
+
+    situation_id = update.get("situation_id") or session.get("current_situation")
+    if not situation_id:
+        return None
+
+    delta: Dict[str, Any] = {"situation_id": situation_id}
+    current = session.get("situations", {}).get(situation_id, {})
+
+    if isinstance(update.get("new_score"), (int, float)):
+        delta["score"] = int(update["new_score"])
+    elif isinstance(update.get("score_change"), (int, float)):
+        delta["score"] = int(current.get("score") or 0) + int(update["score_change"])
+
+    status = SITUATION_STATUS_MAP.get(update.get("status"))
+    if status:
+        delta["status"] = status
+
+    return delta if len(delta) > 1 else None
+
+
+def _character_delta(
+    session: Dict[str, Any],
+    update: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    name = update.get("character_name") if isinstance(update, dict) else None
+    if not name:
+        return None
+
+    current = session.get("characters", {}).get(name, {})
+    delta: Dict[str, Any] = {"character_name": name}
+
+    if update.get("status") in CHARACTER_STATUSES:
+        delta["status"] = update["status"]
+
+    changes = update.get("attribute_changes") or {}
+    if changes:
+        attributes = dict(current.get("attributes") or {})
+        for key, change in changes.items():
+            if isinstance(change, (int, float)):
+                base = attributes.get(key, 0)
+                attributes[key] = (base if isinstance(base, (int, float)) else 0) + change
+        delta["attributes"] = attributes
+
+    return delta if len(delta) > 1 else None
+
+
+def _progress_delta(
+    session: Dict[str, Any],
+    situation: Optional[Dict[str, Any]],
+    chapter_status: Optional[str],
+    story: Optional[StoryDefinition]
+) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    章节与当前局势的推进
+
+    - 进入下一章时创建该章的局势行，并把当前局势切到该章第一个主要局势
+    - 当前局势已结束（或不属于当前章节）时切到本章下一个未结束的主要局势
+    - 当前章节缺少的局势行一并补齐（修复推进时未创建局势的旧会话）
+    """
+    if chapter_status == "ending":
+        return {"is_completed": True}, []
+
+    chapter = session["current_chapter"]
+    session_delta: Dict[str, Any] = {}
+    if chapter_status == "next_chapter":
+        chapter = (story.next_chapter(chapter) if story else None) or chapter + 1
+        session_delta["current_chapter"] = chapter
+    if story is None:
+        return session_delta, []
+
+    existing = session.get("situations", {})
+    new_situations = [
+        row
+        for row in story.situation_rows(session["id"], chapter)
+        if row["situation_id"] not in existing
+    ]
+
+    statuses = {situation_id: state.get("status") for situation_id, state in existing.items()}
+    if situation and situation.get("status"):
+        statuses[situation["situation_id"]] = situation["status"]
+    current = session.get("current_situation")
+    if story.situation_chapter.get(current) != chapter or statuses.get(current) in FINISHED_STATUSES:
+        focus = story.focus_situation(
+            chapter,
+            finished=[situation_id for situation_id, status in statuses.items() if status in FINISHED_STATUSES]
+        )
+        if focus and focus != current:
+            session_delta["current_situation"] = focus
+
+    return session_delta, new_situations
+
+
+def is_empty_delta(delta: Dict[str, Any]) -> bool:
+    return not (
+        delta.get("situation")
+        or delta.get("characters")
+        or delta.get("session")
+        or delta.get("new_situations")
+    )
+
+
+def apply_delta_to_snapshot(
+    snapshot: Dict[str, Any],
+    delta: Dict[str, Any]
+) -> Dict[str, Any]:
+    """将增量合并进会话快照（返回新快照，不修改原对象）"""
+    snapshot = copy.deepcopy(snapshot)
+
+    for row in delta.get("new_situations") or []:
+        snapshot.setdefault("situations", {}).setdefault(row["situation_id"], dict(row))
+
+    situation = delta.get("situation")
+    if situation:
+        situations = snapshot.setdefault("situations", {})
+        state = situations.setdefault(situation["situation_id"], {"situation_id": situation["situation_id"]})
+        state.update(situation)
+
+    for character in delta.get("characters") or []:
+        characters = snapshot.setdefault("characters", {})
+        state = characters.setdefault(character["character_name"], {"character_name": character["character_name"]})
+        state.update(character)
+
+    snapshot.update(delta.get("session") or {})
+    return snapshot
@@ -0,0 +1,261 @@
+"""
+进程内向量索引
+每个剧本一份归一化嵌入矩阵，检索为一次矩阵-向量点积（余弦相似度），
+语料小且几乎只读，精确检索即可在亚毫秒内完成；
+写入新知识时增量追加，无需重建；
+其他进程（API / worker）写入的知识按 created_at 水位定期增量拉取
+"""
+
+import os
+import json
+import time
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import numpy as np
+
+
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "true").lower() == "true"
+# 单个剧本超过该条数时不建本地索引，改用数据库检索
+VECTOR_INDEX_MAX_ROWS = int(os.getenv("VECTOR_INDEX_MAX_ROWS", "50000"))
+# 增量拉取其他进程写入条目的间隔（秒），0 表示不拉取
+VECTOR_INDEX_REFRESH_SECONDS = float(os.getenv("VECTOR_INDEX_REFRESH_SECONDS", "30"))
+# 增量拉取时水位回退的秒数（覆盖提交晚于 created_at 的事务）
+VECTOR_INDEX_REFRESH_OVERLAP = 60
+
+# 随索引保存、随检索结果返回的字段
+INDEX_FIELDS = ("id", "character_name", "content", "content_type", "metadata")
+
+
+def _as_vector(embedding: Any) -> np.ndarray:
+    # PostgREST 以字符串形式返回 pgvector 列
+    if isinstance(embedding, str):
+        embedding = json.loads(embedding)
+    return np.asarray(embedding, dtype=np.float32)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+class StoryVectorIndex:
+    """单个剧本的向量索引"""
+
+    def __init__(self, story_id: str):
+        self.story_id = story_id
+        self._matrix: Optional[np.ndarray] = None
+        self._size = 0
+        self._rows: List[Dict[str, Any]] = []
+        self._ids = set()
+        # 从数据库加载到的最新 created_at（增量拉取的起点）
+        self.watermark: Optional[str] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, rows: List[Dict[str, Any]]):
+        """追加知识条目（需包含 embedding，已存在的 id 跳过）"""
+        rows = [
+            row for row in rows
+            if row.get("embedding") is not None and (row.get("id") is None or row["id"] not in self._ids)
+        ]
+        if not rows:
+            return
+        self._ids.update(row["id"] for row in rows if row.get("id") is not None)
+
+        vectors = _normalize(np.stack([_as_vector(row["embedding"]) for row in rows]))
+        self._reserve(self._size + len(rows), vectors.shape[1])
+        self._matrix[self._size:self._size + len(rows)] = vectors
+        self._size += len(rows)
+        self._rows.extend({field: row.get(field) for field in INDEX_FIELDS} for row in rows)
+
+    def _reserve(self, size: int, dim: int):
+        # 容量翻倍扩展，增量写入均摊 O(1)
+        if self._matrix is None:
+            self._matrix = np.empty((max(size, 64), dim), dtype=np.float32)
+        elif self._matrix.shape[1] != dim:
+            raise ValueError(f"嵌入维度不一致: {self._matrix.shape[1]} != {dim}")
+        elif size > self._matrix.shape[0]:
+            matrix = np.empty((max(size, self._matrix.shape[0] * 2), dim), dtype=np.float32)
+            matrix[:self._size] = self._matrix[:self._size]
+            self._matrix = matrix
+
+    def search(
+        self,
+        query_embedding: List[float],
+        limit: int = 5,
+        threshold: float = 0.0,
+        content_type: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        检索最相似的条目
+
+        Returns:
+            与 match_character_knowledge 相同的结构（附加 similarity）
+        """
+        if self._size == 0:
+            return []
+
+        query = _normalize(_as_vector(query_embedding))
+        scores = self._matrix[:self._size] @ query
+
+        if content_type is not None:
+            mask = np.fromiter(
+                (row["content_type"] == content_type for row in self._rows),
+                dtype=bool,
+                count=self._size
+            )
+            scores = np.where(mask, scores, -np.inf)
+
+        if limit < self._size:
+            candidates = np.argpartition(-scores, limit)[:limit]
+        else:
+            candidates = np.arange(self._size)
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        return [
+            {**self._rows[i], "similarity": float(scores[i])}
+            for i in candidates
+            if scores[i] > threshold
+        ]
+
+
+class VectorIndexRegistry:
+    """
+    按剧本懒加载的向量索引集合
+
+    loader(story_id, since) 返回剧本 created_at >= since（since 为空时为全部）的知识条目（含 embedding、created_at），
+    返回 None 或条目过多时该剧本不建索引，调用方回退到数据库检索
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str, Optional[str]], Awaitable[Optional[List[Dict[str, Any]]]]],
+        enabled: bool = VECTOR_INDEX_ENABLED,
+        max_rows: int = VECTOR_INDEX_MAX_ROWS,
+        refresh_seconds: float = VECTOR_INDEX_REFRESH_SECONDS,
+    ):
+        self.loader = loader
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.refresh_seconds = refresh_seconds
+        self._indexes: Dict[str, Optional[StoryVectorIndex]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refreshed_at: Dict[str, float] = {}
+        self.refreshes = 0
+        self.refreshed_rows = 0
+        # 加载期间写入的条目（加载结果可能不包含它们）
+        self._pending: Dict[str, List[Dict[str, Any]]] = {}
+
+    async def get(self, story_id: str) -> Optional[StoryVectorIndex]:
+        """获取剧本索引（首次访问时从数据库加载）"""
+        if not self.enabled:
+            return None
+        lock = self._locks.setdefault(story_id, asyncio.Lock())
+        if story_id in self._indexes:
+            index = self._indexes[story_id]
+            # 到期时增量拉取；已有其他请求在拉取时直接使用当前索引
+            if index is not None and self._refresh_due(story_id) and not lock.locked():
+                async with lock:
+                    await self._refresh(story_id, index)
+            return self._indexes[story_id]
+
+        async with lock:
+            if story_id not in self._indexes:
+                self._pending[story_id] = []
+                try:
+                    self._indexes[story_id] = await self._build(story_id)
+                    self._refreshed_at[story_id] = time.monotonic()
+                finally:
+                    self._pending.pop(story_id, None)
+            return self._indexes[story_id]
+
+    def _refresh_due(self, story_id: str) -> bool:
+        return (
+            self.refresh_seconds > 0
+            and time.monotonic() - self._refreshed_at.get(story_id, 0) >= self.refresh_seconds
+        )
+
+    async def _refresh(self, story_id: str, index: StoryVectorIndex):
+        """拉取水位之后写入的条目（其他进程写入的知识），失败时沿用当前索引"""
+        self._refreshed_at[story_id] = time.monotonic()
+        try:
+            rows = await self.loader(story_id, _rewind(index.watermark))
+        except Exception as e:
+            print(f"⚠️  剧本 {story_id} 向量索引增量拉取失败: {e}")
+            return
+        if rows is None:
+            return
+
+        size = len(index)
+        index.add(rows)
+        index.watermark = _max_created_at(rows, index.watermark)
+        self.refreshes += 1
+        self.refreshed_rows += len(index) - size
+        if len(index) > self.max_rows:
+            self._indexes[story_id] = None
+
+    async def _build(self, story_id: str) -> Optional[StoryVectorIndex]:
+        rows = await self.loader(story_id, None)
+        if rows is None or len(rows) > self.max_rows:
+            print(f"⚠️  剧本 {story_id} 不建本地向量索引，使用数据库检索")
+            return None
+
+        loaded_ids = {row.get("id") for row in rows}
+        rows += [row for row in self._pending.get(story_id, []) if row.get("id") not in loaded_ids]
+
+        index = StoryVectorIndex(story_id)
+        index.add(rows)
+        index.watermark = _max_created_at(rows, None)
+        print(f"✅ 剧本 {story_id} 向量索引已加载（{len(index)} 条）")
+        return index
+
+    def add(self, story_id: str, rows: List[Dict[str, Any]]):
+        """增量写入（仅更新已加载的索引，未加载的剧本下次访问时从数据库加载）"""
+        if story_id in self._pending:
+            self._pending[story_id].extend(rows)
+            return
+        index = self._indexes.get(story_id)
+        if index is None:
+            return
+        index.add(rows)
+        if len(index) > self.max_rows:
+            self._indexes[story_id] = None
+
+    def invalidate(self, story_id: str):
+        self._indexes.pop(story_id, None)
+        self._refreshed_at.pop(story_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "refresh_seconds": self.refresh_seconds,
+            "refreshes": self.refreshes,
+            "refreshed_rows": self.refreshed_rows,
+            "stories": {
+                story_id: len(index) if index is not None else None
+                for story_id, index in self._indexes.items()
+            },
+        }
+
+
+def _max_created_at(rows: List[Dict[str, Any]], current: Optional[str]) -> Optional[str]:
+    # PostgREST 返回的 timestamptz 格式一致，可直接按字符串比较
+    values = [row["created_at"] for row in rows if row.get("created_at")]
+    if current:
+        values.append(current)
+    return max(values) if values else None
+
+
+def _rewind(watermark: Optional[str]) -> Optional[str]:
+    """水位回退 VECTOR_INDEX_REFRESH_OVERLAP 秒（重复条目按 id 跳过）"""
+    if watermark is None:
+        return None
+    try:
+        moment = datetime.fromisoformat(watermark.replace("Z", "+00:00"))
+    except ValueError:
+        return watermark
+    return (moment - timedelta(seconds=VECTOR_INDEX_REFRESH_OVERLAP)).isoformat()
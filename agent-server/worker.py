@@ -0,0 +1,45 @@
+"""
+回合 Worker（编排层）
+独立于 HTTP 层运行：只从 Redis 回合队列取出回合、执行 Agent Crew 编排并写回结果，
+可与 HTTP 层分别扩缩容。TURN_SHARDS > 1 时各 worker 按一致性哈希分担剧本分片，
+同一剧本的回合落在同一 worker 上，复用其 Agent Crew 与剧本配置缓存
+
+启动：
+    python worker.py
+
+仅暴露 /health、/ready、/metrics（供探活与自动扩缩容）
+"""
+
+import os
+
+import main
+from fastapi import FastAPI
+
+
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "8"))  # 每个 worker 进程同时执行的回合数
+WORKER_PORT = int(os.getenv("WORKER_PORT", "8001"))
+
+# 在 main.startup() 创建工作协程池之前覆盖并发数（HTTP 层通常配置 TURN_WORKERS=0）
+main.turn_worker_concurrency = WORKER_CONCURRENCY
+
+worker_app = FastAPI(title="Mock Drama Turn Worker", version=main.app.version)
+
+
+@worker_app.on_event("startup")
+async def startup():
+    await main.startup()
+
+
+@worker_app.on_event("shutdown")
+async def shutdown():
+    await main.shutdown()
+
+
+worker_app.add_api_route("/health", main.health_check, methods=["GET"])
+worker_app.add_api_route("/ready", main.readiness_check, methods=["GET"])
+worker_app.add_api_route("/metrics", main.metrics, methods=["GET"])
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(worker_app, host="0.0.0.0", port=WORKER_PORT)
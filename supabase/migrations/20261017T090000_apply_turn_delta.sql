@@ -0,0 +1,55 @@
+-- 回合状态批量写入：一次调用在同一事务内更新局势、角色、会话
+-- p_delta 结构（见 agent-server/turn_state.py）：
+-- {
+--   "situation": {"situation_id": "...", "score": 10, "status": "in_progress"} | null,
+--   "characters": [{"character_name": "...", "status": "alive", "attributes": {...}}],
+--   "session": {"current_chapter": 2} | {"is_completed": true} | {}
+-- }
+-- 增量中均为写入后的绝对值，重复调用结果一致
+
+CREATE OR REPLACE FUNCTION apply_turn_delta(
+    p_session_id UUID,
+    p_delta JSONB
+)
+RETURNS VOID
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_situation JSONB := p_delta -> 'situation';
+    v_session JSONB := COALESCE(p_delta -> 'session', '{}'::jsonb);
+BEGIN
+    -- 锁定会话行，同一会话的回合写入串行化
+    PERFORM 1 FROM game_sessions WHERE id = p_session_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'session % not found', p_session_id;
+    END IF;
+
+    -- 局势
+    IF v_situation IS NOT NULL AND jsonb_typeof(v_situation) = 'object' THEN
+        UPDATE situation_states
+        SET score = COALESCE((v_situation ->> 'score')::INTEGER, score),
+            status = COALESCE(v_situation ->> 'status', status)
+        WHERE session_id = p_session_id
+          AND situation_id = v_situation ->> 'situation_id';
+    END IF;
+
+    -- 角色（一条语句更新所有变化的角色）
+    UPDATE character_states AS c
+    SET status = COALESCE(d.value ->> 'status', c.status),
+        attributes = COALESCE(d.value -> 'attributes', c.attributes)
+    FROM jsonb_array_elements(COALESCE(p_delta -> 'characters', '[]'::jsonb)) AS d(value)
+    WHERE c.session_id = p_session_id
+      AND c.character_name = d.value ->> 'character_name';
+
+    -- 会话
+    IF v_session <> '{}'::jsonb THEN
+        UPDATE game_sessions
+        SET current_chapter = COALESCE((v_session ->> 'current_chapter')::INTEGER, current_chapter),
+            is_completed = COALESCE((v_session ->> 'is_completed')::BOOLEAN, is_completed)
+        WHERE id = p_session_id;
+    END IF;
+END;
+$$;
+
+-- 刷新 PostgREST schema cache，使 RPC 立即可用
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,4 @@
+-- 历史消息 keyset 分页索引
+-- 查询：where session_id = ? [and (created_at, id) < (?, ?)] order by created_at desc, id desc limit ?
+CREATE INDEX IF NOT EXISTS idx_chat_messages_session_created
+    ON chat_messages (session_id, created_at DESC, id DESC);
@@ -0,0 +1,187 @@
+-- 统一嵌入维度并为向量列建立 HNSW 索引
+-- 本地模型 paraphrase-multilingual-MiniLM-L12-v2 输出 384 维（agent-server 的 EMBEDDING_DIM），
+-- 更换模型时需同步修改本文件中的 384 并重新生成嵌入
+-- 注意：维度不一致的已有嵌入无法转换，迁移会将其置空，需重新生成
+
+create extension if not exists vector;
+
+-- ============ 角色知识库 ============
+
+create table if not exists public.character_knowledge (
+    id uuid primary key default gen_random_uuid(),
+    story_id text not null,
+    session_id uuid,
+    character_name text not null,
+    content_type text not null default 'character_profile',
+    content text,
+    background text,
+    personality text,
+    relationships jsonb not null default '{}'::jsonb,
+    current_state jsonb not null default '{}'::jsonb,
+    metadata jsonb not null default '{}'::jsonb,
+    embedding vector(384),
+    created_at timestamptz not null default timezone('utc', now())
+);
+
+alter table public.character_knowledge
+    add column if not exists session_id uuid;
+
+-- 维度不一致时改为 384 维（旧嵌入置空）
+do $$
+begin
+    if exists (
+        select 1 from pg_attribute
+        where attrelid = 'public.character_knowledge'::regclass
+          and attname = 'embedding'
+          and atttypmod <> 384
+    ) then
+        raise notice 'character_knowledge.embedding 维度变更为 384，已有嵌入需重新生成';
+        alter table public.character_knowledge
+            alter column embedding type vector(384) using null;
+    end if;
+end;
+$$;
+
+create index if not exists character_knowledge_story_type_idx
+    on public.character_knowledge (story_id, content_type);
+
+create index if not exists character_knowledge_session_idx
+    on public.character_knowledge (session_id)
+    where session_id is not null;
+
+-- 部分索引只包含已生成嵌入的行；剧本/会话/类型过滤由迭代扫描配合 btree 索引完成
+create index if not exists character_knowledge_hnsw_idx
+    on public.character_knowledge
+    using hnsw (embedding vector_cosine_ops)
+    with (m = 16, ef_construction = 64)
+    where embedding is not null;
+
+-- ============ 长期记忆 ============
+-- memory_records 仅存在于完整版 schema（create_chat_tables），精简版跳过
+
+do $$
+begin
+    if to_regclass('public.memory_records') is null then
+        return;
+    end if;
+
+    if exists (
+        select 1 from pg_attribute
+        where attrelid = 'public.memory_records'::regclass
+          and attname = 'embedding'
+          and atttypmod <> 384
+    ) then
+        raise notice 'memory_records.embedding 维度变更为 384，已有嵌入需重新生成';
+        alter table public.memory_records
+            alter column embedding type vector(384) using null;
+    end if;
+
+    create index if not exists memory_records_hnsw_idx
+        on public.memory_records
+        using hnsw (embedding vector_cosine_ops)
+        with (m = 16, ef_construction = 64)
+        where embedding is not null;
+end;
+$$;
+
+-- ============ 检索函数 ============
+-- 先按距离排序取候选（走 HNSW 索引），再按阈值过滤；
+-- 带剧本/会话过滤时开启迭代扫描（pgvector >= 0.8），避免过滤后结果不足
+
+drop function if exists match_character_knowledge(vector, float, int, text);
+drop function if exists match_character_knowledge(vector, float, int, text, uuid, text);
+
+create or replace function match_character_knowledge(
+    query_embedding vector(384),
+    match_threshold float,
+    match_count int,
+    story_filter text,
+    session_filter uuid default null,
+    content_type_filter text default null
+)
+returns table (
+    id uuid,
+    character_name text,
+    content text,
+    content_type text,
+    metadata jsonb,
+    similarity float
+)
+language plpgsql
+as $$
+begin
+    if (select string_to_array(extversion, '.')::int[] >= array[0, 8]
+        from pg_extension where extname = 'vector') then
+        perform set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    end if;
+
+    return query
+    select c.id, c.character_name, c.content, c.content_type, c.metadata, c.similarity
+    from (
+        select
+            k.id,
+            k.character_name,
+            k.content,
+            k.content_type,
+            k.metadata,
+            1 - (k.embedding <=> query_embedding) as similarity
+        from public.character_knowledge k
+        where k.story_id = story_filter
+          and k.embedding is not null
+          and (session_filter is null or k.session_id is null or k.session_id = session_filter)
+          and (content_type_filter is null or k.content_type = content_type_filter)
+        order by k.embedding <=> query_embedding
+        limit match_count
+    ) c
+    where c.similarity > match_threshold
+    order by c.similarity desc;
+end;
+$$;
+
+create or replace function match_memory_records(
+    query_embedding vector(384),
+    match_threshold float,
+    match_count int,
+    story_filter uuid default null,
+    session_filter uuid default null
+)
+returns table (
+    id uuid,
+    session_id uuid,
+    title text,
+    summary text,
+    metadata jsonb,
+    similarity float
+)
+language plpgsql
+as $$
+begin
+    if (select string_to_array(extversion, '.')::int[] >= array[0, 8]
+        from pg_extension where extname = 'vector') then
+        perform set_config('hnsw.iterative_scan', 'relaxed_order', true);
+    end if;
+
+    return query
+    select m.id, m.session_id, m.title, m.summary, m.metadata, m.similarity
+    from (
+        select
+            r.id,
+            r.session_id,
+            r.title,
+            r.summary,
+            r.metadata,
+            1 - (r.embedding <=> query_embedding) as similarity
+        from public.memory_records r
+        where r.embedding is not null
+          and (story_filter is null or r.story_id = story_filter)
+          and (session_filter is null or r.session_id = session_filter)
+        order by r.embedding <=> query_embedding
+        limit match_count
+    ) m
+    where m.similarity > match_threshold
+    order by m.similarity desc;
+end;
+$$;
+
+-- 刷新 PostgREST schema cache，使 RPC 立即可用
+notify pgrst, 'reload schema';